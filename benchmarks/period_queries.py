@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""Query plans of working period lookups before and after indexes.
+
+Generates a dataset in a scratch database with all the migrations
+applied, prints query plans and timings with working period indexes
+(added by migration 0008) dropped and after creating them again. Uses
+a temporary SQLite file by default:
+
+    ./benchmarks/period_queries.py --lamps 1000 --periods 2000000
+
+Pass --keep-db PATH to reuse/keep the database file.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'demolighting.settings')
+
+
+def setup_django(db_path):
+    import django
+    from django.conf import settings
+
+    settings.DATABASES['default']['NAME'] = db_path
+    settings.LOGGING = {'version': 1}
+    django.setup()
+
+
+def migrate():
+    from django.core.management import call_command
+
+    call_command('migrate', verbosity=0)
+
+
+def set_period_indexes(enabled):
+    """Create or drop indexes of WorkingPeriod model."""
+    from django.db import connection
+
+    from lights.models import WorkingPeriod
+
+    table = WorkingPeriod._meta.db_table
+    with connection.cursor() as cursor:
+        existing = connection.introspection.get_constraints(cursor, table)
+    with connection.schema_editor() as schema_editor:
+        for index in WorkingPeriod._meta.indexes:
+            if enabled and index.name not in existing:
+                schema_editor.add_index(WorkingPeriod, index)
+            elif not enabled and index.name in existing:
+                schema_editor.remove_index(WorkingPeriod, index)
+
+
+def generate(lamp_count, period_count, batch_size=20000):
+    from django.db import transaction
+    from django.utils import timezone
+
+    from lights.models import Lamp, WorkingPeriod
+
+    Lamp.objects.bulk_create(
+        [Lamp(name=f'bench lamp {i}') for i in range(lamp_count)],
+        batch_size=batch_size)
+    lamp_ids = list(Lamp.objects.values_list('id', flat=True))
+
+    periods_per_lamp = max(period_count // len(lamp_ids), 1)
+    origin = datetime(2015, 1, 1, tzinfo=timezone.utc)
+    batch = []
+    with transaction.atomic():
+        # Interleave lamps like real history does
+        for n in range(periods_per_lamp):
+            start = origin + timedelta(hours=2 * n)
+            last = n == periods_per_lamp - 1
+            for lamp_id in lamp_ids:
+                batch.append(WorkingPeriod(
+                    lamp_id=lamp_id,
+                    brightness=100,
+                    start=start,
+                    end=None if last else start + timedelta(hours=1)))
+                if len(batch) >= batch_size:
+                    WorkingPeriod.objects.bulk_create(batch)
+                    batch = []
+        WorkingPeriod.objects.bulk_create(batch)
+
+
+def report(title):
+    from django.db import connection
+
+    from lights.models import Lamp, WorkingPeriod
+
+    lamp_id = Lamp.objects.order_by('?').values_list('id', flat=True)[0]
+    queries = {
+        'last period (latest start)':
+            WorkingPeriod.objects.filter(lamp_id=lamp_id).order_by('-start'),
+        'open periods of lamp':
+            WorkingPeriod.objects.filter(lamp_id=lamp_id, end__isnull=True),
+        'lamp page with total working time':
+            Lamp.objects.with_total_working_time().order_by('id')[:20],
+    }
+
+    print(f'=== {title} ===')
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+    for name, queryset in queries.items():
+        print(f'--- {name}')
+        print(queryset.explain())
+        started = time.perf_counter()
+        list(queryset[:20])
+        elapsed = time.perf_counter() - started
+        print(f'time: {elapsed * 1000:.1f} ms')
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lamps', type=int, default=1000)
+    parser.add_argument('--periods', type=int, default=1000000)
+    parser.add_argument('--keep-db', metavar='PATH')
+    args = parser.parse_args()
+
+    if args.keep_db:
+        db_path = args.keep_db
+    else:
+        tmp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(tmp_dir.name, 'bench.sqlite3')
+    setup_django(db_path)
+
+    from lights.models import WorkingPeriod
+
+    migrate()
+    set_period_indexes(False)
+    if not WorkingPeriod.objects.exists():
+        print(f'Generating {args.periods} periods for {args.lamps} lamps...')
+        generate(args.lamps, args.periods)
+    report('without indexes')
+
+    set_period_indexes(True)
+    report('with indexes')
+
+
+if __name__ == '__main__':
+    main()
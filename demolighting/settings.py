@@ -86,6 +86,16 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -141,6 +151,37 @@ REST_FRAMEWORK = {
 }
 
 
+# Switch class controlling the lamps and its keyword arguments. For
+# network controllers use "lights.network_switch.NetworkSwitch" with
+# options like {'controllers': [{'address': 'host:port'}]}.
+LIGHTS_SWITCH_BACKEND = 'lights.switch.Switch'
+LIGHTS_SWITCH_OPTIONS = {}
+
+# Lamp API only queues switch commands when enabled. Commands are
+# processed by "manage.py run_switch_worker".
+LIGHTS_ASYNC_SWITCH = False
+
+# Call the switch after committing mode changes instead of inside the
+# transaction. Failed changes are reverted by a compensating update.
+LIGHTS_SWITCH_AFTER_COMMIT = False
+
+# Rapid changes of a lamp within this number of milliseconds are
+# coalesced into one working period change (and one switch command with
+# LIGHTS_ASYNC_SWITCH). 0 disables it.
+LIGHTS_COALESCE_WINDOW_MS = 0
+
+# Cache for lamp API representations
+LIGHTS_REPRESENTATION_CACHE = 'default'
+
+# Lamp events older than this number of hours are deleted by
+# "manage.py prune_events"
+LIGHTS_EVENT_RETENTION_HOURS = 24
+
+# Working periods closed this number of days ago are deleted by
+# "manage.py archive_periods"
+LIGHTS_PERIOD_RETENTION_DAYS = 365
+
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
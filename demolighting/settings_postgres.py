@@ -0,0 +1,24 @@
+"""Settings for running with PostgreSQL.
+
+Use DJANGO_SETTINGS_MODULE=demolighting.settings_postgres, connection
+parameters are read from the standard PG* environment variables.
+Requires psycopg2.
+"""
+
+import os
+
+from .settings import *  # noqa: F401,F403
+
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('PGDATABASE', 'demolighting'),
+        'USER': os.environ.get('PGUSER', ''),
+        'PASSWORD': os.environ.get('PGPASSWORD', ''),
+        'HOST': os.environ.get('PGHOST', ''),
+        'PORT': os.environ.get('PGPORT', ''),
+        # Web workers reuse connections
+        'CONN_MAX_AGE': 60,
+    }
+}
@@ -1,17 +1,99 @@
 from django.contrib import admin
+from django.db import transaction
 
 from . import models
+from .services import update_group_counters, update_working_time
 
 
 @admin.register(models.Lamp)
 class LampAdmin(admin.ModelAdmin):
 
-    list_display = ('name', 'is_on', 'brightness')
+    list_display = ('name', 'is_on', 'brightness', 'group')
     ordering = ('name',)
 
+    # Group counters are kept up to date with lamp changes
+
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            previous_state = (models.Lamp.objects
+                              .filter(pk=obj.pk)
+                              .values_list('group', 'is_on', 'brightness')
+                              .first()
+                              if change
+                              else None)
+            super().save_model(request, obj, form, change)
+            update_group_counters([previous_state],
+                                  [(obj.group_id, obj.is_on, obj.brightness)])
+
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            update_group_counters([(obj.group_id, obj.is_on, obj.brightness)],
+                                  [None])
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            states = list(queryset.values_list('group', 'is_on', 'brightness'))
+            update_group_counters(states, [None] * len(states))
+            super().delete_queryset(request, queryset)
+
+
+@admin.register(models.LampGroup)
+class LampGroupAdmin(admin.ModelAdmin):
+
+    list_display = ('name', 'path', 'lamp_count', 'on_count')
+    ordering = ('path',)
+    search_fields = ('name',)
+
 
 @admin.register(models.WorkingPeriod)
 class WorkingPeriodAdmin(admin.ModelAdmin):
 
     list_display = ('lamp', 'brightness', 'start', 'end')
     ordering = ('-start',)
+    # Counting all the periods is slow
+    show_full_result_count = False
+
+    # Working time counters of lamps are kept up to date with period
+    # changes
+
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            previous_periods = (list(models.WorkingPeriod.objects
+                                     .filter(pk=obj.pk))
+                                if change
+                                else [])
+            super().save_model(request, obj, form, change)
+            update_working_time(previous_periods, [obj])
+
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            # obj may be loaded before the period was closed
+            update_working_time(models.WorkingPeriod.objects.filter(pk=obj.pk),
+                                [])
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            update_working_time(queryset, [])
+            super().delete_queryset(request, queryset)
+
+
+@admin.register(models.LampCommand)
+class LampCommandAdmin(admin.ModelAdmin):
+
+    list_display = ('lamp', 'status', 'attempts', 'created', 'error')
+    list_filter = ('status',)
+    ordering = ('-id',)
+
+
+@admin.register(models.Schedule)
+class ScheduleAdmin(admin.ModelAdmin):
+
+    list_display = ('name', 'cron', 'on', 'brightness', 'enabled',
+                    'next_fire')
+    list_filter = ('enabled',)
+    ordering = ('name',)
+    # Lamp choices would load all the lamps
+    raw_id_fields = ('lamps',)
+    filter_horizontal = ('groups',)
@@ -1,10 +1,50 @@
-from rest_framework import mixins, viewsets
-from rest_framework.exceptions import APIException
+import hashlib
+import io
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, Max, Q, Sum
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework import mixins, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import (
+    APIException,
+    NotFound,
+    ParseError,
+    ValidationError,
+)
+from rest_framework.parsers import BaseParser, JSONParser
+from rest_framework.permissions import IsAdminUser
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
-from .models import Lamp
-from .serializers import LampSerializer
-from .services import lamp_service, ExternalError
+from .export import iter_periods_csv, iter_periods_ndjson, period_rows
+from .imports import read_lamp_definitions
+from .models import Lamp, LampEvent, LampGroup
+from .pagination import LampCursorPagination, LampPageNumberPagination
+from .reports import ReportBucket, working_time_report
+from .serializers import (
+    CachedLampSerializer,
+    GroupModeSerializer,
+    LampGroupSerializer,
+    LampModeSerializer,
+    LampSerializer,
+    PeriodExportParamsSerializer,
+    ReportBucketSerializer,
+    WorkingTimeReportParamsSerializer,
+)
+from .services import (
+    lamp_service,
+    ExternalBatchError,
+    ExternalError,
+    LampModeChange,
+    import_lamps,
+)
 
 
 class ServiceUnavailableError(APIException):
@@ -13,6 +53,57 @@ class ServiceUnavailableError(APIException):
     default_code = 'service_unavailable'
 
 
+class EventStreamRenderer(BaseRenderer):
+    """Renderer for Server-Sent Events.
+
+    Event streams are returned as StreamingHttpResponse, this renderer
+    is used for content negotiation and error responses only.
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return f'event: error\ndata: {json.dumps(data)}\n\n'.encode()
+
+
+class PeriodExportRenderer(BaseRenderer):
+    """Base renderer of period export formats.
+
+    Exports are returned as StreamingHttpResponse, renderers are used
+    for content negotiation and error responses (rendered as JSON)
+    only.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data).encode()
+
+
+class CSVRenderer(PeriodExportRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class NDJSONRenderer(PeriodExportRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+
+class CSVParser(BaseParser):
+    """Parser of CSV with a header row into a list of dicts."""
+
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        try:
+            text = stream.read().decode(encoding)
+            return list(read_lamp_definitions(io.StringIO(text, newline=''),
+                                              'csv'))
+        except (UnicodeDecodeError, ValueError) as e:
+            raise ParseError(f'CSV parse error - {e}')
+
+
 class LampViewSet(mixins.RetrieveModelMixin,
                   mixins.ListModelMixin,
                   viewsets.GenericViewSet):
@@ -23,9 +114,140 @@ class LampViewSet(mixins.RetrieveModelMixin,
     PUT is not necessary for this API - creation is handled by POST
     and replacement is not allowed. Partial update is handled by
     PATCH, like it supposed to be.
+
+    Multiple lamps can be controlled at once with PATCH to bulk/,
+    passing a list of objects with lamp id, is_on and brightness.
+
+    Admins can create lamps with POST to import/, passing a list of
+    objects (JSON or CSV) with lamp name and brightness. Existing lamps
+    are updated with update=true parameter.
+
+    With LIGHTS_ASYNC_SWITCH setting enabled, mode changes only queue
+    switch commands and 202 is returned. Clients can track
+    actual_is_on and actual_brightness to see when they are applied.
+
+    List and detail responses support conditional requests. Weak
+    ETags are built from lamp versions without serializing lamps.
+    total_working_time of lamps that are on is considered fresh for
+    working_time_resolution seconds.
+
+    The list is paginated by page number. Clients walking the whole
+    collection should pass pagination=cursor and follow next links:
+    cursor pages are fetched by lamp id range without counting lamps.
+    Page size can be set with page_size.
+
+    State changes of lamps are streamed by events/ as Server-Sent
+    Events. The stream is resumed from Last-Event-ID header (or
+    last_event_id parameter) if given, otherwise only new events are
+    sent. The stream is closed after event_stream_timeout seconds,
+    clients are expected to reconnect. Events are kept for
+    LIGHTS_EVENT_RETENTION_HOURS (see prune_events command), a stream
+    resumed from a deleted event starts with the oldest event left.
     """
+    # Maximum number of lamps in a bulk request
+    bulk_max_lamps = 1000
+    # Maximum number of lamps in an import request
+    import_max_lamps = 100000
+    # Seconds
+    working_time_resolution = 60
+    # Event stream settings, seconds
+    event_stream_timeout = 300
+    event_stream_poll_interval = 1
+    event_stream_keepalive_interval = 15
+    # Maximum number of events fetched by one query
+    event_stream_batch_size = 500
+
     queryset = Lamp.objects.all().order_by('id')
     serializer_class = LampSerializer
+    pagination_class = LampPageNumberPagination
+    cursor_pagination_class = LampCursorPagination
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if self._is_cursor_pagination():
+                self._paginator = self.cursor_pagination_class()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def get_serializer_class(self):
+        if self.action in ('list', 'retrieve'):
+            # Lamps are modified on update, so they are serialized
+            # without cache then
+            return CachedLampSerializer
+        return super().get_serializer_class()
+
+    def list(self, request, *args, **kwargs):
+        if self._is_cursor_pagination():
+            # Collection state would cost a full scan for every page
+            return super().list(request, *args, **kwargs)
+
+        state = self.filter_queryset(self.get_queryset()).aggregate(
+            count=Count('pk'),
+            max_id=Max('pk'),
+            versions=Sum('version'),
+            on_count=Count('pk', filter=Q(is_on=True)))
+        # No Last-Modified: max modification time of lamps doesn't
+        # change when a lamp is deleted, ETag does
+        return self._conditional_response(
+            request,
+            [state['count'], state['max_id'], state['versions']],
+            has_active_lamps=bool(state['on_count']),
+            last_modified=None,
+            get_response=lambda: super(LampViewSet, self).list(
+                request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        lamp = self.get_object()
+        return self._conditional_response(
+            request,
+            [lamp.pk, lamp.version],
+            has_active_lamps=lamp.is_on,
+            last_modified=lamp.modified,
+            get_response=lambda: Response(self.get_serializer(lamp).data))
+
+    def _is_cursor_pagination(self):
+        return (self.request is not None
+                and self.request.query_params.get('pagination') == 'cursor')
+
+    def _conditional_response(self, request, state, *, has_active_lamps,
+                              last_modified, get_response):
+        """Return 304 response if resource state is not changed.
+
+        :param list state: values identifying resource state
+        :param bool has_active_lamps: resource includes lamps that
+            are on, so its working time changes over time
+        :param datetime last_modified: last modification time or None
+            if it's unknown, Last-Modified isn't sent then
+        :param get_response: callable returning full response
+        """
+        etag_parts = [request.build_absolute_uri(),
+                      request.accepted_media_type,
+                      *state]
+        # HTTP dates have one second precision
+        last_modified_timestamp = (int(last_modified.timestamp())
+                                   if last_modified else None)
+        if has_active_lamps:
+            resolution = self.working_time_resolution
+            time_slot_start = time.time() // resolution * resolution
+            etag_parts.append(time_slot_start)
+            if last_modified_timestamp is not None:
+                last_modified_timestamp = max(last_modified_timestamp,
+                                              time_slot_start)
+        digest = hashlib.md5(repr(etag_parts).encode()).hexdigest()
+        etag = f'W/"{digest}"'
+
+        response = get_conditional_response(
+            request,
+            etag=etag,
+            last_modified=last_modified_timestamp)
+        if response is None:
+            response = get_response()
+        response['ETag'] = etag
+        if last_modified_timestamp is not None:
+            response['Last-Modified'] = http_date(last_modified_timestamp)
+        return response
 
     def partial_update(self, request, pk=None):
         lamp = self.get_object()
@@ -33,15 +255,281 @@ class LampViewSet(mixins.RetrieveModelMixin,
                                                  data=request.data,
                                                  partial=True)
         request_serializer.is_valid(raise_exception=True)
+        on = request_serializer.validated_data.get('is_on')
+        brightness = request_serializer.validated_data.get('brightness')
 
-        try:
-            lamp_service.set_lamp_mode(
-                lamp,
-                on=request_serializer.validated_data.get('is_on'),
-                brightness=request_serializer.validated_data.get('brightness'))
-        except ExternalError:
-            raise ServiceUnavailableError(
-                detail='Failed to switch the lamp, try again later')
+        if _is_switch_async():
+            lamp_service.request_lamp_mode(lamp, on=on, brightness=brightness)
+            response_status = status.HTTP_202_ACCEPTED
+        else:
+            try:
+                lamp_service.set_lamp_mode(lamp, on=on, brightness=brightness)
+            except ExternalError:
+                raise ServiceUnavailableError(
+                    detail='Failed to switch the lamp, try again later')
+            response_status = status.HTTP_200_OK
 
         response_serializer = self.get_serializer(lamp)
-        return Response(response_serializer.data)
+        return Response(response_serializer.data, status=response_status)
+
+    @action(detail=False, methods=['patch'])
+    def bulk(self, request):
+        request_serializer = LampModeSerializer(data=request.data, many=True)
+        request_serializer.is_valid(raise_exception=True)
+        entries = request_serializer.validated_data
+        if len(entries) > self.bulk_max_lamps:
+            raise ValidationError(
+                f'No more than {self.bulk_max_lamps} lamps are allowed')
+        lamp_ids = [entry['id'] for entry in entries]
+        if len(set(lamp_ids)) != len(lamp_ids):
+            raise ValidationError('Lamp ids should be unique')
+
+        lamps = Lamp.objects.in_bulk(lamp_ids)
+        missing_ids = set(lamp_ids) - lamps.keys()
+        if missing_ids:
+            raise NotFound(f'Lamps not found: {sorted(missing_ids)}')
+
+        changes = [LampModeChange(lamps[entry['id']],
+                                  on=entry.get('is_on'),
+                                  brightness=entry.get('brightness'))
+                   for entry in entries]
+        if _is_switch_async():
+            lamp_service.request_lamps_mode(changes)
+            response_status = status.HTTP_202_ACCEPTED
+        else:
+            try:
+                lamp_service.set_lamps_mode(changes)
+            except ExternalBatchError as e:
+                raise ServiceUnavailableError(
+                    detail=(f'Failed to switch lamps {sorted(e.errors)}, '
+                            f'other lamps are switched'))
+            except ExternalError:
+                raise ServiceUnavailableError(
+                    detail='Failed to switch the lamps, try again later')
+            response_status = status.HTTP_200_OK
+
+        updated_lamps = (Lamp.objects
+                         .with_total_working_time()
+                         .filter(pk__in=lamp_ids)
+                         .order_by('id'))
+        response_serializer = self.get_serializer(updated_lamps, many=True)
+        return Response(response_serializer.data, status=response_status)
+
+    @action(detail=False, methods=['post'], url_path='import',
+            permission_classes=[IsAdminUser],
+            parser_classes=[JSONParser, CSVParser])
+    def lamp_import(self, request):
+        definitions = request.data
+        if (not isinstance(definitions, list)
+                or not all(isinstance(item, dict) for item in definitions)):
+            raise ValidationError('A list of objects is expected')
+        if len(definitions) > self.import_max_lamps:
+            raise ValidationError(
+                f'No more than {self.import_max_lamps} lamps are allowed')
+
+        result = import_lamps(
+            definitions,
+            update=request.query_params.get('update') == 'true')
+        return Response({
+            'created': result.created,
+            'updated': result.updated,
+            'unchanged': result.unchanged,
+            'conflicts': [{'row': row_number, 'name': name, 'reason': reason}
+                          for row_number, name, reason in result.conflicts],
+        })
+
+    @action(detail=False,
+            renderer_classes=[EventStreamRenderer, JSONRenderer])
+    def events(self, request):
+        last_event_id = request.META.get(
+            'HTTP_LAST_EVENT_ID',
+            request.query_params.get('last_event_id'))
+        if last_event_id is None:
+            last_event_id = (LampEvent.objects
+                             .aggregate(last_id=Max('pk'))['last_id'] or 0)
+        else:
+            try:
+                last_event_id = int(last_event_id)
+            except ValueError:
+                raise ValidationError('Invalid event id')
+
+        response = StreamingHttpResponse(
+            self._stream_events(last_event_id),
+            content_type=EventStreamRenderer.media_type)
+        response['Cache-Control'] = 'no-cache'
+        # Disable response buffering by nginx
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def _stream_events(self, last_event_id):
+        """Generate events following last_event_id.
+
+        Events are polled from the database, so one query per poll
+        interval is done for a client instead of client requests.
+
+        Event ids are assigned on insert, so an event of a concurrent
+        transaction may be committed after a later event is sent and
+        be skipped. It's not possible with SQLite serializing writes.
+        """
+        yield f'retry: {self.event_stream_poll_interval * 1000}\n\n'
+        deadline = time.monotonic() + self.event_stream_timeout
+        last_sent = time.monotonic()
+        while True:
+            events = list(LampEvent.objects
+                          .filter(pk__gt=last_event_id)
+                          .order_by('pk')[:self.event_stream_batch_size])
+            for event in events:
+                yield _format_event(event)
+            if events:
+                last_event_id = events[-1].pk
+                last_sent = time.monotonic()
+                if len(events) == self.event_stream_batch_size:
+                    continue
+
+            now = time.monotonic()
+            if now >= deadline:
+                return
+            if now - last_sent >= self.event_stream_keepalive_interval:
+                # Comment line, ignored by clients
+                yield ': keepalive\n\n'
+                last_sent = now
+            time.sleep(min(self.event_stream_poll_interval, deadline - now))
+
+
+class LampGroupViewSet(mixins.RetrieveModelMixin,
+                       mixins.ListModelMixin,
+                       viewsets.GenericViewSet):
+    """Viewset for LampGroup.
+
+    Groups are read-only, lamp counters of a group include its whole
+    subtree. Lamps of a group subtree are controlled at once with PATCH
+    to control/, passing is_on and brightness. Lamps already in the
+    mode are not changed. The response is the group with updated
+    counters.
+    """
+
+    queryset = LampGroup.objects.all().order_by('id')
+    serializer_class = LampGroupSerializer
+
+    @action(detail=True, methods=['patch'])
+    def control(self, request, pk=None):
+        group = self.get_object()
+        request_serializer = GroupModeSerializer(data=request.data)
+        request_serializer.is_valid(raise_exception=True)
+        on = request_serializer.validated_data.get('is_on')
+        brightness = request_serializer.validated_data.get('brightness')
+
+        if _is_switch_async():
+            lamp_service.request_group_mode(group, on=on,
+                                            brightness=brightness)
+            response_status = status.HTTP_202_ACCEPTED
+        else:
+            try:
+                lamp_service.set_group_mode(group, on=on,
+                                            brightness=brightness)
+            except ExternalBatchError as e:
+                raise ServiceUnavailableError(
+                    detail=(f'Failed to switch lamps {sorted(e.errors)}, '
+                            f'other lamps are switched'))
+            except ExternalError:
+                raise ServiceUnavailableError(
+                    detail='Failed to switch the lamps, try again later')
+            response_status = status.HTTP_200_OK
+
+        group.refresh_from_db()
+        response_serializer = self.get_serializer(group)
+        return Response(response_serializer.data, status=response_status)
+
+
+class SwitchStatusView(APIView):
+    """State of switch controllers (circuit breakers) for monitoring."""
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response({'controllers': lamp_service.switch.status()})
+
+
+class WorkingTimeReportView(APIView):
+    """Working time of lamps in a time window.
+
+    Parameters: start and end of the window, bucket size (hour or
+    day), lamp ids (all lamps by default). Working time and
+    brightness-weighted working time are returned for the whole window
+    and for every bucket.
+    """
+
+    def get(self, request):
+        params_serializer = WorkingTimeReportParamsSerializer(data={
+            **request.query_params.dict(),
+            'lamp': request.query_params.getlist('lamp')})
+        params_serializer.is_valid(raise_exception=True)
+        params = params_serializer.validated_data
+
+        buckets = working_time_report(params['start'],
+                                      params['end'],
+                                      bucket=params['bucket'],
+                                      lamp_ids=params.get('lamp') or None)
+        total = ReportBucket(
+            params['start'],
+            working_time=sum((bucket.working_time for bucket in buckets),
+                             timedelta()),
+            weighted_working_time=sum(
+                (bucket.weighted_working_time for bucket in buckets),
+                timedelta()))
+        return Response({
+            'start': params['start'],
+            'end': params['end'],
+            'bucket': params['bucket'],
+            'total': ReportBucketSerializer(total).data,
+            'buckets': ReportBucketSerializer(buckets, many=True).data,
+        })
+
+
+class WorkingPeriodExportView(APIView):
+    """Export of working period history for admins.
+
+    Periods are streamed as CSV or newline-delimited JSON (chosen by
+    Accept header or format parameter: csv or ndjson). Parameters:
+    lamp ids, start and end - range of period start times.
+    """
+
+    permission_classes = [IsAdminUser]
+    renderer_classes = [CSVRenderer, NDJSONRenderer]
+
+    def get(self, request):
+        params_serializer = PeriodExportParamsSerializer(data={
+            **request.query_params.dict(),
+            'lamp': request.query_params.getlist('lamp')})
+        params_serializer.is_valid(raise_exception=True)
+        params = params_serializer.validated_data
+
+        rows = period_rows(lamp_ids=params.get('lamp') or None,
+                           start=params.get('start'),
+                           end=params.get('end'))
+        renderer = request.accepted_renderer
+        if renderer.format == NDJSONRenderer.format:
+            content = iter_periods_ndjson(rows)
+        else:
+            content = iter_periods_csv(rows)
+        response = StreamingHttpResponse(content,
+                                         content_type=renderer.media_type)
+        response['Content-Disposition'] = (
+            f'attachment; filename="periods.{renderer.format}"')
+        return response
+
+
+def _format_event(event):
+    data = {
+        'id': event.lamp_id,
+        'is_on': event.is_on,
+        'brightness': event.brightness,
+        'actual_is_on': event.actual_is_on,
+        'actual_brightness': event.actual_brightness,
+        'time': event.created.isoformat(),
+    }
+    return f'id: {event.pk}\nevent: lamp\ndata: {json.dumps(data)}\n\n'
+
+
+def _is_switch_async():
+    return getattr(settings, 'LIGHTS_ASYNC_SWITCH', False)
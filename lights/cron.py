@@ -0,0 +1,139 @@
+"""Cron-like schedule expressions.
+
+An expression has five space separated fields: minute, hour, day of
+month, month and day of week (0-7, Sunday is 0 or 7). A field is a
+comma separated list of values, ranges ("1-5") or "*", optionally with
+a step ("*/15", "8-18/2"). Like in cron, if both days of month and of
+week are restricted, a day matching either of them matches.
+
+Expressions are evaluated in the current time zone.
+"""
+
+from datetime import datetime, time, timedelta
+
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+
+
+# Name, min and max value of the fields
+_FIELDS = [
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day', 1, 31),
+    ('month', 1, 12),
+    ('weekday', 0, 7),
+]
+
+# Expressions like "0 0 29 2 *" fire once in 4 (or 8) years
+_MAX_DAYS = 366 * 8 + 1
+
+
+class CronExpression:
+    """Parsed cron-like expression.
+
+    :raises ValueError: if the expression is invalid
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        parts = expression.split()
+        if len(parts) != len(_FIELDS):
+            raise ValueError(f'{len(_FIELDS)} fields are expected, '
+                             f'got {len(parts)}')
+        values = [_parse_field(part, *field)
+                  for part, field in zip(parts, _FIELDS)]
+        minutes, hours, days, months, weekdays = values
+        self.minutes = sorted(minutes)
+        self.hours = sorted(hours)
+        self.days = days
+        self.months = months
+        # Sunday is 7 for date.isoweekday()
+        self.weekdays = {weekday or 7 for weekday in weekdays}
+        self._any_day = parts[2] == '*'
+        self._any_weekday = parts[4] == '*'
+
+    def __str__(self):
+        return self.expression
+
+    def next_after(self, moment):
+        """Find the first time matching the expression after moment.
+
+        :param datetime moment: aware datetime
+        :returns: aware datetime or None if the expression never
+            matches (e.g. "0 0 31 2 *")
+        """
+        local = (timezone.localtime(moment)
+                 .replace(tzinfo=None, second=0, microsecond=0)
+                 + timedelta(minutes=1))
+        date = local.date()
+        earliest = local.time()
+        for _ in range(_MAX_DAYS):
+            if self._matches_date(date):
+                fire_time = self._first_time(earliest)
+                if fire_time is not None:
+                    return timezone.make_aware(datetime.combine(date,
+                                                                fire_time),
+                                               is_dst=False)
+            date += timedelta(days=1)
+            earliest = time()
+        return None
+
+    def _matches_date(self, date):
+        if date.month not in self.months:
+            return False
+        day_matches = date.day in self.days
+        weekday_matches = date.isoweekday() in self.weekdays
+        if self._any_day:
+            return weekday_matches
+        if self._any_weekday:
+            return day_matches
+        return day_matches or weekday_matches
+
+    def _first_time(self, earliest):
+        """Return first matching time of day not before earliest."""
+        for hour in self.hours:
+            if hour < earliest.hour:
+                continue
+            for minute in self.minutes:
+                if hour > earliest.hour or minute >= earliest.minute:
+                    return time(hour, minute)
+        return None
+
+
+def _parse_field(value, name, min_value, max_value):
+    """Parse a field of an expression into a set of values."""
+    values = set()
+    for item in value.split(','):
+        try:
+            values.update(_parse_item(item, min_value, max_value))
+        except ValueError as e:
+            raise ValueError(f'invalid {name} "{item}": {e}')
+    return values
+
+
+def _parse_item(item, min_value, max_value):
+    spec, slash, step = item.partition('/')
+    step = int(step) if slash else 1
+    if step < 1:
+        raise ValueError('step should be positive')
+    if spec == '*':
+        first, last = min_value, max_value
+    elif '-' in spec:
+        first, last = map(int, spec.split('-', 1))
+    else:
+        first = int(spec)
+        # "5/10" means from 5 to the max value
+        last = max_value if slash else first
+    if not min_value <= first <= last <= max_value:
+        raise ValueError(f'values should be in {min_value}-{max_value}')
+    return range(first, last + 1, step)
+
+
+def validate_cron(value):
+    """Validator of cron-like expression fields."""
+    try:
+        expression = CronExpression(value)
+    except ValueError as e:
+        raise ValidationError(f'Invalid schedule: {e}')
+    if expression.next_after(timezone.now()) is None:
+        raise ValidationError('The schedule never fires')
@@ -0,0 +1,84 @@
+"""Export of working period history.
+
+Periods are read with a server-side iterator and written row by row,
+so memory usage doesn't depend on the number of periods.
+"""
+
+import csv
+import json
+
+from .models import WorkingPeriod
+
+
+PERIOD_FIELDS = ['id', 'lamp_id', 'brightness', 'start', 'end']
+
+# Number of rows fetched from the database at once
+CHUNK_SIZE = 2000
+
+
+def period_rows(*, lamp_ids=None, start=None, end=None):
+    """Iterate over working periods as tuples of PERIOD_FIELDS values.
+
+    Periods are ordered by id.
+
+    :param lamp_ids: periods of these lamps only
+    :param datetime start: periods started at or after it
+    :param datetime end: periods started before it
+    """
+    periods = WorkingPeriod.objects.order_by('pk')
+    if lamp_ids is not None:
+        periods = periods.filter(lamp__in=lamp_ids)
+    if start is not None:
+        periods = periods.filter(start__gte=start)
+    if end is not None:
+        periods = periods.filter(start__lt=end)
+    return periods.values_list(*PERIOD_FIELDS).iterator(chunk_size=CHUNK_SIZE)
+
+
+def iter_periods_csv(rows, *, header=True):
+    """Generate CSV lines for working periods.
+
+    :param rows: iterable of tuples of PERIOD_FIELDS values
+    :param bool header: start with a header line
+    """
+    writer = csv.writer(_LineBuffer())
+    if header:
+        yield writer.writerow(PERIOD_FIELDS)
+    for period_id, lamp_id, brightness, start, end in rows:
+        yield writer.writerow([period_id,
+                               lamp_id,
+                               brightness,
+                               start.isoformat(),
+                               end.isoformat() if end else ''])
+
+
+def iter_periods_ndjson(rows):
+    """Generate newline-delimited JSON lines for working periods.
+
+    :param rows: iterable of tuples of PERIOD_FIELDS values
+    """
+    for period_id, lamp_id, brightness, start, end in rows:
+        yield json.dumps({
+            'id': period_id,
+            'lamp_id': lamp_id,
+            'brightness': brightness,
+            'start': start.isoformat(),
+            'end': end.isoformat() if end else None,
+        }) + '\n'
+
+
+def write_periods_csv(rows, file, *, header=True):
+    """Write working periods as CSV.
+
+    :param rows: iterable of tuples of PERIOD_FIELDS values
+    :param file: text file
+    :param bool header: write a header row
+    """
+    file.writelines(iter_periods_csv(rows, header=header))
+
+
+class _LineBuffer:
+    """File-like object returning written lines instead of storing."""
+
+    def write(self, value):
+        return value
@@ -0,0 +1,28 @@
+"""Reading of lamp definitions for import."""
+
+import csv
+import json
+
+
+FORMATS = ['csv', 'json']
+
+
+def read_lamp_definitions(file, format):
+    """Read lamp definitions from a file.
+
+    CSV should have a header row with "name" and optionally
+    "brightness" columns. JSON should be a list of objects with the
+    same keys.
+
+    :param file: text file
+    :param str format: one of FORMATS
+    :returns: iterable of dicts
+    :raises ValueError: if the file can't be parsed
+    """
+    if format == 'csv':
+        return csv.DictReader(file)
+    definitions = json.load(file)
+    if (not isinstance(definitions, list)
+            or not all(isinstance(item, dict) for item in definitions)):
+        raise ValueError('JSON should be a list of objects')
+    return definitions
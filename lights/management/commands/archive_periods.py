@@ -0,0 +1,43 @@
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from lights.services import archive_periods
+
+
+class Command(BaseCommand):
+
+    help = ('Delete working periods closed before the retention period, '
+            'keeping working time of lamps. Daily usage should be built '
+            'for the periods first (see rebuild_daily_usage).')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than',
+            type=int,
+            default=getattr(settings, 'LIGHTS_PERIOD_RETENTION_DAYS', 365),
+            help='Retention period, days.')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10000,
+            help='Number of periods archived in one transaction.')
+        parser.add_argument(
+            '--export',
+            metavar='PATH',
+            help='Append archived periods to a CSV file.')
+
+    def handle(self, *args, older_than, batch_size, export, **options):
+        cutoff_date = timezone.localdate() - timedelta(days=older_than)
+        cutoff = timezone.make_aware(datetime.combine(cutoff_date, time()))
+
+        if export:
+            with open(export, 'a', newline='') as export_file:
+                count = archive_periods(cutoff,
+                                        batch_size=batch_size,
+                                        export_file=export_file)
+        else:
+            count = archive_periods(cutoff, batch_size=batch_size)
+        self.stdout.write(f'Periods closed before {cutoff} archived: {count}')
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from lights.services import close_abandoned_periods
+
+
+class Command(BaseCommand):
+
+    help = ('Close abandoned working periods (open, but not last) at start '
+            'of the next period, adding their working time to lamps.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report abandoned periods.')
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=500,
+            help='Number of lamps processed in one transaction.')
+
+    def handle(self, *args, dry_run, chunk_size, **options):
+        periods = close_abandoned_periods(chunk_size=chunk_size,
+                                          dry_run=dry_run)
+        if dry_run or options['verbosity'] > 1:
+            for period in periods:
+                self.stdout.write(
+                    f'Abandoned period {period.pk} of lamp {period.lamp_id} '
+                    f'from {period.start} to {period.end}')
+        action = 'found' if dry_run else 'closed'
+        lamp_count = len({period.lamp_id for period in periods})
+        self.stdout.write(f'Abandoned periods {action}: {len(periods)} '
+                          f'(lamps: {lamp_count})')
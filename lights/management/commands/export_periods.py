@@ -0,0 +1,60 @@
+import argparse
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from lights.export import iter_periods_csv, iter_periods_ndjson, period_rows
+
+
+class Command(BaseCommand):
+
+    help = ('Export working periods as CSV or newline-delimited JSON. '
+            'Periods are streamed, so any number of them can be exported.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format',
+            choices=['csv', 'ndjson'],
+            default='csv',
+            help='Output format.')
+        parser.add_argument(
+            '--lamp',
+            type=int,
+            action='append',
+            help='Export periods of a lamp (id), can be repeated.')
+        parser.add_argument(
+            '--start',
+            type=_datetime,
+            help='Export periods started at or after this ISO 8601 time.')
+        parser.add_argument(
+            '--end',
+            type=_datetime,
+            help='Export periods started before this ISO 8601 time.')
+        parser.add_argument(
+            '--output',
+            metavar='PATH',
+            help='Output file, stdout by default.')
+
+    def handle(self, *args, format, lamp, start, end, output, **options):
+        rows = period_rows(lamp_ids=lamp, start=start, end=end)
+        if format == 'ndjson':
+            lines = iter_periods_ndjson(rows)
+        else:
+            lines = iter_periods_csv(rows)
+
+        if output:
+            with open(output, 'w', newline='') as output_file:
+                output_file.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
+
+
+def _datetime(value):
+    result = parse_datetime(value)
+    if result is None:
+        raise argparse.ArgumentTypeError(f'Invalid date/time: {value}')
+    if timezone.is_naive(result):
+        result = timezone.make_aware(result)
+    return result
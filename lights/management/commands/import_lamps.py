@@ -0,0 +1,62 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lights.imports import FORMATS, read_lamp_definitions
+from lights.services import import_lamps
+
+
+class Command(BaseCommand):
+
+    help = ('Create lamps from a CSV or JSON file with lamp names and '
+            'brightness. Lamps are matched by name, existing ones are '
+            'reported as conflicts unless --update is given.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            help='Input file, "-" for stdin.')
+        parser.add_argument(
+            '--format',
+            choices=FORMATS,
+            help='Input format, detected by file extension by default.')
+        parser.add_argument(
+            '--update',
+            action='store_true',
+            help='Update brightness of existing lamps.')
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Number of lamps processed in one transaction.')
+
+    def handle(self, *args, path, format, update, chunk_size, **options):
+        if format is None:
+            format = os.path.splitext(path)[1].lstrip('.').lower()
+            if format not in FORMATS:
+                raise CommandError('Unknown file format, use --format')
+
+        if path == '-':
+            result = self.import_file(sys.stdin, format, update, chunk_size)
+        else:
+            with open(path, newline='') as input_file:
+                result = self.import_file(input_file, format, update,
+                                          chunk_size)
+
+        for row_number, name, reason in result.conflicts:
+            self.stdout.write(f'Row {row_number} "{name}": {reason}')
+        self.stdout.write(f'Lamps created: {result.created}, '
+                          f'updated: {result.updated}, '
+                          f'unchanged: {result.unchanged}')
+        if result.conflicts:
+            raise CommandError(f'{len(result.conflicts)} conflict(s)')
+
+    def import_file(self, input_file, format, update, chunk_size):
+        try:
+            definitions = read_lamp_definitions(input_file, format)
+            return import_lamps(definitions,
+                                update=update,
+                                chunk_size=chunk_size)
+        except ValueError as e:
+            raise CommandError(f'Invalid input: {e}')
@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from lights.services import prune_events
+
+
+class Command(BaseCommand):
+
+    help = ('Delete lamp events older than the retention period. Clients '
+            'resuming the event stream from deleted events get the events '
+            'left only.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than',
+            type=int,
+            default=getattr(settings, 'LIGHTS_EVENT_RETENTION_HOURS', 24),
+            help='Retention period, hours.')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10000,
+            help='Number of events deleted in one transaction.')
+
+    def handle(self, *args, older_than, batch_size, **options):
+        cutoff = timezone.now() - timedelta(hours=older_than)
+        count = prune_events(cutoff, batch_size=batch_size)
+        self.stdout.write(f'Events created before {cutoff} deleted: {count}')
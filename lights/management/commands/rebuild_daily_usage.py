@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from lights.models import Lamp
+
+
+class Command(BaseCommand):
+
+    help = ('Rebuild daily usage rollup of lamps from working period '
+            'history.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=100,
+            help='Number of lamps processed in one transaction.')
+
+    def handle(self, *args, chunk_size, **options):
+        row_count = 0
+        last_pk = 0
+        while True:
+            pks = list(Lamp.objects
+                       .filter(pk__gt=last_pk)
+                       .order_by('pk')
+                       .values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            with transaction.atomic():
+                row_count += (Lamp.objects
+                              .filter(pk__in=pks)
+                              .select_for_update()
+                              .rebuild_daily_usage())
+        self.stdout.write(f'Daily usage rows created: {row_count}')
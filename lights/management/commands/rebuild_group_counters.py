@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from lights.models import LampGroup
+
+
+class Command(BaseCommand):
+
+    help = 'Recalculate lamp counters of lamp groups from lamps.'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            drifted = LampGroup.objects.select_for_update().rebuild_counters()
+        for group in drifted:
+            self.stdout.write(f'Fixed counters of group "{group}"')
+        self.stdout.write(f'Groups with drifted counters: {len(drifted)}')
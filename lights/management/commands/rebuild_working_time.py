@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from lights.models import Lamp
+
+
+class Command(BaseCommand):
+
+    help = ('Rebuild closed working time counters of lamps from working '
+            'period history.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report drifted counters, exit with error if any.')
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=500,
+            help='Number of lamps processed in one transaction.')
+
+    def handle(self, *args, check, chunk_size, **options):
+        drifted_count = 0
+        last_pk = 0
+        while True:
+            pks = list(Lamp.objects
+                       .filter(pk__gt=last_pk)
+                       .order_by('pk')
+                       .values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            with transaction.atomic():
+                drifted = (Lamp.objects
+                           .filter(pk__in=pks)
+                           .select_for_update()
+                           .rebuild_closed_working_time(dry_run=check))
+            for lamp in drifted:
+                self.stdout.write(
+                    f'Drift for lamp {lamp.pk} "{lamp.name}", '
+                    f'correct value: {lamp.closed_working_time}')
+            drifted_count += len(drifted)
+
+        if check and drifted_count:
+            raise CommandError(f'{drifted_count} lamp(s) with drifted counter')
+        action = 'found' if check else 'fixed'
+        self.stdout.write(f'Drifted counters {action}: {drifted_count}')
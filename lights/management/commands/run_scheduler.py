@@ -0,0 +1,67 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from lights.scheduler import Scheduler
+from lights.services import lamp_service
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = ('Fire lamp schedules. Sleeps until the earliest schedule is '
+            'due, changed schedules are picked up periodically.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of schedules or lamps processed at once.')
+        parser.add_argument(
+            '--refresh-interval',
+            type=float,
+            default=10.0,
+            help='Seconds between checks for changed schedules.')
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Fire due schedules and exit.')
+
+    def handle(self, *args, **options):
+        scheduler = Scheduler(
+            lamp_service,
+            batch_size=options['batch_size'],
+            queue_commands=getattr(settings, 'LIGHTS_ASYNC_SWITCH', False))
+        scheduler.load()
+        if options['once']:
+            fired = scheduler.run_pending()
+            self.stdout.write(f'Fired {fired} schedule(s)')
+            return
+
+        refresh_interval = options['refresh_interval']
+        try:
+            while True:
+                try:
+                    fired = scheduler.run_pending()
+                except Exception:
+                    logger.exception('Failed to fire schedules')
+                    # Due schedules could be lost from the queue
+                    scheduler.load()
+                else:
+                    if fired:
+                        logger.info('Fired %d schedule(s)', fired)
+                next_fire = scheduler.next_fire()
+                delay = refresh_interval
+                if next_fire is not None:
+                    delay = min(delay, (next_fire
+                                        - timezone.now()).total_seconds())
+                time.sleep(max(delay, 0))
+                scheduler.refresh()
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping scheduler...')
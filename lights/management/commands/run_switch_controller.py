@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from lights.network_switch import StandInController
+
+
+class Command(BaseCommand):
+
+    help = ('Run a stand-in network switch controller keeping lamp state '
+            'in memory, for local development with NetworkSwitch.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--host',
+            default='127.0.0.1',
+            help='Address to listen on.')
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=9090,
+            help='Port to listen on.')
+        parser.add_argument(
+            '--delay',
+            type=float,
+            default=0.0,
+            help='Seconds to wait before answering a request.')
+        parser.add_argument(
+            '--fail',
+            type=int,
+            action='append',
+            default=[],
+            metavar='LAMP_ID',
+            help='Fail commands for the lamp, can be repeated.')
+
+    def handle(self, *args, host, port, delay, fail, **options):
+        controller = StandInController((host, port), delay=delay)
+        controller.failing_lamp_ids.update(fail)
+        self.stdout.write('Listening on {}:{}'.format(
+            *controller.server_address))
+        try:
+            controller.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping controller...')
+        finally:
+            controller.server_close()
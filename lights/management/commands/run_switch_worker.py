@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from lights.services import lamp_service
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = ('Process queued switch commands. Runs a pool of worker threads '
+            'and reconciles desired and actual state of lamps periodically.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='Number of worker threads.')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Number of commands applied in one switch call.')
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=1.0,
+            help='Seconds to wait when the queue is empty.')
+        parser.add_argument(
+            '--reconcile-interval',
+            type=float,
+            default=60.0,
+            help='Seconds between reconciliation runs.')
+        parser.add_argument(
+            '--retry-failed',
+            action='store_true',
+            help='Return failed commands to the queue on start.')
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Reconcile, process the queue and exit when it is empty.')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.stop_event = threading.Event()
+
+        queued = lamp_service.reconcile(retry_failed=options['retry_failed'])
+        self.stdout.write(f'Queued commands for {queued} unconfirmed lamp(s)')
+
+        threads = [threading.Thread(target=self.work, name=f'worker-{i}')
+                   for i in range(options['workers'])]
+        for thread in threads:
+            thread.start()
+        try:
+            if not options['once']:
+                self.reconcile_periodically()
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping workers...')
+            self.stop_event.set()
+        finally:
+            # Workers stop by themselves in "once" mode
+            for thread in threads:
+                thread.join()
+
+    def work(self):
+        worker = uuid.uuid4().hex
+        processed_total = 0
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    processed = lamp_service.process_commands(
+                        worker,
+                        batch_size=self.options['batch_size'])
+                except Exception:
+                    logger.exception('Failed to process commands')
+                    processed = 0
+                processed_total += processed
+                if not processed:
+                    if self.options['once']:
+                        break
+                    self.stop_event.wait(self.options['interval'])
+        finally:
+            connection.close()
+        logger.info('Worker %s processed %d command(s)',
+                    worker, processed_total)
+
+    def reconcile_periodically(self):
+        interval = self.options['reconcile_interval']
+        next_run = time.monotonic() + interval
+        while True:
+            time.sleep(max(next_run - time.monotonic(), 0))
+            next_run += interval
+            try:
+                queued = lamp_service.reconcile()
+            except Exception:
+                logger.exception('Failed to reconcile lamp state')
+            else:
+                if queued:
+                    logger.info('Queued commands for %d lamp(s)', queued)
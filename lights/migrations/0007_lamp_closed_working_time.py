@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lights', '0006_lamp_related_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lamp',
+            name='closed_working_microseconds',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lights', '0007_lamp_closed_working_time'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='workingperiod',
+            index=models.Index(fields=['lamp', 'start'], name='period_lamp_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='workingperiod',
+            index=models.Index(condition=models.Q(end__isnull=True), fields=['lamp', 'start'], name='period_open_idx'),
+        ),
+    ]
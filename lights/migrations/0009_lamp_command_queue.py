@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lights', '0008_workingperiod_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lamp',
+            name='actual_brightness',
+            field=models.SmallIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='lamp',
+            name='actual_is_on',
+            field=models.BooleanField(editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='LampCommand',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('on', models.BooleanField(blank=True, null=True)),
+                ('brightness', models.SmallIntegerField(blank=True, null=True, verbose_name='brightness %')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('worker', models.CharField(blank=True, max_length=40)),
+                ('claimed', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('lamp', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='commands', related_query_name='command', to='lights.Lamp')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='lampcommand',
+            index=models.Index(fields=['status', 'id'], name='command_status_idx'),
+        ),
+    ]
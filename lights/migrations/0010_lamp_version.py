@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lights', '0009_lamp_command_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lamp',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
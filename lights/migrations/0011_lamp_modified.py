@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lights', '0010_lamp_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lamp',
+            name='modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
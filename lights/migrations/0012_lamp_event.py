@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lights', '0011_lamp_modified'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LampEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_on', models.BooleanField()),
+                ('brightness', models.SmallIntegerField(verbose_name='brightness %')),
+                ('actual_is_on', models.BooleanField(null=True)),
+                ('actual_brightness', models.SmallIntegerField(null=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('lamp', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', related_query_name='event', to='lights.Lamp')),
+            ],
+        ),
+    ]
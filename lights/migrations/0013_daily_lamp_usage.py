@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lights', '0012_lamp_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyLampUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('working_microseconds', models.BigIntegerField(default=0)),
+                ('weighted_microseconds', models.BigIntegerField(default=0)),
+                ('lamp', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_usage', to='lights.Lamp')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='dailylampusage',
+            index=models.Index(fields=['date', 'working_microseconds', 'weighted_microseconds'], name='usage_date_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailylampusage',
+            unique_together={('lamp', 'date')},
+        ),
+    ]
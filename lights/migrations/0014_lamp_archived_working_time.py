@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lights', '0013_daily_lamp_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lamp',
+            name='archived_until',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='lamp',
+            name='archived_working_microseconds',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+    ]
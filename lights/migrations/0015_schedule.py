@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:37
+
+import django.core.validators
+from django.db import migrations, models
+import lights.cron
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lights', '0014_lamp_archived_working_time'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Schedule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=80)),
+                ('cron', models.CharField(help_text='Cron-like expression: minute hour day month weekday, e.g. "30 7 * * 1-5"', max_length=100, validators=[lights.cron.validate_cron], verbose_name='schedule')),
+                ('on', models.BooleanField(blank=True, null=True)),
+                ('brightness', models.SmallIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(100)], verbose_name='brightness %')),
+                ('enabled', models.BooleanField(default=True)),
+                ('next_fire', models.DateTimeField(editable=False, null=True)),
+                ('last_fire', models.DateTimeField(editable=False, null=True)),
+                ('modified', models.DateTimeField(auto_now=True, db_index=True)),
+                ('lamps', models.ManyToManyField(blank=True, related_name='schedules', related_query_name='schedule', to='lights.Lamp')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['next_fire'], name='schedule_next_fire_idx'),
+        ),
+    ]
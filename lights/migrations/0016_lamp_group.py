@@ -0,0 +1,39 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lights', '0015_schedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LampGroup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=80)),
+                ('path', models.CharField(db_index=True, editable=False, max_length=255)),
+                ('lamp_count', models.PositiveIntegerField(default=0, editable=False)),
+                ('on_count', models.PositiveIntegerField(default=0, editable=False)),
+                ('on_brightness_sum', models.PositiveIntegerField(default=0, editable=False)),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='children', to='lights.LampGroup')),
+            ],
+            options={
+                'ordering': ['path'],
+            },
+        ),
+        migrations.AddField(
+            model_name='lamp',
+            name='group',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='lamps', related_query_name='lamp', to='lights.LampGroup'),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='groups',
+            field=models.ManyToManyField(blank=True, related_name='schedules', related_query_name='schedule', to='lights.LampGroup'),
+        ),
+    ]
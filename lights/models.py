@@ -1,14 +1,294 @@
-from datetime import timedelta
+from collections import defaultdict
+from datetime import datetime, time, timedelta
 
+from django.core.exceptions import ValidationError
 from django.core.validators import (
     MaxValueValidator,
     MinValueValidator,
 )
-from django.db import models
-from django.db.models import ExpressionWrapper, F, Sum
+from django.db import models, transaction
+from django.db.models import (
+    ExpressionWrapper,
+    F,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+)
+from django.db.models.functions import Concat, Substr
 from django.urls import reverse
 from django.utils import timezone
 
+from .cron import CronExpression, validate_cron
+
+
+class LampQuerySet(models.QuerySet):
+
+    def update(self, **kwargs):
+        """Update lamps, incrementing their versions."""
+        kwargs.setdefault('version', F('version') + 1)
+        kwargs.setdefault('modified', timezone.now())
+        return super().update(**kwargs)
+
+    def with_total_working_time(self):
+        """Annotate lamps with data required for total_working_time.
+
+        Closed periods are accounted by Lamp.closed_working_microseconds
+        and the last period is fetched with subqueries, so
+        total_working_time of the resulting lamps doesn't cause any
+        additional queries.
+        """
+        last_period = (WorkingPeriod.objects
+                       .filter(lamp=OuterRef('pk'))
+                       .order_by('-start'))
+        return self.annotate(
+            last_period_start=Subquery(last_period.values('start')[:1]),
+            last_period_end=Subquery(last_period.values('end')[:1]))
+
+    def with_closed_periods_duration(self):
+        """Annotate lamps with total duration of closed periods.
+
+        Unlike the counter, this value is calculated from the period
+        history, so it's expensive for lamps with long history.
+        """
+        closed_duration = (
+            WorkingPeriod.objects
+            .filter(lamp=OuterRef('pk'), end__isnull=False)
+            .order_by()
+            .values('lamp')
+            .annotate(total=Sum(ExpressionWrapper(
+                F('end') - F('start'),
+                output_field=models.DurationField())))
+            .values('total')
+        )
+        return self.annotate(closed_periods_duration=Subquery(
+            closed_duration,
+            output_field=models.DurationField()))
+
+    def rebuild_closed_working_time(self, *, dry_run=False):
+        """Recalculate closed working time counters from history.
+
+        Archived working time is added to the periods left.
+
+        :param bool dry_run: only detect drift, don't update lamps
+        :returns: list of lamps with a drifted counter. Their
+            closed_working_microseconds is set to the correct value.
+        """
+        drifted = []
+        for lamp in self.with_closed_periods_duration():
+            duration = lamp.closed_periods_duration or timedelta(0)
+            microseconds = (duration // timedelta(microseconds=1)
+                            + lamp.archived_working_microseconds)
+            if lamp.closed_working_microseconds != microseconds:
+                lamp.closed_working_microseconds = microseconds
+                drifted.append(lamp)
+        if drifted and not dry_run:
+            self.model.objects.bulk_update(drifted,
+                                           ['closed_working_microseconds'])
+        return drifted
+
+    def rebuild_daily_usage(self):
+        """Recalculate daily usage of lamps from closed periods.
+
+        Usage before archived_until of a lamp is kept, periods are
+        clipped to it.
+
+        :returns: number of DailyLampUsage rows created
+        """
+        archived_until = dict(self.values_list('pk', 'archived_until'))
+        lamp_ids_by_horizon = defaultdict(list)
+        for lamp_id, horizon in archived_until.items():
+            lamp_ids_by_horizon[horizon].append(lamp_id)
+        for horizon, lamp_ids in lamp_ids_by_horizon.items():
+            rows = DailyLampUsage.objects.filter(lamp__in=lamp_ids)
+            if horizon:
+                rows = rows.filter(date__gte=timezone.localdate(horizon))
+            rows.delete()
+
+        # Working and weighted microseconds by lamp id and date
+        usage = defaultdict(lambda: [0, 0])
+        periods = (WorkingPeriod.objects
+                   .filter(lamp__in=list(archived_until),
+                           end__isnull=False)
+                   .values_list('lamp', 'start', 'end', 'brightness')
+                   .iterator())
+        for lamp_id, start, end, brightness in periods:
+            horizon = archived_until[lamp_id]
+            if horizon:
+                if end <= horizon:
+                    continue
+                start = max(start, horizon)
+            for date, working_us, weighted_us in _daily_usage(start,
+                                                              end,
+                                                              brightness):
+                day_usage = usage[lamp_id, date]
+                day_usage[0] += working_us
+                day_usage[1] += weighted_us
+        rows = DailyLampUsage.objects.bulk_create(
+            DailyLampUsage(lamp_id=lamp_id,
+                           date=date,
+                           working_microseconds=working_us,
+                           weighted_microseconds=weighted_us)
+            for (lamp_id, date), (working_us, weighted_us) in usage.items())
+        return len(rows)
+
+
+class LampGroupQuerySet(models.QuerySet):
+
+    def add_lamp_counts(self, counts):
+        """Add lamp counter increments to groups and their ancestors.
+
+        :param dict counts: (lamp count, on count, brightness sum of
+            lamps that are on) increments by group id
+        """
+        paths = dict(LampGroup.objects
+                     .filter(pk__in=counts)
+                     .values_list('pk', 'path'))
+        increments = defaultdict(lambda: [0, 0, 0])
+        for group_id, group_counts in counts.items():
+            for ancestor_id in _path_ids(paths[group_id]):
+                ancestor_increments = increments[ancestor_id]
+                for index, count in enumerate(group_counts):
+                    ancestor_increments[index] += count
+        groups = []
+        for group_id, (lamp_count, on_count, brightness_sum) in (
+                increments.items()):
+            if lamp_count or on_count or brightness_sum:
+                groups.append(LampGroup(
+                    pk=group_id,
+                    lamp_count=F('lamp_count') + lamp_count,
+                    on_count=F('on_count') + on_count,
+                    on_brightness_sum=F('on_brightness_sum') + brightness_sum))
+        LampGroup.objects.bulk_update(
+            groups,
+            ['lamp_count', 'on_count', 'on_brightness_sum'])
+
+    def rebuild_counters(self):
+        """Recalculate lamp counters of groups from lamps.
+
+        :returns: list of groups with drifted counters. Their counters
+            are set to the correct values.
+        """
+        paths = dict(LampGroup.objects.values_list('pk', 'path'))
+        counters = defaultdict(lambda: [0, 0, 0])
+        lamp_counts = (Lamp.objects
+                       .filter(group__isnull=False)
+                       .order_by()
+                       .values_list('group')
+                       .annotate(lamp_count=models.Count('pk'),
+                                 on_count=models.Count('pk',
+                                                       filter=Q(is_on=True)),
+                                 brightness_sum=Sum('brightness',
+                                                    filter=Q(is_on=True))))
+        for group_id, lamp_count, on_count, brightness_sum in lamp_counts:
+            for ancestor_id in _path_ids(paths[group_id]):
+                group_counters = counters[ancestor_id]
+                group_counters[0] += lamp_count
+                group_counters[1] += on_count
+                group_counters[2] += brightness_sum or 0
+
+        drifted = []
+        for group in self:
+            group_counters = counters[group.pk]
+            if [group.lamp_count,
+                    group.on_count,
+                    group.on_brightness_sum] != group_counters:
+                (group.lamp_count,
+                 group.on_count,
+                 group.on_brightness_sum) = group_counters
+                drifted.append(group)
+        LampGroup.objects.bulk_update(
+            drifted,
+            ['lamp_count', 'on_count', 'on_brightness_sum'])
+        return drifted
+
+
+class LampGroup(models.Model):
+    """Group of lamps, e.g. a building, a floor or a room.
+
+    Groups form a tree. path is a materialized path of group ids from
+    the root (like "/1/4/"), so a subtree is selected by path prefix
+    without recursive queries.
+
+    Counters include lamps of the whole subtree. They are maintained
+    by the service layer (see update_group_counters()), so group
+    state doesn't require scanning lamps.
+    """
+
+    name = models.CharField(max_length=80)
+    parent = models.ForeignKey('self',
+                               on_delete=models.PROTECT,
+                               null=True,
+                               blank=True,
+                               related_name='children')
+    path = models.CharField(max_length=255, editable=False, db_index=True)
+    lamp_count = models.PositiveIntegerField(default=0, editable=False)
+    on_count = models.PositiveIntegerField(default=0, editable=False)
+    # Brightness % summed over lamps that are on
+    on_brightness_sum = models.PositiveIntegerField(default=0,
+                                                    editable=False)
+
+    objects = LampGroupQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['path']
+
+    def __str__(self):
+        return self.name
+
+    def clean(self):
+        if (self.pk and self.parent
+                and self.pk in _path_ids(self.parent.path)):
+            raise ValidationError({'parent': 'Group cannot be moved to '
+                                             'its own subtree'})
+
+    def save(self, *args, **kwargs):
+        """Save group, updating paths and counters of moved subtree."""
+        parent_path = self.parent.path if self.parent else '/'
+        with transaction.atomic():
+            if self._state.adding:
+                super().save(*args, **kwargs)
+                self.path = f'{parent_path}{self.pk}/'
+                LampGroup.objects.filter(pk=self.pk).update(path=self.path)
+                return
+
+            previous = (LampGroup.objects
+                        .select_for_update()
+                        .get(pk=self.pk))
+            self.path = f'{parent_path}{self.pk}/'
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = [*update_fields, 'path']
+            super().save(*args, **kwargs)
+            if self.path == previous.path:
+                return
+
+            (LampGroup.objects
+             .filter(path__startswith=previous.path)
+             .exclude(pk=self.pk)
+             .update(path=Concat(Value(self.path),
+                                 Substr('path', len(previous.path) + 1))))
+            counts = (previous.lamp_count,
+                      previous.on_count,
+                      previous.on_brightness_sum)
+            if previous.parent_id:
+                LampGroup.objects.add_lamp_counts(
+                    {previous.parent_id: [-count for count in counts]})
+            if self.parent_id:
+                LampGroup.objects.add_lamp_counts({self.parent_id: counts})
+
+    @property
+    def average_brightness(self):
+        """Average brightness % of lamps that are on."""
+        if not self.on_count:
+            return None
+        return self.on_brightness_sum / self.on_count
+
+    def subtree_lamps(self):
+        """Return lamps of the group and its descendants."""
+        return Lamp.objects.filter(group__path__startswith=self.path)
+
 
 class Lamp(models.Model):
 
@@ -23,26 +303,67 @@ class Lamp(models.Model):
         default=100,
         validators=[MinValueValidator(1),
                     MaxValueValidator(100)])
+    group = models.ForeignKey(LampGroup,
+                              on_delete=models.PROTECT,
+                              null=True,
+                              blank=True,
+                              related_name='lamps',
+                              related_query_name='lamp')
+    # Total duration of closed working periods. It's maintained by the
+    # service layer to avoid summing up the whole period history.
+    # Microseconds are stored instead of a DurationField to allow
+    # atomic increments on every backend (SQLite can't add durations).
+    closed_working_microseconds = models.BigIntegerField(default=0,
+                                                         editable=False)
+    # Working time of deleted (archived) periods, included into the
+    # counter above. Periods ended before archived_until are archived.
+    archived_working_microseconds = models.BigIntegerField(default=0,
+                                                           editable=False)
+    archived_until = models.DateTimeField(null=True, editable=False)
+    # Actual state of the lamp, confirmed by the switch. is_on and
+    # brightness are the desired state, they may differ from actual
+    # while switch commands are queued (see LampCommand). Null means
+    # unknown.
+    actual_is_on = models.BooleanField(null=True, editable=False)
+    actual_brightness = models.SmallIntegerField(null=True, editable=False)
+    # Incremented on every change of the lamp. Used to build cache keys.
+    version = models.PositiveIntegerField(default=1, editable=False)
+    modified = models.DateTimeField(auto_now=True)
+
+    objects = LampQuerySet.as_manager()
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        """Save lamp, incrementing its version."""
+        if self._state.adding:
+            super().save(*args, **kwargs)
+            return
+        self.version = F('version') + 1
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = [*update_fields, 'version', 'modified']
+        super().save(*args, **kwargs)
+        # Value is loaded from db on next access (like a deferred
+        # field), there is no need in extra query otherwise.
+        del self.version
+
+    @property
+    def closed_working_time(self):
+        return timedelta(microseconds=self.closed_working_microseconds)
+
     @property
     def total_working_time(self):
-        # Calculate total duration of closed periods for this lamp
-        result = (
-            self.periods
-            .filter(end__isnull=False)
-            .annotate(period_length=ExpressionWrapper(
-                F('end') - F('start'),
-                output_field=models.DurationField()))
-            .aggregate(total=Sum('period_length'))
-        )
-        total = result['total'] or timedelta(0)
+        total = self.closed_working_time
 
         # Add duration of active period.
-        # TODO: rewrite as a query
-        # TODO: rewrite as a single query?
+        if hasattr(self, 'last_period_start'):
+            # Annotated by LampQuerySet.with_total_working_time()
+            if self.last_period_start and not self.last_period_end:
+                total += timezone.now() - self.last_period_start
+            return total
+
         try:
             last_period = self.periods.latest('start')
         except WorkingPeriod.DoesNotExist:
@@ -52,6 +373,12 @@ class Lamp(models.Model):
                 total += last_period.duration
         return total
 
+    @property
+    def is_confirmed(self):
+        """Check if actual state is known to match the desired one."""
+        return (self.actual_is_on == self.is_on
+                and self.actual_brightness == self.brightness)
+
     def get_absolute_url(self):
         return reverse('lights:lamp-site-detail', kwargs={'pk': self.pk})
 
@@ -68,7 +395,8 @@ class WorkingPeriod(models.Model):
     - Open period - end is null
     - Last period - period with maximum start (open or closed)
     - Active period - last period if it's open, else none
-    - Abandoned period - open period but not last (so not active)
+    - Abandoned period - open period but not last (so not active),
+      see close_abandoned_periods management command
     """
 
     lamp = models.ForeignKey(Lamp,
@@ -82,6 +410,18 @@ class WorkingPeriod(models.Model):
     start = models.DateTimeField()
     end = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # Last period lookups
+            models.Index(fields=['lamp', 'start'],
+                         name='period_lamp_start_idx'),
+            # Open periods are few, partial index is ignored by
+            # backends not supporting it
+            models.Index(fields=['lamp', 'start'],
+                         name='period_open_idx',
+                         condition=Q(end__isnull=True)),
+        ]
+
     def __str__(self):
         return f'{self.lamp.name} ({self.start:%Y:%m:%d %H:%M:%S})'
 
@@ -90,4 +430,205 @@ class WorkingPeriod(models.Model):
         end = self.end or timezone.now()
         return end - self.start
 
+    def daily_usage(self):
+        """Split the period by days of the current time zone.
+
+        :returns: list of tuples (date, working microseconds,
+            brightness-weighted working microseconds)
+        """
+        return _daily_usage(self.start,
+                            self.end or timezone.now(),
+                            self.brightness)
+
     # TODO: add is_open() ?
+
+
+class LampCommand(models.Model):
+    """Queued switch command for a lamp.
+
+    Commands are created when a mode change is requested
+    asynchronously and processed by the switch worker (see
+    run_switch_worker management command). The worker applies the
+    desired state of the lamp at the time of processing, so several
+    queued commands for a lamp are applied as one. on and brightness
+    of the command are kept for information only.
+
+    Successfully applied commands are deleted. Commands failed too many
+    times are kept with "failed" status.
+    """
+
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'),
+                      (PROCESSING, 'Processing'),
+                      (FAILED, 'Failed')]
+
+    lamp = models.ForeignKey(Lamp,
+                             on_delete=models.CASCADE,
+                             related_name='commands',
+                             related_query_name='command')
+    on = models.BooleanField(null=True, blank=True)
+    brightness = models.SmallIntegerField('brightness %',
+                                          null=True,
+                                          blank=True)
+    status = models.CharField(max_length=10,
+                              choices=STATUS_CHOICES,
+                              default=PENDING)
+    created = models.DateTimeField(default=timezone.now)
+    # Worker processing the command and the time it was claimed
+    worker = models.CharField(max_length=40, blank=True)
+    claimed = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'], name='command_status_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.lamp.name} ({self.status})'
+
+
+class LampEvent(models.Model):
+    """State change of a lamp, streamed to clients.
+
+    An event is a snapshot of lamp state saved with the change.
+    Ascending id of the event is used by clients to resume the
+    stream. Old events are deleted by prune_events management command.
+    """
+
+    lamp = models.ForeignKey(Lamp,
+                             on_delete=models.CASCADE,
+                             related_name='events',
+                             related_query_name='event')
+    is_on = models.BooleanField()
+    brightness = models.SmallIntegerField('brightness %')
+    actual_is_on = models.BooleanField(null=True)
+    actual_brightness = models.SmallIntegerField(null=True)
+    created = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f'{self.lamp.name} ({self.created:%Y:%m:%d %H:%M:%S})'
+
+
+class DailyLampUsage(models.Model):
+    """Working time of a lamp per day, rolled up from closed periods.
+
+    Days are dates in TIME_ZONE. Rows are updated by the service layer
+    when periods are closed, active periods are not included. Use
+    rebuild_daily_usage management command to fill in the history.
+    """
+
+    lamp = models.ForeignKey(Lamp,
+                             on_delete=models.CASCADE,
+                             related_name='daily_usage')
+    date = models.DateField()
+    working_microseconds = models.BigIntegerField(default=0)
+    # Working time multiplied by brightness (fraction of 100%)
+    weighted_microseconds = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('lamp', 'date')]
+        indexes = [
+            # Fleet reports, covering to avoid a table lookup per row
+            models.Index(fields=['date',
+                                 'working_microseconds',
+                                 'weighted_microseconds'],
+                         name='usage_date_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.lamp.name} ({self.date})'
+
+
+class Schedule(models.Model):
+    """Lamp mode change repeated on a cron-like schedule.
+
+    Schedules are fired by the scheduler process (see run_scheduler
+    management command). next_fire is maintained by save() and by the
+    scheduler, so due schedules are found without evaluating every
+    expression.
+    """
+
+    name = models.CharField(max_length=80)
+    cron = models.CharField(
+        'schedule',
+        max_length=100,
+        validators=[validate_cron],
+        help_text=('Cron-like expression: minute hour day month weekday, '
+                   'e.g. "30 7 * * 1-5"'))
+    lamps = models.ManyToManyField(Lamp,
+                                   related_name='schedules',
+                                   related_query_name='schedule',
+                                   blank=True)
+    # Lamps of the group subtrees are included
+    groups = models.ManyToManyField(LampGroup,
+                                    related_name='schedules',
+                                    related_query_name='schedule',
+                                    blank=True)
+    # Mode to set, None means "don't change"
+    on = models.BooleanField(null=True, blank=True)
+    brightness = models.SmallIntegerField(
+        'brightness %',
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(1),
+                    MaxValueValidator(100)])
+    enabled = models.BooleanField(default=True)
+    next_fire = models.DateTimeField(null=True, editable=False)
+    last_fire = models.DateTimeField(null=True, editable=False)
+    # Used by the scheduler to pick up changed schedules
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_fire'], name='schedule_next_fire_idx'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+    def clean(self):
+        if self.on is None and self.brightness is None:
+            raise ValidationError('Schedule should change power or '
+                                  'brightness')
+
+    def save(self, *args, **kwargs):
+        """Save schedule, calculating next fire time."""
+        self.next_fire = (CronExpression(self.cron).next_after(timezone.now())
+                          if self.enabled
+                          else None)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = [*update_fields, 'next_fire', 'modified']
+        super().save(*args, **kwargs)
+
+
+def _path_ids(path):
+    """Split materialized path of a group into ids from the root."""
+    return [int(pk) for pk in path.strip('/').split('/')]
+
+
+def _daily_usage(start, end, brightness):
+    """Split working time by days, see WorkingPeriod.daily_usage()."""
+    start = timezone.localtime(start)
+    end = timezone.localtime(end)
+    usage = []
+    while start.date() != end.date():
+        # Midnight may not exist or be ambiguous on DST changes
+        next_day = timezone.make_aware(
+            datetime.combine(start.date() + timedelta(days=1), time()),
+            is_dst=False)
+        microseconds = (next_day - start) // timedelta(microseconds=1)
+        usage.append((start.date(),
+                      microseconds,
+                      microseconds * brightness // 100))
+        start = next_day
+    microseconds = (end - start) // timedelta(microseconds=1)
+    if microseconds or not usage:
+        usage.append((start.date(),
+                      microseconds,
+                      microseconds * brightness // 100))
+    return usage
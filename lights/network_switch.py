@@ -0,0 +1,452 @@
+"""Networked light switch.
+
+Lamps are controlled by network controllers, each one driving a range
+of lamps. Commands are sent to controllers over TCP as JSON lines:
+
+    request:  {"commands": [{"lamp_id": 1, "on": true, "brightness": 50}]}
+    response: {"errors": {"1": "lamp not responding"}}
+
+A response may have "error" instead of "errors" if the whole request
+failed. Connections are kept open and reused.
+
+Every controller has a circuit breaker: after a number of failed
+requests in a row the controller is considered down and requests fail
+immediately instead of waiting for timeouts. Commands are idempotent,
+so failed ones are retried a few times with jittered backoff.
+
+StandInController implements the controller side, it's meant for
+tests and local development (see run_switch_controller command).
+"""
+
+import json
+import logging
+import random
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .switch import Switch, SwitchBatchError, SwitchCommand, SwitchError
+
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(SwitchError):
+    """Request rejected, the controller is considered down."""
+
+
+class CircuitBreaker:
+    """Circuit breaker of a controller.
+
+    The breaker is closed normally. failure_threshold failures in a row
+    open it, requests are rejected then. After reset_timeout seconds
+    the breaker is half-open: a single probe request is let through,
+    its success closes the breaker, failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, *, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures_in_row = 0
+        self._opened_at = None
+        self._probing = False
+        # Statistics
+        self.failure_count = 0
+        self.rejected_count = 0
+        self.open_count = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if (self._state == self.OPEN
+                    and time.monotonic() - self._opened_at
+                    >= self.reset_timeout):
+                return self.HALF_OPEN
+            return self._state
+
+    def before_request(self):
+        """Check if a request is allowed.
+
+        :raises CircuitOpenError: if the breaker is open
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            if (self._state == self.OPEN
+                    and time.monotonic() - self._opened_at
+                    >= self.reset_timeout):
+                self._state = self.HALF_OPEN
+                logger.info('Circuit of %s is half-open', self.name)
+            if self._state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.rejected_count += 1
+        raise CircuitOpenError(f'{self.name} is down')
+
+    def record_success(self):
+        with self._lock:
+            self._failures_in_row = 0
+            self._probing = False
+            if self._state != self.CLOSED:
+                self._state = self.CLOSED
+                logger.info('Circuit of %s is closed', self.name)
+
+    def record_failure(self):
+        with self._lock:
+            self.failure_count += 1
+            self._failures_in_row += 1
+            self._probing = False
+            if (self._state == self.HALF_OPEN
+                    or self._failures_in_row >= self.failure_threshold):
+                if self._state != self.OPEN:
+                    self.open_count += 1
+                    logger.warning('Circuit of %s is open', self.name)
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class ConnectionPool:
+    """Pool of connections to a controller.
+
+    At most max_connections requests are sent to the controller at
+    once, requests wait for a free connection up to timeout seconds.
+    Requests go through the circuit breaker of the controller.
+    """
+
+    def __init__(self, address, *, max_connections=4, timeout=5.0,
+                 failure_threshold=5, reset_timeout=30.0):
+        """Create pool.
+
+        :param tuple address: (host, port) of the controller
+        :param int max_connections: concurrency limit of the controller
+        :param float timeout: timeout of connecting, waiting for a
+            connection and reading a response, in seconds
+        :param int failure_threshold: number of failed requests in a
+            row opening the circuit breaker
+        :param float reset_timeout: seconds before an open breaker
+            lets a probe request through
+        """
+        self.address = tuple(address)
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(self._name,
+                                      failure_threshold=failure_threshold,
+                                      reset_timeout=reset_timeout)
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def request(self, data, *, wait_timeout=None):
+        """Send a JSON request and return decoded response.
+
+        :param float wait_timeout: timeout of waiting for a connection
+            if it differs from timeout, e.g. when part of it is spent
+            already
+        :raises CircuitOpenError: if the controller is considered down
+        :raises SwitchError: if the controller is not available or the
+            response is invalid
+        """
+        if wait_timeout is None:
+            wait_timeout = self.timeout
+        self.breaker.before_request()
+        if not self._slots.acquire(timeout=max(wait_timeout, 0)):
+            # All the connections are busy for too long, the controller
+            # is likely overloaded
+            self.breaker.record_failure()
+            raise SwitchError(f'no free connection to {self._name}')
+        try:
+            result = self._request(data)
+        except SwitchError:
+            self.breaker.record_failure()
+            raise
+        finally:
+            self._slots.release()
+        self.breaker.record_success()
+        return result
+
+    def close(self):
+        """Close idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    @property
+    def _name(self):
+        return '{}:{}'.format(*self.address)
+
+    def _request(self, data):
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is not None:
+            try:
+                return self._exchange(connection, data)
+            except _ConnectionClosed:
+                # Idle connection could be closed by the controller,
+                # commands are idempotent, so they are resent
+                pass
+        return self._exchange(self._connect(), data)
+
+    def _connect(self):
+        try:
+            return socket.create_connection(self.address,
+                                            timeout=self.timeout)
+        except OSError as e:
+            raise SwitchError(f'failed to connect to {self._name}: {e}')
+
+    def _exchange(self, connection, data):
+        """Send request over connection, return it to the pool after."""
+        try:
+            connection.sendall(json.dumps(data).encode() + b'\n')
+            response = connection.makefile('rb').readline()
+            if not response:
+                raise _ConnectionClosed(f'{self._name} closed connection')
+            result = json.loads(response)
+        except ConnectionError as e:
+            connection.close()
+            raise _ConnectionClosed(f'{self._name} closed connection: {e}')
+        except (OSError, ValueError) as e:
+            connection.close()
+            raise SwitchError(f'request to {self._name} failed: {e}')
+        except SwitchError:
+            connection.close()
+            raise
+        with self._lock:
+            self._idle.append(connection)
+        return result
+
+
+class _ConnectionClosed(SwitchError):
+    """Connection was closed by the controller."""
+
+
+class NetworkSwitch(Switch):
+    """Switch sending commands to network controllers.
+
+    Commands of a batch are split by controller and sent to the
+    controllers concurrently. Each controller has its own connection
+    pool and its own worker threads (as many as connections), so a
+    slow controller holds up only its own lamps. Commands for one of
+    the controllers are sent from the calling thread, so a call to a
+    single controller doesn't wait for worker threads at all.
+    """
+
+    def __init__(self, controllers, *, retries=2, retry_backoff=0.1,
+                 **pool_options):
+        """Create switch.
+
+        :param controllers: list of dicts with controller "address"
+            ((host, port) tuple or "host:port" string) and optional
+            "lamp_ids" ((first, last) range of lamp ids driven by the
+            controller; the controller without it drives the rest).
+            ConnectionPool options can be given to override the
+            defaults.
+        :param int retries: number of retries of failed commands
+        :param float retry_backoff: base delay before a retry, in
+            seconds. It's doubled for every retry, actual delay is
+            random up to it.
+        :param pool_options: default ConnectionPool options
+            (max_connections, timeout, failure_threshold,
+            reset_timeout)
+        """
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._routes = []
+        self._default_pool = None
+        for controller in controllers:
+            controller = dict(controller)
+            address = controller.pop('address')
+            if isinstance(address, str):
+                host, port = address.rsplit(':', 1)
+                address = host, int(port)
+            lamp_ids = controller.pop('lamp_ids', None)
+            pool = ConnectionPool(address, **{**pool_options, **controller})
+            if lamp_ids:
+                first, last = lamp_ids
+                self._routes.append((first, last, pool))
+            else:
+                self._default_pool = pool
+        self._pools = [pool for first, last, pool in self._routes]
+        if self._default_pool:
+            self._pools.append(self._default_pool)
+        self._executors = {
+            pool: ThreadPoolExecutor(max_workers=pool.max_connections,
+                                     thread_name_prefix='switch')
+            for pool in self._pools}
+
+    def execute(self, commands):
+        batches = {}
+        errors = {}
+        for command in commands:
+            pool = self._route(command.lamp_id)
+            if pool is None:
+                errors[command.lamp_id] = 'no controller'
+            else:
+                batches.setdefault(pool, []).append(command)
+
+        batches = list(batches.items())
+        submitted = time.monotonic()
+        futures = [self._executors[pool].submit(self._send, pool, batch,
+                                                submitted=submitted)
+                   for pool, batch in batches[1:]]
+        if batches:
+            errors.update(self._send(*batches[0]))
+        for future in futures:
+            errors.update(future.result())
+
+        if not errors:
+            return
+        if all(command.lamp_id in errors for command in commands):
+            raise SwitchError(f'all {len(errors)} command(s) failed: '
+                              f'{next(iter(errors.values()))}')
+        raise SwitchBatchError(errors)
+
+    def turn_on(self, lamp_id):
+        self.execute([SwitchCommand(lamp_id, on=True)])
+
+    def turn_off(self, lamp_id):
+        self.execute([SwitchCommand(lamp_id, on=False)])
+
+    def set_brightness(self, *, lamp_id, brightness):
+        self.execute([SwitchCommand(lamp_id, brightness=brightness)])
+
+    def close(self):
+        """Close connections and stop worker threads."""
+        for executor in self._executors.values():
+            executor.shutdown()
+        for pool in self._pools:
+            pool.close()
+
+    def _route(self, lamp_id):
+        for first, last, pool in self._routes:
+            if first <= lamp_id <= last:
+                return pool
+        return self._default_pool
+
+    def status(self):
+        breakers = [pool.breaker for pool in self._pools]
+        return [{'controller': breaker.name,
+                 'state': breaker.state,
+                 'failures': breaker.failure_count,
+                 'rejected': breaker.rejected_count,
+                 'opened': breaker.open_count}
+                for breaker in breakers]
+
+    def _send(self, pool, commands, *, submitted=None):
+        """Send commands to a controller, retrying failed ones.
+
+        Requests rejected by the circuit breaker are not retried.
+
+        :param float submitted: time.monotonic() when the commands were
+            queued for a worker thread. Time spent in the queue counts
+            towards the timeout of waiting for a connection.
+        :returns: dict of error messages by lamp id
+        """
+        errors = {}
+        for retry in range(self.retries + 1):
+            if retry:
+                logger.warning('Retrying %d command(s) for %s',
+                               len(commands), pool.breaker.name)
+                time.sleep(random.uniform(
+                    0, self.retry_backoff * 2 ** (retry - 1)))
+            wait_timeout = None
+            if submitted is not None and not retry:
+                wait_timeout = pool.timeout - (time.monotonic() - submitted)
+            try:
+                errors = self._send_once(pool, commands, wait_timeout)
+            except CircuitOpenError as e:
+                return {command.lamp_id: str(e) for command in commands}
+            except SwitchError as e:
+                errors = {command.lamp_id: str(e) for command in commands}
+            if not errors:
+                break
+            commands = [command for command in commands
+                        if command.lamp_id in errors]
+        return errors
+
+    def _send_once(self, pool, commands, wait_timeout=None):
+        response = pool.request({'commands': [command._asdict()
+                                              for command in commands]},
+                                wait_timeout=wait_timeout)
+        if 'error' in response:
+            raise SwitchError(f'controller error: {response["error"]}')
+        return {int(lamp_id): message
+                for lamp_id, message in response.get('errors', {}).items()}
+
+
+class StandInController(socketserver.ThreadingTCPServer):
+    """Local stand-in for a network controller.
+
+    Keeps lamp state in memory. Commands for lamps in failing_lamp_ids
+    fail, all the requests are delayed by delay seconds.
+
+    :ivar dict lamps: state of lamps, dicts with "on" and "brightness"
+        by lamp id
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), *, delay=0.0):
+        super().__init__(address, _ControllerHandler)
+        self.delay = delay
+        self.failing_lamp_ids = set()
+        self.lamps = {}
+        self.request_count = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Serve in a background thread.
+
+        :returns: (host, port) address
+        """
+        thread = threading.Thread(target=self.serve_forever,
+                                  kwargs={'poll_interval': 0.05},
+                                  daemon=True)
+        thread.start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def apply(self, commands):
+        """Apply commands, return error messages by lamp id."""
+        if self.delay:
+            time.sleep(self.delay)
+        errors = {}
+        with self._lock:
+            self.request_count += 1
+            for command in commands:
+                lamp_id = command['lamp_id']
+                if lamp_id in self.failing_lamp_ids:
+                    errors[str(lamp_id)] = 'lamp not responding'
+                    continue
+                lamp = self.lamps.setdefault(lamp_id, {'on': False,
+                                                       'brightness': 100})
+                if command.get('brightness') is not None:
+                    lamp['brightness'] = command['brightness']
+                if command.get('on') is not None:
+                    lamp['on'] = command['on']
+        return errors
+
+
+class _ControllerHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                commands = json.loads(line)['commands']
+                response = {'errors': self.server.apply(commands)}
+            except (ValueError, KeyError, TypeError) as e:
+                response = {'error': f'invalid request: {e}'}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
@@ -0,0 +1,17 @@
+from rest_framework import pagination
+
+
+class LampPageNumberPagination(pagination.PageNumberPagination):
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class LampCursorPagination(pagination.CursorPagination):
+    """Keyset pagination by lamp id.
+
+    Every page is fetched by an indexed range query, no matter how far
+    it is from the start, and no total count is calculated.
+    """
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
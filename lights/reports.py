@@ -0,0 +1,222 @@
+"""Working time reports.
+
+Reports are calculated in SQL over working periods. Period bounds are
+converted to seconds from the window start and clipped to the window.
+Periods are grouped by their first and last buckets (and brightness),
+sums of the bounds are enough to split working time between buckets,
+so the periods are scanned only once.
+
+Daily reports aligned to days of TIME_ZONE read closed periods of
+whole days from DailyLampUsage rollup instead, so only active periods
+and periods of the partial last day (if any) are scanned.
+"""
+
+from collections import namedtuple
+from datetime import time, timedelta
+
+from django.db.models import (
+    Case,
+    Count,
+    ExpressionWrapper,
+    FloatField,
+    Func,
+    IntegerField,
+    Q,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.utils import timezone
+
+from .models import DailyLampUsage, WorkingPeriod
+
+
+BUCKET_SIZES = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+}
+
+ReportBucket = namedtuple('ReportBucket',
+                          ['start', 'working_time', 'weighted_working_time'])
+ReportBucket.__doc__ = """Working time of a report bucket.
+
+weighted_working_time is working time multiplied by brightness
+(fraction of 100%), i.e. proportional to consumed energy.
+"""
+
+
+class EpochSeconds(Func):
+    """Number of seconds since the Unix epoch for a datetime."""
+
+    template = 'EXTRACT(EPOCH FROM %(expressions)s)'
+    output_field = FloatField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # julianday() is native, unlike Django's date functions
+        # implemented in Python. SQLite keeps milliseconds, rounding
+        # to them drops floating point error of the day fraction
+        # (CAST is much faster than ROUND).
+        return self.as_sql(
+            compiler, connection,
+            template=('(CAST((julianday(%(expressions)s) - 2440587.5)'
+                      ' * 86400000.0 + 0.5 AS INTEGER) / 1000.0)'),
+            **extra_context)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection,
+                           template='UNIX_TIMESTAMP(%(expressions)s)',
+                           **extra_context)
+
+
+class FloorNonNegative(Func):
+    """FLOOR() of a non-negative number."""
+
+    function = 'FLOOR'
+    output_field = IntegerField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # Truncation is floor for non-negative numbers, and it's native
+        return self.as_sql(compiler, connection,
+                           template='CAST(%(expressions)s AS INTEGER)',
+                           **extra_context)
+
+
+def working_time_report(start, end, *, bucket='day', lamp_ids=None):
+    """Calculate working time of lamps in a time window.
+
+    Working periods are clipped to the window, the active ones last
+    till now. The window is divided into buckets counted from its
+    start, so a start at local midnight gives local days (DST changes
+    are not taken into account). If all the day buckets start at
+    midnight of TIME_ZONE, DailyLampUsage is used for closed periods
+    of the buckets lying within the window and before now.
+
+    :param datetime start: window start (aware)
+    :param datetime end: window end (aware), exclusive
+    :param str bucket: bucket size, key of BUCKET_SIZES
+    :param lamp_ids: report on these lamps only, all lamps by default
+    :returns: list of ReportBucket for every bucket of the window.
+        Durations are rounded to milliseconds (precision of SQLite
+        date functions).
+    """
+    bucket_size = BUCKET_SIZES[bucket]
+    bucket_seconds = bucket_size.total_seconds()
+    window_start = start.timestamp()
+    window_end = min(end, timezone.now()).timestamp()
+    bucket_count = int(-(-(end.timestamp() - window_start)
+                         // bucket_seconds))
+
+    working_seconds = [0.0] * bucket_count
+    # Multiplied by brightness in %
+    weighted_seconds = [0.0] * bucket_count
+
+    periods = WorkingPeriod.objects.filter(Q(end__isnull=True)
+                                           | Q(end__gt=start),
+                                           start__lt=min(end, timezone.now()))
+    if lamp_ids is not None:
+        periods = periods.filter(lamp__in=lamp_ids)
+
+    bucket_dates = (_local_dates(start, bucket_count)
+                    if bucket == 'day'
+                    else None)
+    if bucket_dates:
+        # Buckets ending after the window end or now are partial
+        full_count = min(int((window_end - window_start) // bucket_seconds),
+                         bucket_count)
+        bucket_dates = bucket_dates[:full_count]
+    # Closed periods are counted from this offset (seconds from the
+    # window start), the rollup covers the buckets before it
+    closed_start = 0.0
+    if bucket_dates:
+        daily_usage = (DailyLampUsage.objects
+                       .filter(date__gte=bucket_dates[0],
+                               date__lte=bucket_dates[-1]))
+        if lamp_ids is not None:
+            daily_usage = daily_usage.filter(lamp__in=lamp_ids)
+        daily_usage = (daily_usage
+                       .order_by()
+                       .values('date')
+                       .annotate(working=Sum('working_microseconds'),
+                                 weighted=Sum('weighted_microseconds')))
+        date_indexes = {date: index for index, date in enumerate(bucket_dates)}
+        for row in daily_usage:
+            index = date_indexes[row['date']]
+            working_seconds[index] += row['working'] / 10 ** 6
+            weighted_seconds[index] += row['weighted'] / 10 ** 4
+        closed_start = len(bucket_dates) * bucket_seconds
+        periods = periods.filter(
+            Q(end__isnull=True)
+            | Q(end__gt=start + len(bucket_dates) * bucket_size))
+
+    def seconds(value):
+        return Value(value, output_field=FloatField())
+
+    def bucket_index(expression):
+        return FloorNonNegative(
+            ExpressionWrapper(expression / seconds(bucket_seconds),
+                              output_field=FloatField()))
+
+    # Seconds from the window start. Closed periods are clipped to
+    # the rollup end, the time before it is counted already.
+    min_start = seconds(0)
+    if closed_start:
+        min_start = Case(When(end__isnull=True, then=min_start),
+                         default=seconds(closed_start))
+    period_start = Greatest(EpochSeconds('start') - seconds(window_start),
+                            min_start)
+    period_end = Least(Coalesce(EpochSeconds('end'), seconds(window_end))
+                       - seconds(window_start),
+                       seconds(window_end - window_start))
+    groups = (
+        periods
+        .annotate(first_bucket=bucket_index(period_start),
+                  last_bucket=bucket_index(period_end))
+        .order_by()
+        .values('first_bucket', 'last_bucket', 'brightness')
+        .annotate(count=Count('pk'),
+                  start_sum=Sum(period_start),
+                  end_sum=Sum(period_end))
+    )
+
+    def add(index, duration, brightness):
+        # Periods ending at the window end have last bucket out of
+        # the window
+        if index < bucket_count:
+            working_seconds[index] += duration
+            weighted_seconds[index] += duration * brightness
+
+    for group in groups:
+        first, last = group['first_bucket'], group['last_bucket']
+        count, brightness = group['count'], group['brightness']
+        # Sums of offsets from the first and the last bucket starts
+        start_offset = group['start_sum'] - count * first * bucket_seconds
+        end_offset = group['end_sum'] - count * last * bucket_seconds
+        if first == last:
+            add(first, end_offset - start_offset, brightness)
+            continue
+        add(first, count * bucket_seconds - start_offset, brightness)
+        for index in range(first + 1, last):
+            add(index, count * bucket_seconds, brightness)
+        add(last, end_offset, brightness)
+
+    return [ReportBucket(start + index * bucket_size,
+                         timedelta(seconds=round(working_seconds[index], 3)),
+                         timedelta(seconds=round(weighted_seconds[index] / 100,
+                                                 3)))
+            for index in range(bucket_count)]
+
+
+def _local_dates(start, count):
+    """Return dates of days starting at start, if aligned to midnight.
+
+    :returns: list of dates in the current time zone or None if any
+        of the days doesn't start at midnight
+    """
+    dates = []
+    for index in range(count):
+        day_start = timezone.localtime(start + index * timedelta(days=1))
+        if day_start.time() != time():
+            return None
+        dates.append(day_start.date())
+    return dates
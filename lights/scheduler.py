@@ -0,0 +1,176 @@
+"""Scheduler of lamp mode changes.
+
+Next fire times of enabled schedules are kept in a heap, so the
+scheduler sleeps until the earliest one is due and only due schedules
+are read from the database. Changed schedules are picked up by their
+modified timestamp.
+"""
+
+import heapq
+import logging
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .cron import CronExpression
+from .models import Lamp, Schedule
+from .services import ExternalError, LampModeChange
+
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """Fires due schedules through the lamp service.
+
+    Schedules missed while the scheduler wasn't running are fired once
+    when it starts. Mode changes of all the schedules due at once are
+    merged per lamp (the schedule with a greater id wins) and applied in
+    batches, lamps already in the scheduled mode are skipped.
+    """
+
+    # Schedules modified this long before the last refresh are read
+    # again, in case they were committed after it
+    refresh_margin = timedelta(minutes=1)
+
+    def __init__(self, service, *, batch_size=1000, queue_commands=False):
+        """Create scheduler.
+
+        :param LampService service: service to apply mode changes
+        :param int batch_size: number of lamps changed in one service
+            call
+        :param bool queue_commands: queue switch commands (see
+            LampService.request_lamps_mode()) instead of calling the
+            switch
+        """
+        self.service = service
+        self.batch_size = batch_size
+        self.queue_commands = queue_commands
+        # Heap of (next fire, schedule id). Entries not matching
+        # _next_fires are outdated and skipped.
+        self._heap = []
+        self._next_fires = {}
+        self._refreshed = None
+
+    def load(self):
+        """Load next fire times of all the enabled schedules."""
+        self._heap = []
+        self._next_fires = {}
+        self._refresh(Schedule.objects.all())
+
+    def refresh(self):
+        """Load next fire times of schedules changed since last load."""
+        self._refresh(Schedule.objects.filter(
+            modified__gte=self._refreshed - self.refresh_margin))
+
+    def next_fire(self):
+        """Return the earliest next fire time or None."""
+        while self._heap:
+            fire_time, schedule_id = self._heap[0]
+            if self._next_fires.get(schedule_id) == fire_time:
+                return fire_time
+            heapq.heappop(self._heap)
+        return None
+
+    def run_pending(self):
+        """Fire all the due schedules.
+
+        Schedules are read and fired in batches of batch_size.
+
+        :returns: number of fired schedules
+        """
+        now = timezone.now()
+        due_ids = []
+        while self.next_fire() is not None and self.next_fire() <= now:
+            fire_time, schedule_id = heapq.heappop(self._heap)
+            due_ids.append(schedule_id)
+        due_ids.sort()
+        return sum(self._fire(due_ids[index:index + self.batch_size], now)
+                   for index in range(0, len(due_ids), self.batch_size))
+
+    def _fire(self, schedule_ids, now):
+        schedules = list(Schedule.objects
+                         .filter(pk__in=schedule_ids)
+                         .order_by('id'))
+        # Deleted schedules are forgotten
+        for schedule_id in set(schedule_ids) - {s.pk for s in schedules}:
+            del self._next_fires[schedule_id]
+        fired = [schedule for schedule in schedules
+                 if schedule.enabled
+                 and schedule.next_fire == self._next_fires[schedule.pk]]
+        self._apply(fired)
+
+        for schedule in fired:
+            schedule.last_fire = now
+            schedule.next_fire = (CronExpression(schedule.cron)
+                                  .next_after(now))
+        # modified is kept, so the scheduler doesn't reload these
+        Schedule.objects.bulk_update(fired, ['next_fire', 'last_fire'])
+        # Schedules changed since the last refresh are updated here
+        for schedule in schedules:
+            self._push(schedule.pk, schedule.next_fire)
+        return len(fired)
+
+    def _refresh(self, schedules):
+        self._refreshed = timezone.now()
+        for schedule_id, next_fire, enabled in schedules.values_list(
+                'id', 'next_fire', 'enabled').iterator():
+            self._push(schedule_id, next_fire if enabled else None)
+
+    def _push(self, schedule_id, next_fire):
+        if self._next_fires.get(schedule_id) == next_fire:
+            return
+        self._next_fires[schedule_id] = next_fire
+        if next_fire is not None:
+            heapq.heappush(self._heap, (next_fire, schedule_id))
+
+    def _apply(self, schedules):
+        """Apply mode changes of schedules to their lamps."""
+        modes = {}
+        lamp_ids = list(Schedule.lamps.through.objects
+                        .filter(schedule__in=schedules)
+                        .values_list('schedule_id', 'lamp_id'))
+        group_paths = (Schedule.groups.through.objects
+                       .filter(schedule__in=schedules)
+                       .values_list('schedule_id', 'lampgroup__path'))
+        for schedule_id, path in group_paths:
+            lamp_ids.extend(
+                (schedule_id, lamp_id)
+                for lamp_id in (Lamp.objects
+                                .filter(group__path__startswith=path)
+                                .values_list('pk', flat=True)))
+        lamp_ids.sort()
+        schedules_by_id = {schedule.pk: schedule for schedule in schedules}
+        for schedule_id, lamp_id in lamp_ids:
+            schedule = schedules_by_id[schedule_id]
+            on, brightness = modes.get(lamp_id, (None, None))
+            if schedule.on is not None:
+                on = schedule.on
+            if schedule.brightness is not None:
+                brightness = schedule.brightness
+            modes[lamp_id] = on, brightness
+
+        lamp_ids = sorted(modes)
+        for index in range(0, len(lamp_ids), self.batch_size):
+            lamps = Lamp.objects.filter(
+                pk__in=lamp_ids[index:index + self.batch_size])
+            changes = []
+            for lamp in lamps:
+                on, brightness = modes[lamp.pk]
+                if on == lamp.is_on:
+                    on = None
+                if brightness == lamp.brightness:
+                    brightness = None
+                if on is not None or brightness is not None:
+                    changes.append(LampModeChange(lamp, on, brightness))
+            if not changes:
+                continue
+            if self.queue_commands:
+                self.service.request_lamps_mode(changes)
+                continue
+            try:
+                self.service.set_lamps_mode(changes)
+            except ExternalError:
+                # Other batches are applied
+                logger.error('Failed to apply schedules to %d lamp(s)',
+                             len(changes))
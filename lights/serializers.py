@@ -1,6 +1,13 @@
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
 from rest_framework import serializers
 
-from .models import Lamp
+from .models import Lamp, LampGroup
+from .reports import BUCKET_SIZES
 
 
 class LampSerializer(serializers.HyperlinkedModelSerializer):
@@ -18,9 +25,183 @@ class LampSerializer(serializers.HyperlinkedModelSerializer):
             'is_on',
             'brightness',
             'last_switch',
-            # TODO: This value should be excluded from list
-            # representation or cached. It's expensive to calculate
-            # for every lamp.
+            # This value is expensive to calculate for every lamp,
+            # use with_total_working_time() or CachedLampSerializer
             'total_working_time',
+            'actual_is_on',
+            'actual_brightness',
         ]
         read_only_fields = ['name', 'last_switch']
+
+
+class CachedLampListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        return self.child.to_representation_many(list(data))
+
+
+class CachedLampSerializer(LampSerializer):
+    """Lamp serializer caching representations.
+
+    Representations are cached by lamp id and version, so any change
+    of a lamp invalidates its cache entry. url (depends on request)
+    and total_working_time (depends on current time) are not
+    cached. The latter is calculated from cached closed working time
+    and active period start.
+
+    Serialized lamps don't need with_total_working_time() annotation:
+    lamps missing in the cache are loaded annotated with one query.
+
+    Cache alias is configured by LIGHTS_REPRESENTATION_CACHE setting.
+    """
+
+    class Meta(LampSerializer.Meta):
+        list_serializer_class = CachedLampListSerializer
+
+    def to_representation(self, instance):
+        return self.to_representation_many([instance])[0]
+
+    def to_representation_many(self, lamps):
+        cache = caches[getattr(settings,
+                               'LIGHTS_REPRESENTATION_CACHE',
+                               'default')]
+        keys = {lamp.pk: _cache_key(lamp) for lamp in lamps}
+        cached_entries = cache.get_many(keys.values())
+        entries = {pk: cached_entries[key] for pk, key in keys.items()
+                   if key in cached_entries}
+
+        missing_ids = [lamp.pk for lamp in lamps if lamp.pk not in entries]
+        if missing_ids:
+            fresh_lamps = (Lamp.objects
+                           .with_total_working_time()
+                           .filter(pk__in=missing_ids))
+            new_entries = {lamp.pk: self._make_cache_entry(lamp)
+                           for lamp in fresh_lamps}
+            cache.set_many({_cache_key(lamp): new_entries[lamp.pk]
+                            for lamp in fresh_lamps})
+            entries.update(new_entries)
+
+        now = timezone.now()
+        return [self._from_cache_entry(lamp, entries[lamp.pk], now)
+                if lamp.pk in entries
+                # Deleted while serializing
+                else super().to_representation(lamp)
+                for lamp in lamps]
+
+    def _make_cache_entry(self, lamp):
+        data = super().to_representation(lamp)
+        del data['url']
+        del data['total_working_time']
+        active_period_start = (lamp.last_period_start
+                               if lamp.last_period_end is None
+                               else None)
+        return data, lamp.closed_working_microseconds, active_period_start
+
+    def _from_cache_entry(self, lamp, entry, now):
+        data, closed_working_microseconds, active_period_start = entry
+        total_working_time = timedelta(
+            microseconds=closed_working_microseconds)
+        if active_period_start:
+            total_working_time += now - active_period_start
+
+        representation = OrderedDict()
+        for field_name, field in self.fields.items():
+            if field_name == 'url':
+                representation[field_name] = field.to_representation(lamp)
+            elif field_name == 'total_working_time':
+                representation[field_name] = field.to_representation(
+                    total_working_time)
+            else:
+                representation[field_name] = data[field_name]
+        return representation
+
+
+class LampModeSerializer(serializers.Serializer):
+    """Mode change of a lamp in bulk control requests."""
+
+    id = serializers.IntegerField()
+    is_on = serializers.BooleanField(required=False)
+    brightness = serializers.IntegerField(required=False,
+                                          min_value=1,
+                                          max_value=100)
+
+
+class GroupModeSerializer(serializers.Serializer):
+    """Mode change of lamps of a group."""
+
+    is_on = serializers.BooleanField(required=False)
+    brightness = serializers.IntegerField(required=False,
+                                          min_value=1,
+                                          max_value=100)
+
+
+class LampGroupSerializer(serializers.HyperlinkedModelSerializer):
+
+    url = serializers.HyperlinkedIdentityField(
+        view_name='lights:lampgroup-detail')
+    parent = serializers.HyperlinkedRelatedField(
+        view_name='lights:lampgroup-detail',
+        read_only=True)
+    average_brightness = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = LampGroup
+        fields = [
+            'url',
+            'id',
+            'name',
+            'parent',
+            # Counters of the whole subtree
+            'lamp_count',
+            'on_count',
+            'average_brightness',
+        ]
+
+
+class PeriodExportParamsSerializer(serializers.Serializer):
+    """Query parameters of working period export."""
+
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+    lamp = serializers.ListField(child=serializers.IntegerField(),
+                                 required=False)
+
+    def validate(self, data):
+        if 'start' in data and 'end' in data and data['start'] >= data['end']:
+            raise serializers.ValidationError('start should be before end')
+        return data
+
+
+class WorkingTimeReportParamsSerializer(serializers.Serializer):
+    """Query parameters of working time report."""
+
+    # Maximum number of report buckets, a leap year of hours
+    max_buckets = 366 * 24
+
+    start = serializers.DateTimeField()
+    end = serializers.DateTimeField()
+    bucket = serializers.ChoiceField(choices=list(BUCKET_SIZES),
+                                     default='day')
+    lamp = serializers.ListField(child=serializers.IntegerField(),
+                                 required=False)
+
+    def validate(self, data):
+        if data['start'] >= data['end']:
+            raise serializers.ValidationError('start should be before end')
+        bucket_count = ((data['end'] - data['start'])
+                        / BUCKET_SIZES[data['bucket']])
+        if bucket_count > self.max_buckets:
+            raise serializers.ValidationError(
+                f'No more than {self.max_buckets} buckets are allowed')
+        return data
+
+
+class ReportBucketSerializer(serializers.Serializer):
+
+    start = serializers.DateTimeField()
+    working_time = serializers.DurationField()
+    weighted_working_time = serializers.DurationField()
+
+
+def _cache_key(lamp):
+    return f'lights:lamp:{lamp.pk}:{lamp.version}'
@@ -3,13 +3,30 @@
 Implementing business logic here to keep models simple.
 """
 
+import functools
+import itertools
 import logging
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery
 from django.utils import timezone
+from django.utils.module_loading import import_string
 
-from .models import WorkingPeriod
-from .switch import Switch, SwitchError
+from .export import PERIOD_FIELDS, write_periods_csv
+from .models import (
+    DailyLampUsage,
+    Lamp,
+    LampCommand,
+    LampGroup,
+    LampEvent,
+    WorkingPeriod,
+)
+from .switch import SwitchBatchError, SwitchCommand, SwitchError
 
 
 logger = logging.getLogger(__name__)
@@ -19,12 +36,58 @@ class ExternalError(Exception):
     """External system error."""
 
 
+class ExternalBatchError(ExternalError):
+    """External system error for some lamps of a batch.
+
+    Changes of other lamps are applied.
+
+    :ivar dict errors: error messages by lamp id
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(f'light switch error for {len(errors)} lamp(s)')
+
+
+LampModeChange = namedtuple('LampModeChange',
+                            ['lamp', 'on', 'brightness'],
+                            defaults=[None, None])
+LampModeChange.__doc__ = """Mode change of a lamp for set_lamps_mode()."""
+
+LampImportResult = namedtuple('LampImportResult',
+                              ['created', 'updated', 'unchanged', 'conflicts'])
+LampImportResult.__doc__ = """Result of import_lamps().
+
+created, updated, unchanged are numbers of lamps. conflicts is a list
+of (row number, lamp name, reason) for rows that were not imported.
+"""
+
+
 class LampService:
 
     """Service for controlling lamps."""
 
-    def __init__(self, external_switch):
+    # Number of attempts to apply a queued command
+    max_command_attempts = 5
+    # Maximum number of commands sent to the switch in one call
+    switch_batch_size = 1000
+    # Maximum number of switch calls made concurrently
+    switch_concurrency = 8
+
+    def __init__(self, external_switch, *, switch_after_commit=False,
+                 coalesce_window=timedelta(0)):
+        """Create service.
+
+        :param external_switch: Switch instance
+        :param bool switch_after_commit: call the switch after
+            committing mode changes, see set_lamp_mode()
+        :param timedelta coalesce_window: rapid changes of a lamp
+            within this time are coalesced, see set_lamp_mode().
+            Disabled by default.
+        """
         self.switch = external_switch
+        self.switch_after_commit = switch_after_commit
+        self.coalesce_window = coalesce_window
 
     def set_lamp_mode(self, lamp, *, on=None, brightness=None):
         """Set operating mode for a lamp.
@@ -45,80 +108,1038 @@ class LampService:
         Changing brightness when lamp is on closes active period and
         starts a new one.
 
-        Correct handling of concurrent requests would require
-        Repeatable Read isolation level or some sort of locking. But
-        such things are beyond the scope of this demo project (running
-        on SQLite). Real application would probably have a different
-        approach overall - asynchronous switch operations, tracking
-        both desired and current state of lamps, etc.
+        Parameters matching the current (desired) mode of the lamp are
+        ignored, so repeated requests neither write to the database
+        nor call the switch. Unconfirmed lamps are retried by
+        reconcile() instead.
+
+        The lamp row is locked (SELECT ... FOR UPDATE) and its mode is
+        reloaded first, so concurrent changes of a lamp are serialized
+        and its periods stay consistent. SQLite doesn't support row
+        locks, but it serializes write transactions anyway. See
+        request_lamp_mode() for asynchronous switch operations.
+
+        If the service is created with switch_after_commit, the switch
+        isn't called while the transaction is open, so a slow switch
+        doesn't hold database locks. Mode change is committed first,
+        the lamp stays unconfirmed (actual state differs from desired)
+        until the switch call is done. If the call fails, the change
+        is reverted by a compensating update and ExternalError is
+        raised, like in the transactional mode. When called inside an
+        outer transaction, the switch is called after it's committed.
+
+        Bursts of changes (e.g. from a brightness slider) are coalesced
+        if coalesce_window is set. Brightness change of a lamp with
+        active period started within the window updates the period
+        instead of splitting it. Every change is still sent to the
+        switch: delaying the call would hold the request thread, use
+        request_lamp_mode() to coalesce switch commands too.
 
         :param Lamp lamp: lamp instance, it is updated and saved here
         :raises ExternalError:
 
         """
+        if self.switch_after_commit:
+            self._set_lamp_mode_after_commit(lamp, on, brightness)
+            return
         with transaction.atomic():
+            _lock_lamps([lamp])
+            change = _effective_change(lamp, on, brightness)
+            if change is None:
+                return
+            lamp, on, brightness = change
+            previous_state = _group_state(lamp)
+            self._persist_mode(lamp, on, brightness, count_groups=False)
+            self._call_switch([SwitchCommand(lamp.id, on, brightness)])
+            # Group rows are locked by the update, so it's done after
+            # the switch call: changes of other lamps of the groups
+            # don't wait for the switch
+            update_group_counters([previous_state], [_group_state(lamp)])
+            _confirm_state([lamp])
+            _record_events([lamp])
+
+    def set_lamps_mode(self, changes):
+        """Set operating mode for multiple lamps.
+
+        Bulk version of set_lamp_mode(). Model changes for all the
+        lamps are saved with a few bulk queries in a single
+        transaction. Switch commands are sent concurrently, see
+        _dispatch().
+
+        If switch operations fail for some lamps, the changes are
+        rolled back to a savepoint and saved again for successful
+        lamps only, so failed lamps are not changed. If all of them
+        fail, the transaction is rolled back and the lamp instances are
+        restored too.
+
+        :param changes: iterable of LampModeChange, one per lamp. Lamp
+            instances are updated here, failed ones are restored.
+        :raises ExternalBatchError: if some of the lamps failed
+        :raises ExternalError: if all the lamps failed
+        """
+        changes = list(changes)
+        with transaction.atomic():
+            _lock_lamps(change.lamp for change in changes)
+            changes = _effective_changes(changes)
+            if not changes:
+                return
+            previous_modes = [_lamp_mode(change.lamp) for change in changes]
+            previous_states = {change.lamp.id: _group_state(change.lamp)
+                               for change in changes}
+            savepoint_id = transaction.savepoint()
+            self._persist_modes(changes, count_groups=False)
+            try:
+                errors = self._call_switch(
+                    [SwitchCommand(change.lamp.id, change.on,
+                                   change.brightness)
+                     for change in changes],
+                    partial=True)
+            except ExternalError:
+                for change, previous_mode in zip(changes, previous_modes):
+                    _restore_lamp_mode(change.lamp, previous_mode)
+                raise
+            if errors:
+                transaction.savepoint_rollback(savepoint_id)
+                for change, previous_mode in zip(changes, previous_modes):
+                    _restore_lamp_mode(change.lamp, previous_mode)
+                changes = [change for change in changes
+                           if change.lamp.id not in errors]
+                self._persist_modes(changes, count_groups=False)
+            else:
+                transaction.savepoint_commit(savepoint_id)
+            lamps = [change.lamp for change in changes]
+            # After the switch call, see set_lamp_mode()
+            update_group_counters(
+                [previous_states[lamp.id] for lamp in lamps],
+                [_group_state(lamp) for lamp in lamps])
+            _confirm_state(lamps)
+            _record_events(lamps)
+        if errors:
+            raise ExternalBatchError(errors)
+
+    def request_lamp_mode(self, lamp, *, on=None, brightness=None):
+        """Request operating mode change for a lamp.
+
+        Asynchronous version of set_lamp_mode(). The desired mode is
+        saved to the database and a switch command is queued. The
+        command is applied by process_commands() later, actual state
+        of the lamp is updated then.
+
+        No command is queued if the lamp has a pending one queued
+        within coalesce_window: it applies the latest desired state
+        anyway. Working periods are coalesced as in set_lamp_mode().
+
+        :param Lamp lamp: lamp instance, it is updated and saved here
+        """
+        with transaction.atomic():
+            _lock_lamps([lamp])
+            change = _effective_change(lamp, on, brightness)
+            if change is None:
+                return
+            lamp, on, brightness = change
             self._persist_mode(lamp, on, brightness)
-            self._call_switch(lamp.id, on, brightness)
+            if not self._recently_queued([lamp]):
+                LampCommand.objects.create(lamp=lamp, on=on,
+                                           brightness=brightness)
+            _record_events([lamp])
+
+    def request_lamps_mode(self, changes):
+        """Request operating mode change for multiple lamps.
+
+        Asynchronous version of set_lamps_mode(), see
+        request_lamp_mode().
+
+        :param changes: iterable of LampModeChange, one per lamp
+        """
+        changes = list(changes)
+        with transaction.atomic():
+            _lock_lamps(change.lamp for change in changes)
+            changes = _effective_changes(changes)
+            if not changes:
+                return
+            self._persist_modes(changes)
+            queued_lamp_ids = self._recently_queued(
+                [change.lamp for change in changes])
+            LampCommand.objects.bulk_create(
+                LampCommand(lamp=change.lamp,
+                            on=change.on,
+                            brightness=change.brightness)
+                for change in changes
+                if change.lamp.id not in queued_lamp_ids)
+            _record_events([change.lamp for change in changes])
+
+    def set_group_mode(self, group, *, on=None, brightness=None):
+        """Set operating mode for all the lamps of a group subtree.
+
+        See set_lamps_mode(), all the lamps are changed in one
+        transaction.
+
+        :param LampGroup group: group, its counters are not reloaded
+        :returns: list of lamps
+        :raises ExternalError:
+        """
+        lamps = list(group.subtree_lamps().order_by('pk'))
+        self.set_lamps_mode(LampModeChange(lamp, on, brightness)
+                            for lamp in lamps)
+        return lamps
+
+    def request_group_mode(self, group, *, on=None, brightness=None):
+        """Request operating mode change for lamps of a group subtree.
+
+        Asynchronous version of set_group_mode(), see
+        request_lamps_mode().
 
-    def _persist_mode(self, lamp, on, brightness):
-        """Save mode change to db."""
-        # TODO: check for changes
+        :param LampGroup group: group, its counters are not reloaded
+        :returns: list of lamps
+        """
+        lamps = list(group.subtree_lamps().order_by('pk'))
+        self.request_lamps_mode(LampModeChange(lamp, on, brightness)
+                                for lamp in lamps)
+        return lamps
+
+    def process_commands(self, worker, *, batch_size=100):
+        """Apply a batch of queued switch commands.
+
+        Pending commands are claimed by the worker first, so multiple
+        workers can process the queue concurrently. Desired state of
+        command lamps is sent to the switch in one call. Actual state
+        of lamps is updated for successful commands, failed commands
+        are returned to the queue until max_command_attempts is
+        reached.
+
+        :param str worker: unique worker name
+        :returns: number of processed commands
+        """
+        pending_ids = list(LampCommand.objects
+                           .filter(status=LampCommand.PENDING)
+                           .order_by('id')
+                           .values_list('id', flat=True)[:batch_size])
+        claimed_count = (LampCommand.objects
+                         .filter(pk__in=pending_ids,
+                                 status=LampCommand.PENDING)
+                         .update(status=LampCommand.PROCESSING,
+                                 worker=worker,
+                                 claimed=timezone.now()))
+        if not claimed_count:
+            return 0
+
+        commands = list(LampCommand.objects
+                        .filter(status=LampCommand.PROCESSING, worker=worker)
+                        .select_related('lamp'))
+        lamps = {command.lamp_id: command.lamp for command in commands}
+        errors = self._dispatch([
+            SwitchCommand(lamp.id, on=lamp.is_on, brightness=lamp.brightness)
+            for lamp in lamps.values()])
+        if errors:
+            logger.error('Failed to apply commands for %d lamp(s)',
+                         len(errors))
+
+        with transaction.atomic():
+            confirmed_lamps = [lamp for lamp_id, lamp in lamps.items()
+                               if lamp_id not in errors]
+            _confirm_state(confirmed_lamps)
+            _record_events(confirmed_lamps)
+            (LampCommand.objects
+             .filter(pk__in=[command.pk for command in commands
+                             if command.lamp_id not in errors])
+             .delete())
+            failed_commands = [command for command in commands
+                               if command.lamp_id in errors]
+            for command in failed_commands:
+                command.attempts += 1
+                command.error = str(errors[command.lamp_id])
+                command.worker = ''
+                command.status = (
+                    LampCommand.FAILED
+                    if command.attempts >= self.max_command_attempts
+                    else LampCommand.PENDING)
+            LampCommand.objects.bulk_update(
+                failed_commands,
+                ['attempts', 'error', 'worker', 'status'])
+        return len(commands)
+
+    def reconcile(self, *, stale_after=timedelta(minutes=5),
+                  retry_failed=False):
+        """Make sure actual state of all lamps will be confirmed.
+
+        Commands claimed by a worker too long ago (e.g. crashed one)
+        are returned to the queue. Commands are queued for lamps with
+        unconfirmed state and no queued commands.
+
+        :param bool retry_failed: return failed commands to the queue
+        :returns: number of queued commands
+        """
+        stale_commands = LampCommand.objects.filter(
+            status=LampCommand.PROCESSING,
+            claimed__lt=timezone.now() - stale_after)
+        stale_commands.update(status=LampCommand.PENDING, worker='')
+        if retry_failed:
+            (LampCommand.objects
+             .filter(status=LampCommand.FAILED)
+             .update(status=LampCommand.PENDING, attempts=0))
+
+        unconfirmed_lamps = (
+            Lamp.objects
+            .filter(Q(actual_is_on__isnull=True)
+                    | Q(actual_brightness__isnull=True)
+                    | ~Q(is_on=F('actual_is_on'))
+                    | ~Q(brightness=F('actual_brightness')))
+            .filter(command__isnull=True)
+        )
+        commands = LampCommand.objects.bulk_create(
+            LampCommand(lamp=lamp) for lamp in unconfirmed_lamps)
+        return len(commands)
+
+    def _set_lamp_mode_after_commit(self, lamp, on, brightness):
+        with transaction.atomic():
+            _lock_lamps([lamp])
+            change = _effective_change(lamp, on, brightness)
+            if change is None:
+                return
+            lamp, on, brightness = change
+            previous_mode = (lamp.is_on, lamp.brightness, lamp.last_switch)
+            period_changes = self._persist_mode(lamp, on, brightness)
+            _record_events([lamp])
+        transaction.on_commit(functools.partial(
+            self._call_switch_after_commit,
+            lamp,
+            SwitchCommand(lamp.id, on, brightness),
+            previous_mode,
+            period_changes))
+
+    def _call_switch_after_commit(self, lamp, command, previous_mode,
+                                  period_changes):
+        try:
+            self._call_switch([command])
+        except ExternalError:
+            with transaction.atomic():
+                if _revert_mode(lamp, previous_mode, *period_changes):
+                    _record_events([lamp])
+            raise
+        with transaction.atomic():
+            _confirm_state([lamp])
+            _record_events([lamp])
+
+    def _persist_mode(self, lamp, on, brightness, *, count_groups=True):
+        """Save mode change to db.
+
+        Only changed fields are written, see _effective_change().
+
+        :param bool count_groups: update lamp counters of groups
+
+        :returns: tuple of opened, closed and coalesced (updated in
+            place) periods, or None
+        """
         now = timezone.now()
+        previous_state = _group_state(lamp)
+        update_fields = []
         if on is not None:
             lamp.is_on = on
             lamp.last_switch = now
+            update_fields += ['is_on', 'last_switch']
         if brightness is not None:
             lamp.brightness = brightness
-        lamp.save()
+            update_fields.append('brightness')
+        # Working time counter is updated separately
+        lamp.save(update_fields=update_fields)
+        if count_groups:
+            update_group_counters([previous_state], [_group_state(lamp)])
 
+        opened_period = closed_period = coalesced_period = None
         if on:
-            _open_period(lamp, now, brightness)
+            opened_period = _open_period(lamp, now, brightness)
         elif on is False:
-            _close_period(lamp, now)
+            closed_period = _close_period(lamp, now)
         elif lamp.is_on and brightness is not None:
-            # brightness changed when light was on, splitting period
-            _close_period(lamp, now)
-            _open_period(lamp, now, brightness)
-        return lamp
+            coalesced_period = self._coalesce_periods([lamp], now).get(
+                lamp.id)
+            if coalesced_period is None:
+                # brightness changed when light was on, splitting period
+                closed_period = _close_period(lamp, now)
+                opened_period = _open_period(lamp, now, brightness)
+        return opened_period, closed_period, coalesced_period
 
-    def _call_switch(self, lamp_id, on, brightness):
-        """Perform calls to the switch.
+    def _persist_modes(self, changes, *, count_groups=True):
+        """Save mode changes of multiple lamps to db.
 
-        This is supposed to control the actual lamps.
+        Only fields changed for some of the lamps are written.
 
-        :raises ExternalError:
+        :param bool count_groups: update lamp counters of groups
+        """
+        now = timezone.now()
+        update_fields = set()
+        to_close = []
+        to_open = []
+        to_split = []
+        previous_states = [_group_state(change.lamp) for change in changes]
+        for lamp, on, brightness in changes:
+            if on is not None:
+                lamp.is_on = on
+                lamp.last_switch = now
+                update_fields.update(['is_on', 'last_switch'])
+            if brightness is not None:
+                lamp.brightness = brightness
+                update_fields.add('brightness')
+
+            if on:
+                to_open.append(lamp)
+            elif on is False:
+                to_close.append(lamp)
+            elif lamp.is_on and brightness is not None:
+                to_split.append(lamp)
+
+        coalesced_periods = self._coalesce_periods(to_split, now)
+        for lamp in to_split:
+            if lamp.id not in coalesced_periods:
+                to_close.append(lamp)
+                to_open.append(lamp)
+        Lamp.objects.bulk_update(
+            [change.lamp for change in changes],
+            sorted(update_fields))
+        if count_groups:
+            update_group_counters(
+                previous_states,
+                [_group_state(change.lamp) for change in changes])
+        _close_periods(to_close, now)
+        WorkingPeriod.objects.bulk_create(
+            WorkingPeriod(lamp=lamp, brightness=lamp.brightness, start=now)
+            for lamp in to_open)
+
+    def _coalesce_periods(self, lamps, now):
+        """Update brightness of active periods started within the window.
+
+        :param lamps: lamps that are on, with new brightness set
+        :returns: dict of updated periods by lamp id
+        """
+        if not self.coalesce_window or not lamps:
+            return {}
+        lamps_by_id = {lamp.id: lamp for lamp in lamps}
+        periods = list(WorkingPeriod.objects
+                       .filter(lamp__in=lamps,
+                               end__isnull=True,
+                               start__gte=now - self.coalesce_window))
+        for period in periods:
+            period.brightness = lamps_by_id[period.lamp_id].brightness
+        WorkingPeriod.objects.bulk_update(periods, ['brightness'])
+        return {period.lamp_id: period for period in periods}
+
+    def _recently_queued(self, lamps):
+        """Return ids of lamps with pending commands queued within the
+        coalesce window."""
+        if not self.coalesce_window:
+            return set()
+        return set(LampCommand.objects
+                   .filter(lamp__in=lamps,
+                           status=LampCommand.PENDING,
+                           created__gte=(timezone.now()
+                                         - self.coalesce_window))
+                   .values_list('lamp_id', flat=True))
+
+    def _call_switch(self, commands, *, partial=False):
+        """Perform a call to the switch.
+
+        This is supposed to control the actual lamps. Power and
+        brightness changes of a lamp are sent as a single command, see
+        _dispatch().
+
+        :param commands: list of SwitchCommand
+        :param bool partial: return errors if only some of the
+            commands failed
+        :returns: error messages by lamp id (empty unless partial)
+        :raises ExternalError: if any command failed (all the commands
+            with partial)
         """
         # TODO: set brightness only when turning on (regardless of
         # actual brightness change)?
+        errors = self._dispatch(commands)
+        if not errors:
+            return {}
+        logger.error('Failed to set mode for %d of %d lamp(s)',
+                     len(errors), len(commands))
+        if partial and len(errors) < len(commands):
+            return errors
+        raise ExternalError('light switch error')
+
+    def _dispatch(self, commands):
+        """Send commands to the switch.
+
+        Commands are sent in batches of switch_batch_size, up to
+        switch_concurrency batches at once. The switch is expected to
+        split a batch by controllers itself and to send concurrent
+        calls in parallel (see NetworkSwitch, limited by connections
+        of a controller), so a batch takes one round trip and the
+        batches are sent at once.
+
+        :param commands: list of SwitchCommand, one per lamp
+        :returns: error messages by lamp id of failed commands
+        """
+        batches = [commands[index:index + self.switch_batch_size]
+                   for index in range(0, len(commands),
+                                      self.switch_batch_size)]
+        if not batches:
+            return {}
+        if len(batches) == 1:
+            return self._execute(commands)
+        errors = {}
+        with ThreadPoolExecutor(
+                max_workers=min(len(batches), self.switch_concurrency),
+                thread_name_prefix='dispatch') as executor:
+            for batch_errors in executor.map(self._execute, batches):
+                errors.update(batch_errors)
+        return errors
+
+    def _execute(self, commands):
+        """Execute a batch of commands, return errors by lamp id."""
         try:
-            if brightness is not None:
-                self.switch.set_brightness(
-                    lamp_id=lamp_id,
-                    brightness=brightness)
-            if on is True:
-                self.switch.turn_on(lamp_id)
-            elif on is False:
-                self.switch.turn_off(lamp_id)
+            self.switch.execute(commands)
+        except SwitchBatchError as e:
+            return e.errors
         except SwitchError as e:
-            logger.error('Failed to set mode for lamp %d: ' + str(e))
-            raise ExternalError('light switch error')
+            return {command.lamp_id: str(e) for command in commands}
+        return {}
+
+
+def import_lamps(definitions, *, update=False, chunk_size=1000):
+    """Create lamps from definitions, matching existing ones by name.
+
+    A definition is a dict with lamp name and optionally brightness.
+    Lamps are processed in chunks, one transaction per chunk, with a
+    few bulk queries per chunk.
+
+    Existing lamps are updated if update is True, but brightness of
+    lamps that are on can be changed only through the switch (see
+    LampService.set_lamp_mode()), so such definitions are conflicts.
+    Otherwise any difference from an existing lamp is a conflict.
+    Invalid definitions and duplicate names are conflicts too.
+
+    :param definitions: iterable of dicts
+    :param bool update: update existing lamps
+    :returns: LampImportResult
+    """
+    created = updated = unchanged = 0
+    conflicts = []
+    seen_names = set()
+    for chunk_start, chunk in _chunks(definitions, chunk_size):
+        lamps = {}
+        for row_number, definition in enumerate(chunk, chunk_start + 1):
+            brightness = definition.get('brightness')
+            lamp = Lamp(name=definition.get('name') or '',
+                        brightness=(100 if brightness in (None, '')
+                                    else brightness))
+            try:
+                lamp.clean_fields(exclude=_NOT_IMPORTED_FIELDS)
+            except ValidationError as e:
+                conflicts.append((row_number, lamp.name, _error_text(e)))
+                continue
+            if lamp.name in seen_names:
+                conflicts.append((row_number, lamp.name, 'duplicate name'))
+                continue
+            seen_names.add(lamp.name)
+            lamps[row_number] = lamp
+
+        with transaction.atomic():
+            existing = Lamp.objects.select_for_update().in_bulk(
+                [lamp.name for lamp in lamps.values()],
+                field_name='name')
+            to_create = []
+            to_update = []
+            for row_number, lamp in lamps.items():
+                existing_lamp = existing.get(lamp.name)
+                if existing_lamp is None:
+                    to_create.append(lamp)
+                elif existing_lamp.brightness == lamp.brightness:
+                    unchanged += 1
+                elif not update:
+                    conflicts.append((row_number, lamp.name, 'lamp exists'))
+                elif existing_lamp.is_on:
+                    conflicts.append((row_number, lamp.name, 'lamp is on'))
+                else:
+                    existing_lamp.brightness = lamp.brightness
+                    to_update.append(existing_lamp)
+            Lamp.objects.bulk_create(to_create)
+            Lamp.objects.bulk_update(to_update, ['brightness'])
+        created += len(to_create)
+        updated += len(to_update)
+    conflicts.sort()
+    return LampImportResult(created, updated, unchanged, conflicts)
+
+
+def update_group_counters(previous_states, states):
+    """Update lamp counters of groups for changed lamps.
+
+    Lamps not in groups don't cause any queries.
+
+    :param previous_states: iterable of lamp states before the change,
+        None for created lamps. A state is a tuple of group id, is_on
+        and brightness, see _group_state().
+    :param states: iterable of lamp states after the change, None for
+        deleted lamps
+    """
+    counts = defaultdict(lambda: [0, 0, 0])
+    for sign, lamp_states in [(-1, previous_states), (1, states)]:
+        for state in lamp_states:
+            if state is None or state[0] is None:
+                continue
+            group_id, is_on, brightness = state
+            group_counts = counts[group_id]
+            group_counts[0] += sign
+            if is_on:
+                group_counts[1] += sign
+                group_counts[2] += sign * brightness
+    counts = {group_id: group_counts
+              for group_id, group_counts in counts.items()
+              if any(group_counts)}
+    if counts:
+        LampGroup.objects.add_lamp_counts(counts)
+
+
+def update_working_time(previous_periods, periods):
+    """Update working time counters of lamps for changed periods.
+
+    For periods changed bypassing the service, e.g. in admin. Open
+    periods aren't counted until they are closed. Versions of the lamps
+    are incremented even if the counters don't change, since their
+    cached representations depend on the last period.
+
+    :param previous_periods: iterable of periods before the change
+    :param periods: iterable of periods after the change, without
+        deleted periods
+    """
+    increments = defaultdict(int)
+    for sign, changed_periods in [(-1, previous_periods), (1, periods)]:
+        changed_periods = list(changed_periods)
+        for period in changed_periods:
+            increments[period.lamp_id] += (
+                sign * (period.duration // timedelta(microseconds=1))
+                if period.end is not None
+                else 0)
+        _count_daily_usage([period for period in changed_periods
+                            if period.end is not None],
+                           sign)
+    for lamp_id, microseconds in increments.items():
+        (Lamp.objects
+         .filter(pk=lamp_id)
+         .update(closed_working_microseconds=(
+             F('closed_working_microseconds') + microseconds)))
+
+
+def archive_periods(cutoff, *, batch_size=10000, export_file=None):
+    """Delete periods closed before cutoff, keeping working time.
+
+    Working time of the periods is moved to archived working time of
+    their lamps, so total working time and rebuilt counters don't
+    change. Daily usage is not changed either, make sure it's built
+    for the archived periods (see rebuild_daily_usage command).
+    Periods are processed in batches, one transaction per batch. A
+    batch is exported before it's committed, so exported periods may
+    be exported again if the commit fails.
+
+    :param datetime cutoff: archive periods ended before it. It should
+        be midnight of TIME_ZONE, so daily usage can be rebuilt.
+    :param export_file: text file to write archived periods as CSV
+        to, the header is written only if it's empty
+    :returns: number of archived periods
+    """
+    archived_count = 0
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            rows = list(WorkingPeriod.objects
+                        .filter(pk__gt=last_pk, end__lte=cutoff)
+                        .order_by('pk')
+                        .values_list(*PERIOD_FIELDS)[:batch_size])
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+
+            increments = defaultdict(int)
+            for period_id, lamp_id, brightness, start, end in rows:
+                increments[lamp_id] += (end - start) // timedelta(
+                    microseconds=1)
+            lamps = Lamp.objects.in_bulk(increments)
+            for lamp_id, microseconds in increments.items():
+                lamp = lamps[lamp_id]
+                lamp.archived_working_microseconds = (
+                    F('archived_working_microseconds') + microseconds)
+                lamp.archived_until = cutoff
+            Lamp.objects.bulk_update(
+                lamps.values(),
+                ['archived_working_microseconds', 'archived_until'])
+            (WorkingPeriod.objects
+             .filter(pk__in=[row[0] for row in rows])
+             .delete())
+
+            if export_file is not None:
+                # The file may be appended to by previous runs
+                write_periods_csv(rows, export_file,
+                                  header=export_file.tell() == 0)
+        archived_count += len(rows)
+    return archived_count
+
+
+def close_abandoned_periods(*, chunk_size=500, dry_run=False):
+    """Close abandoned periods (open, but not last) of all the lamps.
+
+    An abandoned period is closed at start of the next period of its
+    lamp, its duration is added to the working time counter and daily
+    usage of the lamp. Lamps are processed in chunks of chunk_size,
+    one transaction per chunk. Each chunk takes a query finding the
+    periods and a single UPDATE closing them, both using period
+    indexes, so the job stays fast for large period tables (open
+    periods are few).
+
+    :param bool dry_run: only find the periods, don't change anything
+    :returns: list of abandoned periods, end is set to the closing
+        time
+    """
+    abandoned = []
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            lamp_ids = list(Lamp.objects
+                            .filter(pk__gt=last_pk)
+                            .order_by('pk')
+                            .values_list('pk', flat=True)[:chunk_size])
+            if not lamp_ids:
+                break
+            last_pk = lamp_ids[-1]
+            if not dry_run:
+                # Mode changes of the lamps wait for the chunk
+                _lock_lamps(Lamp(pk=pk) for pk in lamp_ids)
+
+            next_start = Subquery(WorkingPeriod.objects
+                                  .filter(lamp=OuterRef('lamp'),
+                                          start__gt=OuterRef('start'))
+                                  .order_by('start')
+                                  .values('start')[:1])
+            periods = list(WorkingPeriod.objects
+                           .filter(lamp__in=lamp_ids, end__isnull=True)
+                           .annotate(next_start=next_start)
+                           .filter(next_start__isnull=False)
+                           .order_by('lamp', 'start'))
+            for period in periods:
+                period.end = period.next_start
+            abandoned.extend(periods)
+            if dry_run or not periods:
+                continue
+
+            (WorkingPeriod.objects
+             .filter(pk__in=[period.pk for period in periods])
+             .update(end=next_start))
+            increments = defaultdict(int)
+            for period in periods:
+                increments[period.lamp_id] += (
+                    period.duration // timedelta(microseconds=1))
+            lamps = [Lamp(pk=lamp_id,
+                          closed_working_microseconds=(
+                              F('closed_working_microseconds')
+                              + microseconds))
+                     for lamp_id, microseconds in increments.items()]
+            Lamp.objects.bulk_update(lamps, ['closed_working_microseconds'])
+            _count_daily_usage(periods)
+    return abandoned
+
+
+def prune_events(cutoff, *, batch_size=10000):
+    """Delete lamp events created before cutoff.
+
+    Events are deleted by ranges of id up to the first event created
+    at cutoff or later, one transaction per batch, so no index on
+    created is needed. Clients resuming the event stream from a
+    deleted event get the events left only.
+
+    :returns: number of deleted events
+    """
+    first_kept_id = (LampEvent.objects
+                     .filter(created__gte=cutoff)
+                     .order_by('pk')
+                     .values_list('pk', flat=True)
+                     .first())
+    events = LampEvent.objects.all()
+    if first_kept_id is not None:
+        events = events.filter(pk__lt=first_kept_id)
+    deleted_count = 0
+    while True:
+        with transaction.atomic():
+            pks = list(events
+                       .order_by('pk')
+                       .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            LampEvent.objects.filter(pk__in=pks).delete()
+        deleted_count += len(pks)
+    return deleted_count
+
+
+_NOT_IMPORTED_FIELDS = [field.name for field in Lamp._meta.fields
+                        if field.name not in ['name', 'brightness']]
+
+
+def _chunks(iterable, size):
+    """Split iterable into lists, yield (start index, list) pairs."""
+    iterator = iter(iterable)
+    start = 0
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield start, chunk
+        start += len(chunk)
+
+
+def _error_text(validation_error):
+    return '; '.join(f'{field}: {" ".join(messages)}'
+                     for field, messages
+                     in validation_error.message_dict.items())
+
+
+def _lamp_mode(lamp):
+    """Return lamp fields changed by LampService._persist_modes()."""
+    return (lamp.is_on,
+            lamp.brightness,
+            lamp.last_switch,
+            lamp.closed_working_microseconds)
+
+
+def _restore_lamp_mode(lamp, mode):
+    (lamp.is_on,
+     lamp.brightness,
+     lamp.last_switch,
+     lamp.closed_working_microseconds) = mode
+
+
+def _lock_lamps(lamps):
+    """Lock rows of lamps until the end of transaction.
+
+    Fields changed by mode changes are reloaded from the locked rows,
+    so the changes are applied to the latest mode. Rows are locked in
+    order of id to avoid deadlocks between bulk changes.
+    """
+    lamps_by_id = {lamp.pk: lamp for lamp in lamps}
+    rows = (Lamp.objects
+            .select_for_update()
+            .filter(pk__in=lamps_by_id)
+            .order_by('pk')
+            .values_list('pk', *_LOCKED_FIELDS))
+    for pk, *values in rows:
+        lamp = lamps_by_id[pk]
+        for field, value in zip(_LOCKED_FIELDS, values):
+            setattr(lamp, field, value)
+
+
+# Lamp fields reloaded by _lock_lamps()
+_LOCKED_FIELDS = ['is_on', 'brightness', 'last_switch', 'group_id',
+                  'closed_working_microseconds']
+
+
+def _effective_change(lamp, on, brightness):
+    """Drop parameters matching the desired mode of a lamp.
+
+    :returns: LampModeChange or None if nothing is changed
+    """
+    if on == lamp.is_on:
+        on = None
+    if brightness == lamp.brightness:
+        brightness = None
+    if on is None and brightness is None:
+        return None
+    return LampModeChange(lamp, on, brightness)
+
+
+def _effective_changes(changes):
+    """Return list of changes that change something, see
+    _effective_change()."""
+    return [change
+            for change in itertools.starmap(_effective_change, changes)
+            if change is not None]
+
+
+def _group_state(lamp):
+    """Return lamp state counted by group counters."""
+    return lamp.group_id, lamp.is_on, lamp.brightness
+
+
+def _confirm_state(lamps):
+    """Save desired state of lamps as actual."""
+    for lamp in lamps:
+        lamp.actual_is_on = lamp.is_on
+        lamp.actual_brightness = lamp.brightness
+    Lamp.objects.bulk_update(lamps, ['actual_is_on', 'actual_brightness'])
+
+
+def _record_events(lamps):
+    """Save current state of lamps as events for the event stream."""
+    now = timezone.now()
+    LampEvent.objects.bulk_create(
+        LampEvent(lamp=lamp,
+                  is_on=lamp.is_on,
+                  brightness=lamp.brightness,
+                  actual_is_on=lamp.actual_is_on,
+                  actual_brightness=lamp.actual_brightness,
+                  created=now)
+        for lamp in lamps)
+
+
+def _revert_mode(lamp, previous_mode, opened_period, closed_period,
+                 coalesced_period):
+    """Revert mode change saved by LampService._persist_mode().
+
+    Lamp isn't reverted if it has been changed since then.
+
+    :returns: True if the lamp is reverted
+    """
+    is_on, brightness, last_switch = previous_mode
+    reverted = (Lamp.objects
+                .filter(pk=lamp.pk,
+                        is_on=lamp.is_on,
+                        brightness=lamp.brightness,
+                        last_switch=lamp.last_switch)
+                .update(is_on=is_on,
+                        brightness=brightness,
+                        last_switch=last_switch))
+    if not reverted:
+        logger.warning('Lamp %d was changed concurrently, not reverting',
+                       lamp.id)
+        return False
+    changed_state = _group_state(lamp)
+    lamp.is_on, lamp.brightness, lamp.last_switch = previous_mode
+    update_group_counters([changed_state], [_group_state(lamp)])
+
+    if opened_period:
+        opened_period.delete()
+    if coalesced_period:
+        coalesced_period.brightness = brightness
+        coalesced_period.save(update_fields=['brightness'])
+    if closed_period:
+        microseconds = closed_period.duration // timedelta(microseconds=1)
+        _count_daily_usage([closed_period], sign=-1)
+        closed_period.end = None
+        closed_period.save()
+        (Lamp.objects
+         .filter(pk=lamp.pk)
+         .update(closed_working_microseconds=(
+             F('closed_working_microseconds') - microseconds)))
+        lamp.closed_working_microseconds -= microseconds
+    return True
 
 
 def _open_period(lamp, timestamp, brightness):
-    WorkingPeriod.objects.create(lamp=lamp,
-                                 brightness=lamp.brightness,
-                                 start=timestamp)
+    return WorkingPeriod.objects.create(lamp=lamp,
+                                        brightness=lamp.brightness,
+                                        start=timestamp)
 
 
 def _close_period(lamp, timestamp):
-    """Close current working period."""
+    """Close current working period.
+
+    Duration of the period is added to the lamp's counter of closed
+    working time.
+    """
     try:
         last_period = lamp.periods.latest('start')
-        # TODO: check if active
-        last_period.end = timestamp
-        last_period.save()
     except WorkingPeriod.DoesNotExist:
+        last_period = None
+    if last_period is None or last_period.end is not None:
         logger.warning('No period to close for lamp_id=%d', lamp.id)
+        return None
+    last_period.end = timestamp
+    last_period.save()
+    _count_closed_periods([last_period])
+    return last_period
+
+
+def _close_periods(lamps, timestamp):
+    """Close current working periods of multiple lamps."""
+    if not lamps:
+        return
+    last_period_ids = (
+        Lamp.objects
+        .filter(pk__in=[lamp.pk for lamp in lamps])
+        .annotate(last_period_id=Subquery(
+            WorkingPeriod.objects
+            .filter(lamp=OuterRef('pk'))
+            .order_by('-start')
+            .values('pk')[:1]))
+        .values('last_period_id')
+    )
+    periods = list(WorkingPeriod.objects.filter(pk__in=last_period_ids,
+                                                end__isnull=True))
+    lamps_by_id = {lamp.pk: lamp for lamp in lamps}
+    for period in periods:
+        period.lamp = lamps_by_id[period.lamp_id]
+        period.end = timestamp
+    if len(periods) < len(lamps):
+        logger.warning('No period to close for %d of %d lamps',
+                       len(lamps) - len(periods), len(lamps))
+
+    WorkingPeriod.objects.bulk_update(periods, ['end'])
+    _count_closed_periods(periods)
+
+
+def _count_closed_periods(periods):
+    """Add duration of closed periods to lamp working time counters.
+
+    At most one period per lamp is expected.
+    """
+    increments = {period.lamp: period.duration // timedelta(microseconds=1)
+                  for period in periods}
+    counters = {lamp: lamp.closed_working_microseconds for lamp in increments}
+    for lamp, microseconds in increments.items():
+        lamp.closed_working_microseconds = (F('closed_working_microseconds')
+                                            + microseconds)
+    Lamp.objects.bulk_update(increments, ['closed_working_microseconds'])
+    for lamp, microseconds in increments.items():
+        lamp.closed_working_microseconds = counters[lamp] + microseconds
+    _count_daily_usage(periods)
+
+
+def _count_daily_usage(periods, sign=1):
+    """Add working time of closed periods to daily usage of lamps.
+
+    :param int sign: -1 to subtract (when a period is reopened)
+    """
+    # Working and weighted microseconds by lamp id and date
+    increments = defaultdict(lambda: [0, 0])
+    for period in periods:
+        for date, working_us, weighted_us in period.daily_usage():
+            increment = increments[period.lamp_id, date]
+            increment[0] += sign * working_us
+            increment[1] += sign * weighted_us
+    if not increments:
+        return
+
+    DailyLampUsage.objects.bulk_create(
+        (DailyLampUsage(lamp_id=lamp_id, date=date)
+         for lamp_id, date in increments),
+        ignore_conflicts=True)
+    rows = DailyLampUsage.objects.filter(
+        lamp__in={lamp_id for lamp_id, date in increments},
+        date__in={date for lamp_id, date in increments})
+    updated_rows = []
+    for row in rows:
+        increment = increments.get((row.lamp_id, row.date))
+        if increment is None:
+            continue
+        row.working_microseconds = (F('working_microseconds')
+                                    + increment[0])
+        row.weighted_microseconds = (F('weighted_microseconds')
+                                     + increment[1])
+        updated_rows.append(row)
+    DailyLampUsage.objects.bulk_update(
+        updated_rows,
+        ['working_microseconds', 'weighted_microseconds'])
+
+
+def _load_switch():
+    """Create switch configured by LIGHTS_SWITCH_BACKEND setting."""
+    backend = import_string(getattr(settings,
+                                    'LIGHTS_SWITCH_BACKEND',
+                                    'lights.switch.Switch'))
+    return backend(**getattr(settings, 'LIGHTS_SWITCH_OPTIONS', {}))
 
 
-lamp_service = LampService(Switch())
+lamp_service = LampService(
+    _load_switch(),
+    switch_after_commit=getattr(settings, 'LIGHTS_SWITCH_AFTER_COMMIT', False),
+    coalesce_window=timedelta(
+        milliseconds=getattr(settings, 'LIGHTS_COALESCE_WINDOW_MS', 0)))
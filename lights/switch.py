@@ -6,6 +6,7 @@ sources. Let's assume it uses some sort of hardware controller.
 
 
 import logging
+from collections import namedtuple
 
 
 logger = logging.getLogger(__name__)
@@ -15,13 +16,60 @@ class SwitchError(Exception):
     pass
 
 
+class SwitchBatchError(SwitchError):
+    """Some commands of a batch failed.
+
+    Commands for other lamps of the batch are applied.
+
+    :ivar dict errors: error messages by lamp id
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(f'failed commands for {len(errors)} lamp(s)')
+
+
+SwitchCommand = namedtuple('SwitchCommand',
+                           ['lamp_id', 'on', 'brightness'],
+                           defaults=[None, None])
+SwitchCommand.__doc__ = """Command for a lamp, None means "don't change"."""
+
+
 class Switch:
     """Light switch for multiple lamps.
 
     This interface is synchronous. Methods apply changes immediately or
     raise exception.
+
+    execute() should be preferred: it applies commands for any number
+    of lamps in a single controller call.
     """
 
+    def execute(self, commands):
+        """Apply multiple lamp commands in a single call.
+
+        Brightness is set before turning a lamp on.
+
+        :param commands: iterable of SwitchCommand, one per lamp
+        :raises SwitchBatchError: if some of the commands failed
+        :raises SwitchError: if the whole call failed
+        """
+        for command in commands:
+            if command.brightness is not None:
+                logger.info('Set brightness to %d%% for lamp %d',
+                            command.brightness, command.lamp_id)
+            if command.on is True:
+                logger.info('Turned on lamp %d', command.lamp_id)
+            elif command.on is False:
+                logger.info('Turned off lamp %d', command.lamp_id)
+
+    def status(self):
+        """Return state of controllers for monitoring.
+
+        :returns: list of dicts, one per controller
+        """
+        return []
+
     def turn_on(self, lamp_id):
         logger.info('Turned on lamp %d', lamp_id)
 
@@ -0,0 +1,101 @@
+import datetime
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from .models import DailyLampUsage, Lamp
+
+
+class WorkingPeriodAdminTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(
+            User.objects.create_superuser('admin', 'admin@example.com', ''))
+        self.lamp = Lamp.objects.create(name='lamp')
+        # Lamp ids are reused by tests, cached representations too
+        cache.clear()
+        # Periods are edited in the local time zone
+        self.start = timezone.make_aware(datetime.datetime(2019, 1, 1, 10))
+
+    def create_period(self, hours):
+        period = self.lamp.periods.create(
+            brightness=50,
+            start=self.start,
+            end=(self.start + datetime.timedelta(hours=hours)
+                 if hours is not None
+                 else None))
+        lamps = Lamp.objects.filter(pk=self.lamp.pk)
+        lamps.rebuild_closed_working_time()
+        lamps.rebuild_daily_usage()
+        return period
+
+    def change_period(self, period, end_hour):
+        return self.client.post(
+            f'/admin/lights/workingperiod/{period.id}/change/',
+            {'lamp': self.lamp.id,
+             'brightness': 50,
+             'start_0': '2019-01-01',
+             'start_1': '10:00:00',
+             'end_0': '2019-01-01',
+             'end_1': f'{end_hour}:00:00'})
+
+    def assertWorkingHours(self, hours):
+        self.lamp.refresh_from_db()
+        self.assertEqual(self.lamp.closed_working_time,
+                         datetime.timedelta(hours=hours))
+        usage = DailyLampUsage.objects.filter(lamp=self.lamp).first()
+        self.assertEqual(usage.working_microseconds if usage else 0,
+                         hours * 3600 * 10**6)
+
+    def test_change(self):
+        period = self.create_period(hours=1)
+
+        response = self.change_period(period, end_hour=13)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertWorkingHours(3)
+
+    def test_close(self):
+        period = self.create_period(hours=None)
+
+        self.change_period(period, end_hour=12)
+
+        self.assertWorkingHours(2)
+
+    def test_delete(self):
+        period = self.create_period(hours=2)
+
+        response = self.client.post(
+            f'/admin/lights/workingperiod/{period.id}/delete/',
+            {'post': 'yes'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertWorkingHours(0)
+
+    def test_delete_selected(self):
+        period = self.create_period(hours=2)
+
+        response = self.client.post(
+            '/admin/lights/workingperiod/',
+            {'action': 'delete_selected',
+             '_selected_action': [period.id],
+             'post': 'yes'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertWorkingHours(0)
+
+    def test_cache_invalidation(self):
+        """Representation cache is invalidated by open period changes.
+
+        They don't change working time counters.
+        """
+        period = self.create_period(hours=None)
+        self.client.get(f'/api/lamps/{self.lamp.id}/')
+
+        self.client.post(f'/admin/lights/workingperiod/{period.id}/delete/',
+                         {'post': 'yes'})
+        response = self.client.get(f'/api/lamps/{self.lamp.id}/')
+
+        self.assertEqual(response.json()['total_working_time'], '00:00:00')
@@ -1,13 +1,20 @@
-from datetime import datetime
+import csv
+import json
+import time
+from datetime import datetime, timedelta
 from unittest import mock
 
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.utils import timezone
+from django.utils.dateparse import parse_duration
+from django.utils.http import http_date
 from rest_framework import status
 from rest_framework.test import APIClient
 
-from .models import Lamp
+from .api_views import LampViewSet
+from .models import Lamp, LampCommand, LampGroup
 from .switch import SwitchError
 
 
@@ -25,6 +32,8 @@ class LampsTests(TestCase):
         user = User.objects.create_user('testuser')
         self.client = APIClient()
         self.client.force_authenticate(user=user)
+        # Lamp ids are reused by tests, cached representations too
+        cache.clear()
 
     def test_root(self):
         response = self.client.get('/api/')
@@ -53,6 +62,155 @@ class LampsTests(TestCase):
         self.assertEqual(lamp_repr['brightness'], lamp.brightness)
         self.assertIn('url', lamp_repr)
 
+    def test_list_query_count(self):
+        """Working time shouldn't cause a query per lamp."""
+        for i in range(3):
+            lamp = Lamp.objects.create(name=f'lamp{i}')
+            lamp.periods.create(brightness=10, start=timezone.now())
+
+        # Conditional request state, count, page, cache misses
+        with self.assertNumQueries(4):
+            response = self.client.get('/api/lamps/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        with self.assertNumQueries(3):
+            cached_response = self.client.get('/api/lamps/')
+        self.assertEqual(
+            [lamp_repr['name']
+             for lamp_repr in cached_response.json()['results']],
+            [lamp_repr['name'] for lamp_repr in response.json()['results']])
+
+    def test_cache_invalidation(self):
+        lamp = Lamp.objects.create(name='lamp1')
+        self.client.get(f'/api/lamps/{lamp.id}/')
+
+        self.client.patch(f'/api/lamps/{lamp.id}/', {'brightness': 10})
+        response = self.client.get(f'/api/lamps/{lamp.id}/')
+        self.assertEqual(response.json()['brightness'], 10)
+
+        # Like admin does
+        lamp.refresh_from_db()
+        lamp.name = 'new name'
+        lamp.save()
+        response = self.client.get(f'/api/lamps/{lamp.id}/')
+        self.assertEqual(response.json()['name'], 'new name')
+
+    def test_cached_working_time(self):
+        """Working time of active lamp is recalculated for cached repr."""
+        lamp = Lamp.objects.create(name='lamp1')
+        self.client.patch(f'/api/lamps/{lamp.id}/', {'is_on': True})
+
+        response = self.client.get(f'/api/lamps/{lamp.id}/')
+        cached_response = self.client.get(f'/api/lamps/{lamp.id}/')
+
+        self.assertGreater(
+            parse_duration(cached_response.json()['total_working_time']),
+            parse_duration(response.json()['total_working_time']))
+
+    def test_list_page_size(self):
+        for i in range(3):
+            Lamp.objects.create(name=f'lamp{i}')
+
+        response = self.client.get('/api/lamps/?page_size=2')
+        data = response.json()
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(len(data['results']), 2)
+
+    def test_list_cursor_pagination(self):
+        for i in range(5):
+            Lamp.objects.create(name=f'lamp{i}')
+
+        names = []
+        url = '/api/lamps/?pagination=cursor&page_size=2'
+        while url:
+            # Page, cache misses
+            with self.assertNumQueries(2):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.json()
+            self.assertNotIn('count', data)
+            names.extend(lamp_repr['name'] for lamp_repr in data['results'])
+            url = data['next']
+        self.assertEqual(names, [f'lamp{i}' for i in range(5)])
+
+    def test_list_etag(self):
+        lamp = Lamp.objects.create(name='lamp1')
+        response = self.client.get('/api/lamps/')
+        etag = response['ETag']
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/lamps/',
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        response = self.client.get('/api/lamps/?page=1',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK,
+                         'ETag should depend on query')
+
+        self.client.patch(f'/api/lamps/{lamp.id}/', {'brightness': 10})
+        response = self.client.get('/api/lamps/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_list_etag_new_lamp(self):
+        Lamp.objects.create(name='lamp1')
+        etag = self.client.get('/api/lamps/')['ETag']
+
+        Lamp.objects.create(name='lamp2')
+        response = self.client.get('/api/lamps/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_list_no_last_modified(self):
+        """Collection Last-Modified can't reflect deleted lamps."""
+        lamps = [Lamp.objects.create(name=f'lamp{i}', is_on=bool(i))
+                 for i in range(2)]
+        response = self.client.get('/api/lamps/')
+        self.assertNotIn('Last-Modified', response)
+
+        lamps[0].delete()
+        response = self.client.get(
+            '/api/lamps/',
+            HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 60))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_details_etag(self):
+        lamp = Lamp.objects.create(name='lamp1')
+        response = self.client.get(f'/api/lamps/{lamp.id}/')
+        etag = response['ETag']
+
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/lamps/{lamp.id}/',
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        lamp.name = 'new name'
+        lamp.save()
+        response = self.client.get(f'/api/lamps/{lamp.id}/',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_details_last_modified(self):
+        lamp = Lamp.objects.create(name='lamp1')
+        response = self.client.get(f'/api/lamps/{lamp.id}/')
+        last_modified = response['Last-Modified']
+
+        response = self.client.get(f'/api/lamps/{lamp.id}/',
+                                   HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    @mock.patch('lights.api_views.time.time')
+    def test_details_etag_active_lamp(self, mock_time):
+        """Working time of active lamp makes ETag expire."""
+        mock_time.return_value = 1000000
+        lamp = Lamp.objects.create(name='lamp1', is_on=True)
+        etag = self.client.get(f'/api/lamps/{lamp.id}/')['ETag']
+
+        mock_time.return_value += LampViewSet.working_time_resolution
+        response = self.client.get(f'/api/lamps/{lamp.id}/',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
     def test_lamp_details(self):
         lamp = Lamp.objects.create(name='lamp1',
                                    is_on=True,
@@ -112,6 +270,20 @@ class LampsTests(TestCase):
             lamp.last_switch,
             'change of brightness should not update "last_switch"')
 
+    @mock.patch('lights.services.lamp_service.switch')
+    def test_no_change(self, mock_switch):
+        lamp = Lamp.objects.create(name='lamp1', brightness=50)
+
+        response = self.client.patch(f'/api/lamps/{lamp.id}/',
+                                     {'is_on': False, 'brightness': 50})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.json()['is_on'],
+                          response.json()['brightness']),
+                         (False, 50))
+        mock_switch.execute.assert_not_called()
+        self.assertEqual(Lamp.objects.get(pk=lamp.pk).version, lamp.version)
+
     def test_post(self):
         response = self.client.post('/api/lamps/', {'name': 'lamp name'})
         self.assertEqual(response.status_code,
@@ -136,7 +308,7 @@ class LampsTests(TestCase):
 
     @mock.patch('lights.services.lamp_service.switch')
     def test_switch_error(self, mock_switch):
-        mock_switch.turn_on.side_effect = SwitchError('switch error')
+        mock_switch.execute.side_effect = SwitchError('switch error')
         lamp = Lamp.objects.create(name='lamp1')
         # TODO: extract reverse method
         response = self.client.patch(f'/api/lamps/{lamp.id}/',
@@ -144,6 +316,104 @@ class LampsTests(TestCase):
         self.assertEqual(response.status_code,
                          status.HTTP_503_SERVICE_UNAVAILABLE)
 
+    def test_bulk(self):
+        lamps = [Lamp.objects.create(name=f'lamp{i}') for i in range(3)]
+
+        response = self.client.patch(
+            '/api/lamps/bulk/',
+            [{'id': lamps[0].id, 'is_on': True, 'brightness': 30},
+             {'id': lamps[1].id, 'brightness': 40}],
+            format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual([lamp_repr['name'] for lamp_repr in data],
+                         ['lamp0', 'lamp1'])
+        for lamp in lamps:
+            lamp.refresh_from_db()
+        self.assertEqual((lamps[0].is_on, lamps[0].brightness), (True, 30))
+        self.assertEqual((lamps[1].is_on, lamps[1].brightness), (False, 40))
+        self.assertEqual((lamps[2].is_on, lamps[2].brightness), (False, 100))
+
+    def test_bulk_validation_error(self):
+        lamp = Lamp.objects.create(name='lamp1')
+
+        response = self.client.patch(
+            '/api/lamps/bulk/',
+            [{'id': lamp.id, 'brightness': 0}],
+            format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_duplicate_ids(self):
+        lamp = Lamp.objects.create(name='lamp1')
+
+        response = self.client.patch(
+            '/api/lamps/bulk/',
+            [{'id': lamp.id, 'is_on': True}, {'id': lamp.id, 'is_on': False}],
+            format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_404(self):
+        lamp = Lamp.objects.create(name='lamp1')
+
+        response = self.client.patch(
+            '/api/lamps/bulk/',
+            [{'id': lamp.id, 'is_on': True}, {'id': 100, 'is_on': True}],
+            format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        lamp.refresh_from_db()
+        self.assertEqual(lamp.is_on, False)
+
+    @mock.patch('lights.services.lamp_service.switch')
+    def test_bulk_switch_error(self, mock_switch):
+        mock_switch.execute.side_effect = SwitchError('switch error')
+        lamp = Lamp.objects.create(name='lamp1')
+
+        response = self.client.patch('/api/lamps/bulk/',
+                                     [{'id': lamp.id, 'is_on': True}],
+                                     format='json')
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    @override_settings(LIGHTS_ASYNC_SWITCH=True)
+    @mock.patch('lights.services.lamp_service.switch')
+    def test_turn_on_async(self, mock_switch):
+        lamp = Lamp.objects.create(name='lamp1')
+
+        response = self.client.patch(f'/api/lamps/{lamp.id}/',
+                                     {'is_on': True})
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        lamp_repr = response.json()
+        self.assertEqual(lamp_repr['is_on'], True)
+        self.assertIsNone(lamp_repr['actual_is_on'])
+        mock_switch.execute.assert_not_called()
+        self.assertTrue(LampCommand.objects.filter(lamp=lamp).exists())
+
+    @override_settings(LIGHTS_ASYNC_SWITCH=True)
+    def test_bulk_async(self):
+        lamp = Lamp.objects.create(name='lamp1')
+
+        response = self.client.patch('/api/lamps/bulk/',
+                                     [{'id': lamp.id, 'is_on': True}],
+                                     format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertTrue(LampCommand.objects.filter(lamp=lamp).exists())
+
+    def test_turn_on_confirmed(self):
+        lamp = Lamp.objects.create(name='lamp1')
+
+        response = self.client.patch(f'/api/lamps/{lamp.id}/',
+                                     {'is_on': True})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['actual_is_on'], True)
+
     def test_turn_on_404(self):
         """Test turning on a non-existent lamp."""
         response = self.client.patch(f'/api/lamps/100/',
@@ -151,5 +421,298 @@ class LampsTests(TestCase):
         self.assertEqual(response.status_code,
                          status.HTTP_404_NOT_FOUND)
 
+
+@mock.patch.object(LampViewSet, 'event_stream_timeout', 0)
+class LampEventsTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('testuser')
+        self.client = APIClient()
+        self.client.force_authenticate(user=user)
+
+    def get_events(self, **extra):
+        response = self.client.get('/api/lamps/events/',
+                                   HTTP_ACCEPT='text/event-stream',
+                                   **extra)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = b''.join(response.streaming_content).decode()
+        return [dict(line.split(': ', 1) for line in message.splitlines())
+                for message in content.split('\n\n')
+                if message.startswith('id:')]
+
+    def test_resume(self):
+        lamp = Lamp.objects.create(name='lamp1')
+        self.client.patch(f'/api/lamps/{lamp.id}/', {'is_on': True})
+        self.client.patch(f'/api/lamps/{lamp.id}/', {'brightness': 10})
+
+        events = self.get_events(HTTP_LAST_EVENT_ID='0')
+        self.assertEqual(len(events), 2)
+        data = json.loads(events[1]['data'])
+        self.assertEqual(data['id'], lamp.id)
+        self.assertEqual(data['is_on'], True)
+        self.assertEqual(data['brightness'], 10)
+        self.assertEqual(data['actual_brightness'], 10)
+
+        self.assertEqual(
+            self.get_events(HTTP_LAST_EVENT_ID=events[1]['id']), [])
+        self.assertEqual(
+            self.get_events(QUERY_STRING=f'last_event_id={events[0]["id"]}'),
+            events[1:])
+
+    def test_new_events_only(self):
+        lamp = Lamp.objects.create(name='lamp1')
+        self.client.patch(f'/api/lamps/{lamp.id}/', {'is_on': True})
+
+        self.assertEqual(self.get_events(), [])
+
+    def test_invalid_event_id(self):
+        response = self.client.get('/api/lamps/events/',
+                                   HTTP_LAST_EVENT_ID='x')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class LampImportTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('testuser', is_staff=True)
+        self.client = APIClient()
+        self.client.force_authenticate(user=user)
+
+    def test_json(self):
+        Lamp.objects.create(name='lamp1')
+
+        response = self.client.post('/api/lamps/import/',
+                                    [{'name': 'lamp1', 'brightness': 50},
+                                     {'name': 'lamp2'}],
+                                    format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data['created'], 1)
+        self.assertEqual(data['conflicts'], [{'row': 1,
+                                              'name': 'lamp1',
+                                              'reason': 'lamp exists'}])
+
+    def test_csv_update(self):
+        Lamp.objects.create(name='lamp1')
+
+        response = self.client.post('/api/lamps/import/?update=true',
+                                    'name,brightness\nlamp1,50\nlamp2,\n',
+                                    content_type='text/csv')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['updated'], 1)
+        self.assertEqual(Lamp.objects.get(name='lamp1').brightness, 50)
+        self.assertEqual(Lamp.objects.get(name='lamp2').brightness, 100)
+
+    def test_invalid(self):
+        response = self.client.post('/api/lamps/import/', {'name': 'lamp1'},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_not_admin(self):
+        self.client.force_authenticate(
+            user=User.objects.create_user('otheruser'))
+        response = self.client.post('/api/lamps/import/', [], format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class LampGroupTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('testuser')
+        self.client = APIClient()
+        self.client.force_authenticate(user=user)
+        self.floor = LampGroup.objects.create(name='floor')
+        self.room = LampGroup.objects.create(name='room', parent=self.floor)
+        self.lamps = [Lamp.objects.create(name=f'lamp{i}', group=self.room)
+                      for i in range(2)]
+        LampGroup.objects.rebuild_counters()
+
+    def test_list(self):
+        response = self.client.get('/api/groups/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        room = response.json()['results'][1]
+        self.assertEqual(room['name'], 'room')
+        self.assertTrue(
+            room['parent'].endswith(f'/api/groups/{self.floor.pk}/'))
+        self.assertEqual(room['lamp_count'], 2)
+        self.assertEqual(room['on_count'], 0)
+        self.assertIsNone(room['average_brightness'])
+
+    def test_control(self):
+        response = self.client.patch(f'/api/groups/{self.floor.pk}/control/',
+                                     {'is_on': True, 'brightness': 30},
+                                     format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['on_count'], 2)
+        self.assertEqual(response.json()['average_brightness'], 30)
+        self.assertEqual(
+            Lamp.objects.filter(is_on=True, brightness=30).count(), 2)
+
+    @override_settings(LIGHTS_ASYNC_SWITCH=True)
+    def test_control_async(self):
+        response = self.client.patch(f'/api/groups/{self.room.pk}/control/',
+                                     {'is_on': True},
+                                     format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(LampCommand.objects.count(), 2)
+
+    def test_control_invalid(self):
+        response = self.client.patch(f'/api/groups/{self.room.pk}/control/',
+                                     {'brightness': 0},
+                                     format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SwitchStatusTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', is_staff=True)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    @mock.patch('lights.services.lamp_service.switch')
+    def test_status(self, mock_switch):
+        mock_switch.status.return_value = [{'controller': 'localhost:9090',
+                                            'state': 'open'}]
+
+        response = self.client.get('/api/switch/status/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['controllers'][0]['state'], 'open')
+
+    def test_not_admin(self):
+        self.user.is_staff = False
+        self.user.save()
+
+        response = self.client.get('/api/switch/status/')
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class WorkingTimeReportTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('testuser')
+        self.client = APIClient()
+        self.client.force_authenticate(user=user)
+
+    def test_report(self):
+        lamp = Lamp.objects.create(name='lamp1')
+        lamp.periods.create(brightness=50,
+                            start=datetime(2019, 3, 1, 10,
+                                           tzinfo=timezone.utc),
+                            end=datetime(2019, 3, 2, 10,
+                                         tzinfo=timezone.utc))
+
+        response = self.client.get('/api/reports/working-time/', {
+            'start': '2019-03-01T00:00:00Z',
+            'end': '2019-03-03T00:00:00Z',
+            'lamp': [lamp.id],
+        })
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(parse_duration(data['total']['working_time']),
+                         timedelta(days=1))
+        self.assertEqual(
+            parse_duration(data['total']['weighted_working_time']),
+            timedelta(hours=12))
+        self.assertEqual(
+            [parse_duration(bucket['working_time'])
+             for bucket in data['buckets']],
+            [timedelta(hours=14), timedelta(hours=10)])
+
+    def test_validation(self):
+        for params in [{'start': '2019-03-02T00:00:00Z',
+                        'end': '2019-03-01T00:00:00Z'},
+                       {'start': '2019-03-01T00:00:00Z',
+                        'end': '2029-03-01T00:00:00Z',
+                        'bucket': 'hour'},
+                       {'start': '2019-03-01T00:00:00Z',
+                        'end': '2019-03-02T00:00:00Z',
+                        'bucket': 'week'}]:
+            with self.subTest(params=params):
+                response = self.client.get('/api/reports/working-time/',
+                                           params)
+                self.assertEqual(response.status_code,
+                                 status.HTTP_400_BAD_REQUEST)
+
+
+class WorkingPeriodExportTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('testuser', is_staff=True)
+        self.client = APIClient()
+        self.client.force_authenticate(user=user)
+        self.lamp = Lamp.objects.create(name='lamp1')
+        self.periods = [
+            self.lamp.periods.create(
+                brightness=50,
+                start=datetime(2019, 3, day, 10, tzinfo=timezone.utc),
+                end=datetime(2019, 3, day, 11, tzinfo=timezone.utc))
+            for day in [1, 2, 3]]
+
+    def get_export(self, params):
+        response = self.client.get('/api/periods/export/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv(self):
+        content = self.get_export({'start': '2019-03-02T00:00:00Z'})
+
+        rows = list(csv.DictReader(content.splitlines()))
+        self.assertEqual([int(row['id']) for row in rows],
+                         [period.pk for period in self.periods[1:]])
+        self.assertEqual(rows[0]['start'], '2019-03-02T10:00:00+00:00')
+
+    def test_ndjson(self):
+        content = self.get_export({'format': 'ndjson',
+                                   'lamp': [self.lamp.pk],
+                                   'end': '2019-03-02T00:00:00Z'})
+
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(rows, [{'id': self.periods[0].pk,
+                                 'lamp_id': self.lamp.pk,
+                                 'brightness': 50,
+                                 'start': '2019-03-01T10:00:00+00:00',
+                                 'end': '2019-03-01T11:00:00+00:00'}])
+
+    def test_not_admin(self):
+        self.client.force_authenticate(
+            user=User.objects.create_user('otheruser'))
+        response = self.client.get('/api/periods/export/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class LampSwitchAfterCommitTests(TransactionTestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('testuser')
+        self.client = APIClient()
+        self.client.force_authenticate(user=user)
+
+    @mock.patch('lights.services.lamp_service.switch_after_commit', True)
+    @mock.patch('lights.services.lamp_service.switch')
+    def test_switch_error(self, mock_switch):
+        mock_switch.execute.side_effect = SwitchError('switch error')
+        lamp = Lamp.objects.create(name='lamp1')
+
+        response = self.client.patch(f'/api/lamps/{lamp.id}/',
+                                     {'is_on': True})
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_503_SERVICE_UNAVAILABLE)
+        lamp.refresh_from_db()
+        self.assertEqual(lamp.is_on, False)
+        self.assertEqual(lamp.periods.count(), 0)
+
+
 # TODO: test 0% brightness
 # TODO: test paging
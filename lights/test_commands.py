@@ -0,0 +1,238 @@
+import csv
+import datetime
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from .models import (
+    DailyLampUsage,
+    Lamp,
+    LampCommand,
+    LampGroup,
+    Schedule,
+)
+from .services import lamp_service
+
+
+class RebuildWorkingTimeTests(TestCase):
+
+    def setUp(self):
+        self.lamp = Lamp.objects.create(name='the lamp')
+        self.lamp.periods.create(
+            brightness=1,
+            start=datetime.datetime(2019, 1, 1, 10, tzinfo=timezone.utc),
+            end=datetime.datetime(2019, 1, 1, 11, tzinfo=timezone.utc))
+
+    def test_rebuild(self):
+        out = StringIO()
+        call_command('rebuild_working_time', chunk_size=1, stdout=out)
+
+        self.lamp.refresh_from_db()
+        self.assertEqual(self.lamp.closed_working_time,
+                         datetime.timedelta(hours=1))
+        self.assertIn('fixed: 1', out.getvalue())
+
+    def test_check_drift(self):
+        with self.assertRaises(CommandError):
+            call_command('rebuild_working_time', check=True, stdout=StringIO())
+
+        self.lamp.refresh_from_db()
+        self.assertEqual(self.lamp.closed_working_microseconds, 0)
+
+    def test_check_no_drift(self):
+        call_command('rebuild_working_time', stdout=StringIO())
+        out = StringIO()
+        call_command('rebuild_working_time', check=True, stdout=out)
+        self.assertIn('found: 0', out.getvalue())
+
+
+class RebuildDailyUsageTests(TestCase):
+
+    def test_rebuild(self):
+        for i in range(3):
+            lamp = Lamp.objects.create(name=f'lamp{i}')
+            lamp.periods.create(
+                brightness=1,
+                start=datetime.datetime(2019, 1, 1, 10, tzinfo=timezone.utc),
+                end=datetime.datetime(2019, 1, 1, 11, tzinfo=timezone.utc))
+
+        out = StringIO()
+        call_command('rebuild_daily_usage', chunk_size=2, stdout=out)
+
+        self.assertEqual(DailyLampUsage.objects.count(), 3)
+        self.assertIn('created: 3', out.getvalue())
+
+
+class RebuildGroupCountersTests(TestCase):
+
+    def test_rebuild(self):
+        group = LampGroup.objects.create(name='room')
+        Lamp.objects.create(name='the lamp', group=group)
+        out = StringIO()
+
+        call_command('rebuild_group_counters', stdout=out)
+
+        group.refresh_from_db()
+        self.assertEqual(group.lamp_count, 1)
+        self.assertIn('drifted counters: 1', out.getvalue())
+
+
+class ArchivePeriodsTests(TestCase):
+
+    def test_archive(self):
+        lamp = Lamp.objects.create(name='the lamp')
+        now = timezone.now()
+        old_period = lamp.periods.create(
+            brightness=1,
+            start=now - datetime.timedelta(days=12),
+            end=now - datetime.timedelta(days=11))
+        recent_period = lamp.periods.create(
+            brightness=1,
+            start=now - datetime.timedelta(days=5),
+            end=now - datetime.timedelta(days=4))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'periods.csv')
+            call_command('archive_periods', older_than=10, export=path,
+                         stdout=StringIO())
+            # Appended without another header
+            call_command('archive_periods', older_than=3, export=path,
+                         stdout=StringIO())
+            with open(path) as export_file:
+                exported = list(csv.DictReader(export_file))
+
+        self.assertEqual(lamp.periods.count(), 0)
+        self.assertEqual([int(row['id']) for row in exported],
+                         [old_period.pk, recent_period.pk])
+
+
+class PruneEventsTests(TestCase):
+
+    def test_prune(self):
+        lamp = Lamp.objects.create(name='the lamp')
+        now = timezone.now()
+        for hours in [30, 25, 1]:
+            lamp.events.create(is_on=True,
+                               brightness=100,
+                               created=now - datetime.timedelta(hours=hours))
+
+        out = StringIO()
+        call_command('prune_events', older_than=24, batch_size=1, stdout=out)
+
+        self.assertIn('deleted: 2', out.getvalue())
+        self.assertEqual(
+            list(lamp.events.values_list('created', flat=True)),
+            [now - datetime.timedelta(hours=1)])
+
+
+class CloseAbandonedPeriodsTests(TestCase):
+
+    def setUp(self):
+        self.lamp = Lamp.objects.create(name='the lamp')
+        for hour in [10, 11]:
+            self.lamp.periods.create(
+                brightness=50,
+                start=datetime.datetime(2019, 1, 1, hour, tzinfo=timezone.utc))
+
+    def test_close(self):
+        out = StringIO()
+        call_command('close_abandoned_periods', stdout=out)
+
+        self.assertIn('closed: 1 (lamps: 1)', out.getvalue())
+        self.assertEqual(self.lamp.periods.filter(end__isnull=True).count(),
+                         1)
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command('close_abandoned_periods', dry_run=True, stdout=out)
+
+        self.assertIn(f'of lamp {self.lamp.pk}', out.getvalue())
+        self.assertIn('found: 1 (lamps: 1)', out.getvalue())
+        self.assertEqual(self.lamp.periods.filter(end__isnull=True).count(),
+                         2)
+
+
+class ExportPeriodsTests(TestCase):
+
+    def test_export(self):
+        lamp = Lamp.objects.create(name='the lamp')
+        for day in [1, 2]:
+            lamp.periods.create(
+                brightness=1,
+                start=datetime.datetime(2019, 1, day, 10, tzinfo=timezone.utc),
+                end=datetime.datetime(2019, 1, day, 11, tzinfo=timezone.utc))
+
+        out = StringIO()
+        call_command('export_periods', format='ndjson', lamp=[lamp.pk],
+                     start=datetime.datetime(2019, 1, 2,
+                                             tzinfo=timezone.utc),
+                     stdout=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn('2019-01-02T10:00:00+00:00', lines[0])
+
+
+class ImportLampsTests(TestCase):
+
+    def test_import(self):
+        Lamp.objects.create(name='lamp1')
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'lamps.json')
+            with open(path, 'w') as input_file:
+                json.dump([{'name': 'lamp1'}, {'name': 'lamp2'}], input_file)
+            out = StringIO()
+            call_command('import_lamps', path, stdout=out)
+
+        self.assertEqual(Lamp.objects.count(), 2)
+        self.assertIn('created: 1', out.getvalue())
+
+    def test_conflicts(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'lamps.csv')
+            with open(path, 'w') as input_file:
+                input_file.write('name,brightness\nlamp1,500\n')
+            out = StringIO()
+            with self.assertRaises(CommandError):
+                call_command('import_lamps', path, stdout=out)
+
+        self.assertIn('Row 1 "lamp1"', out.getvalue())
+
+
+class RunSwitchWorkerTests(TransactionTestCase):
+
+    def test_once(self):
+        lamps = [Lamp.objects.create(name=f'lamp{i}') for i in range(5)]
+        lamp_service.request_lamp_mode(lamps[0], on=True)
+
+        call_command('run_switch_worker', once=True, workers=1, batch_size=2,
+                     stdout=StringIO())
+
+        self.assertFalse(LampCommand.objects.exists())
+        for lamp in lamps:
+            lamp.refresh_from_db()
+            self.assertTrue(lamp.is_confirmed)
+
+
+class RunSchedulerTests(TestCase):
+
+    def test_once(self):
+        lamp = Lamp.objects.create(name='the lamp')
+        schedule = Schedule.objects.create(name='evening', cron='0 18 * * *',
+                                           on=True)
+        schedule.lamps.add(lamp)
+        Schedule.objects.update(next_fire=timezone.now())
+        out = StringIO()
+
+        call_command('run_scheduler', once=True, stdout=out)
+
+        self.assertIn('Fired 1 schedule(s)', out.getvalue())
+        lamp.refresh_from_db()
+        self.assertTrue(lamp.is_on)
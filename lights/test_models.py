@@ -5,7 +5,7 @@ from django.core.exceptions import ValidationError
 from django.test import TestCase
 from django.utils import timezone
 
-from .models import Lamp, WorkingPeriod
+from .models import DailyLampUsage, Lamp, LampGroup, WorkingPeriod
 
 
 class LampTests(TestCase):
@@ -62,6 +62,8 @@ class LampTests(TestCase):
             brightness=1,
             start=datetime.datetime(2019, 1, 1, 2, tzinfo=timezone.utc),
             end=datetime.datetime(2019, 1, 1, 5, tzinfo=timezone.utc))
+        Lamp.objects.rebuild_closed_working_time()
+        lamp.refresh_from_db()
 
         expected_duration = period1.duration + period2.duration
         self.assertEqual(lamp.total_working_time, expected_duration)
@@ -81,11 +83,117 @@ class LampTests(TestCase):
             brightness=1,
             start=datetime.datetime(2019, 1, 1, 2, tzinfo=timezone.utc),
             end=datetime.datetime(2019, 1, 1, 5, tzinfo=timezone.utc))
+        Lamp.objects.rebuild_closed_working_time()
+        lamp.refresh_from_db()
 
         expected_duration = closed_period.duration + active_period.duration
         delta = abs(lamp.total_working_time - expected_duration)
         self.assertLess(delta, timedelta(seconds=1))
 
+    def test_total_working_time_annotated(self):
+        """Test total time annotated by queryset."""
+        lamp = Lamp.objects.create(name='the lamp')
+        closed_period = lamp.periods.create(
+            brightness=1,
+            start=datetime.datetime(2019, 1, 1, 10, tzinfo=timezone.utc),
+            end=datetime.datetime(2019, 1, 1, 11, tzinfo=timezone.utc))
+        active_period = lamp.periods.create(
+            brightness=1,
+            start=datetime.datetime(2019, 1, 1, 13, tzinfo=timezone.utc))
+        Lamp.objects.rebuild_closed_working_time()
+
+        with self.assertNumQueries(1):
+            annotated_lamp = (Lamp.objects
+                              .with_total_working_time()
+                              .get(pk=lamp.pk))
+            total = annotated_lamp.total_working_time
+
+        expected_duration = closed_period.duration + active_period.duration
+        delta = abs(total - expected_duration)
+        self.assertLess(delta, timedelta(seconds=1))
+
+    def test_total_working_time_annotated_no_active(self):
+        lamp = Lamp.objects.create(name='the lamp')
+        lamp.periods.create(
+            brightness=1,
+            start=datetime.datetime(2019, 1, 1, 10, tzinfo=timezone.utc),
+            end=datetime.datetime(2019, 1, 1, 11, tzinfo=timezone.utc))
+        Lamp.objects.create(name='other lamp')
+        Lamp.objects.rebuild_closed_working_time()
+
+        lamps = Lamp.objects.with_total_working_time().order_by('name')
+        self.assertEqual([lamp.total_working_time for lamp in lamps],
+                         [timedelta(0), timedelta(hours=1)])
+
+    def test_total_working_time_uses_counter(self):
+        lamp = Lamp.objects.create(name='the lamp',
+                                   closed_working_microseconds=10**6)
+        self.assertEqual(lamp.total_working_time, timedelta(seconds=1))
+
+    def test_rebuild_closed_working_time(self):
+        lamp = Lamp.objects.create(name='the lamp',
+                                   closed_working_microseconds=10**6)
+        lamp.periods.create(
+            brightness=1,
+            start=datetime.datetime(2019, 1, 1, 10, tzinfo=timezone.utc),
+            end=datetime.datetime(2019, 1, 1, 11, tzinfo=timezone.utc))
+        Lamp.objects.create(name='other lamp')
+
+        drifted = Lamp.objects.rebuild_closed_working_time()
+
+        self.assertEqual(drifted, [lamp])
+        lamp.refresh_from_db()
+        self.assertEqual(lamp.closed_working_time, timedelta(hours=1))
+
+    def test_rebuild_closed_working_time_dry_run(self):
+        lamp = Lamp.objects.create(name='the lamp',
+                                   closed_working_microseconds=10**6)
+
+        drifted = Lamp.objects.rebuild_closed_working_time(dry_run=True)
+
+        self.assertEqual(drifted, [lamp])
+        lamp.refresh_from_db()
+        self.assertEqual(lamp.closed_working_microseconds, 10**6)
+
+    @timezone.override(timezone.utc)
+    def test_rebuild_daily_usage(self):
+        lamp = Lamp.objects.create(name='the lamp')
+        for day in [1, 2]:
+            lamp.periods.create(
+                brightness=50,
+                start=datetime.datetime(2019, 1, day, 10, tzinfo=timezone.utc),
+                end=datetime.datetime(2019, 1, day, 11, tzinfo=timezone.utc))
+        lamp.periods.create(
+            brightness=50,
+            start=datetime.datetime(2019, 1, 2, 12, tzinfo=timezone.utc))
+        DailyLampUsage.objects.create(lamp=lamp,
+                                      date=datetime.date(2019, 1, 5),
+                                      working_microseconds=1)
+
+        self.assertEqual(Lamp.objects.rebuild_daily_usage(), 2)
+
+        self.assertEqual(
+            list(lamp.daily_usage.order_by('date')
+                 .values_list('date', 'working_microseconds',
+                              'weighted_microseconds')),
+            [(datetime.date(2019, 1, 1), 3600 * 10**6, 1800 * 10**6),
+             (datetime.date(2019, 1, 2), 3600 * 10**6, 1800 * 10**6)])
+
+    def test_version(self):
+        lamp = Lamp.objects.create(name='the lamp')
+        self.assertEqual(lamp.version, 1)
+
+        lamp.save()
+        self.assertEqual(lamp.version, 2)
+        lamp.save(update_fields=['name'])
+        self.assertEqual(lamp.version, 3)
+        Lamp.objects.filter(pk=lamp.pk).update(brightness=10)
+        lamp.refresh_from_db()
+        self.assertEqual(lamp.version, 4)
+        Lamp.objects.bulk_update([lamp], ['brightness'])
+        lamp.refresh_from_db()
+        self.assertEqual(lamp.version, 5)
+
 
 class WorkingPeriodTests(TestCase):
 
@@ -109,6 +217,63 @@ class WorkingPeriodTests(TestCase):
         period = WorkingPeriod(lamp=lamp, brightness=33, start=start, end=end)
         self.assertEqual(period.duration, end - start)
 
+    @timezone.override(timezone.utc)
+    def test_daily_usage(self):
+        lamp = Lamp.objects.create(name='lamp')
+        period = WorkingPeriod(
+            lamp=lamp,
+            brightness=10,
+            start=datetime.datetime(2019, 1, 1, 23, tzinfo=timezone.utc),
+            end=datetime.datetime(2019, 1, 3, 1, tzinfo=timezone.utc))
+
+        hour = 3600 * 10**6
+        self.assertEqual(period.daily_usage(), [
+            (datetime.date(2019, 1, 1), hour, hour // 10),
+            (datetime.date(2019, 1, 2), 24 * hour, 24 * hour // 10),
+            (datetime.date(2019, 1, 3), hour, hour // 10),
+        ])
+
+    def test_daily_usage_time_zone(self):
+        """Days are split at midnight of the current time zone."""
+        lamp = Lamp.objects.create(name='lamp')
+        period = WorkingPeriod(
+            lamp=lamp,
+            brightness=10,
+            start=datetime.datetime(2019, 1, 1, 22, tzinfo=timezone.utc),
+            end=datetime.datetime(2019, 1, 2, 0, tzinfo=timezone.utc))
+
+        with timezone.override('Etc/GMT+1'):
+            self.assertEqual(
+                [date for date, *_ in period.daily_usage()],
+                [datetime.date(2019, 1, 1)])
+        with timezone.override('Etc/GMT-1'):
+            self.assertEqual(
+                [date for date, *_ in period.daily_usage()],
+                [datetime.date(2019, 1, 1), datetime.date(2019, 1, 2)])
+
+    def test_daily_usage_dst_at_midnight(self):
+        """DST changes at midnight, it doesn't exist or is ambiguous."""
+        lamp = Lamp.objects.create(name='lamp')
+        hour = 3600 * 10**6
+        cases = [
+            # Midnight is skipped
+            (datetime.datetime(2019, 3, 10, 3, tzinfo=timezone.utc),
+             datetime.date(2019, 3, 9)),
+            # Midnight happens twice, the day starts at the second one
+            (datetime.datetime(2019, 11, 3, 3, tzinfo=timezone.utc),
+             datetime.date(2019, 11, 2)),
+        ]
+        for start, date in cases:
+            period = WorkingPeriod(lamp=lamp,
+                                   brightness=100,
+                                   start=start,
+                                   end=start + timedelta(hours=3))
+            with self.subTest(date), timezone.override('America/Havana'):
+                self.assertEqual(period.daily_usage(), [
+                    (date, 2 * hour, 2 * hour),
+                    (date + timedelta(days=1), hour, hour),
+                ])
+
     def test_duration_open(self):
         lamp = Lamp.objects.create(name='lamp')
         period = WorkingPeriod(
@@ -116,3 +281,70 @@ class WorkingPeriodTests(TestCase):
             brightness=33,
             start=datetime.datetime(2019, 1, 1, 10, tzinfo=timezone.utc))
         self.assertIsInstance(period.duration, timedelta)
+
+
+class LampGroupTests(TestCase):
+
+    def setUp(self):
+        self.building = LampGroup.objects.create(name='building')
+        self.floor = LampGroup.objects.create(name='floor',
+                                              parent=self.building)
+        self.room = LampGroup.objects.create(name='room', parent=self.floor)
+
+    def test_path(self):
+        self.assertEqual(self.building.path, f'/{self.building.pk}/')
+        self.room.refresh_from_db()
+        self.assertEqual(
+            self.room.path,
+            f'/{self.building.pk}/{self.floor.pk}/{self.room.pk}/')
+
+    def test_subtree_lamps(self):
+        lamp = Lamp.objects.create(name='lamp1', group=self.room)
+        Lamp.objects.create(name='lamp2')
+
+        self.assertEqual(list(self.building.subtree_lamps()), [lamp])
+        self.assertEqual(list(self.room.subtree_lamps()), [lamp])
+
+    def test_move(self):
+        Lamp.objects.create(name='lamp1', group=self.room, is_on=True,
+                            brightness=40)
+        LampGroup.objects.rebuild_counters()
+        other_building = LampGroup.objects.create(name='other building')
+
+        self.floor.refresh_from_db()
+        self.floor.parent = other_building
+        self.floor.save()
+
+        self.room.refresh_from_db()
+        self.assertEqual(
+            self.room.path,
+            f'/{other_building.pk}/{self.floor.pk}/{self.room.pk}/')
+        self.building.refresh_from_db()
+        self.assertEqual(self.building.lamp_count, 0)
+        other_building.refresh_from_db()
+        self.assertEqual(other_building.lamp_count, 1)
+        self.assertEqual(other_building.average_brightness, 40)
+
+    def test_move_to_subtree(self):
+        self.building.parent = self.room
+
+        with self.assertRaises(ValidationError):
+            self.building.full_clean()
+
+    def test_rebuild_counters(self):
+        Lamp.objects.create(name='lamp1', group=self.room, is_on=True,
+                            brightness=40)
+        Lamp.objects.create(name='lamp2', group=self.floor, is_on=True,
+                            brightness=60)
+        Lamp.objects.create(name='lamp3', group=self.floor)
+
+        drifted = LampGroup.objects.rebuild_counters()
+
+        self.assertEqual(len(drifted), 3)
+        self.building.refresh_from_db()
+        self.assertEqual(self.building.lamp_count, 3)
+        self.assertEqual(self.building.on_count, 2)
+        self.assertEqual(self.building.average_brightness, 50)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.lamp_count, 1)
+        self.assertEqual(LampGroup.objects.rebuild_counters(), [])
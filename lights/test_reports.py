@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.test import TestCase
+from django.utils import timezone
+
+from .models import DailyLampUsage, Lamp
+from .reports import working_time_report
+
+
+START = datetime(2019, 3, 1, tzinfo=timezone.utc)
+
+
+class WorkingTimeReportTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('lights.reports.timezone.now',
+                             return_value=START + timedelta(days=10))
+        self.mock_now = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.lamp = Lamp.objects.create(name='lamp1')
+
+    def add_period(self, start_hours, end_hours, brightness=100):
+        return self.lamp.periods.create(
+            brightness=brightness,
+            start=START + timedelta(hours=start_hours),
+            end=(START + timedelta(hours=end_hours)
+                 if end_hours is not None
+                 else None))
+
+    def test_buckets(self):
+        self.add_period(1, 2)
+        self.add_period(3, 5, brightness=50)
+        self.add_period(26, 27)
+
+        report = working_time_report(START, START + timedelta(days=3))
+
+        self.assertEqual([bucket.start for bucket in report],
+                         [START + timedelta(days=i) for i in range(3)])
+        self.assertEqual([bucket.working_time for bucket in report],
+                         [timedelta(hours=3), timedelta(hours=1), timedelta()])
+        self.assertEqual(report[0].weighted_working_time, timedelta(hours=2))
+
+    def test_spanning_period(self):
+        """Period is split between buckets and clipped to window."""
+        self.add_period(-2, 50, brightness=50)
+
+        report = working_time_report(START, START + timedelta(days=2))
+
+        self.assertEqual([bucket.working_time for bucket in report],
+                         [timedelta(hours=24), timedelta(hours=24)])
+        self.assertEqual(report[1].weighted_working_time,
+                         timedelta(hours=12))
+
+    def test_active_period(self):
+        """Active period lasts till now."""
+        self.add_period(1, None)
+        self.mock_now.return_value = START + timedelta(hours=3)
+
+        report = working_time_report(START, START + timedelta(hours=5),
+                                     bucket='hour')
+
+        self.assertEqual([bucket.working_time for bucket in report],
+                         [timedelta(), timedelta(hours=1),
+                          timedelta(hours=1), timedelta(), timedelta()])
+
+    def test_lamp_filter(self):
+        self.add_period(1, 2)
+        other_lamp = Lamp.objects.create(name='lamp2')
+        other_lamp.periods.create(brightness=100,
+                                  start=START,
+                                  end=START + timedelta(hours=1))
+
+        report = working_time_report(START, START + timedelta(days=1),
+                                     lamp_ids=[other_lamp.pk])
+
+        self.assertEqual(report[0].working_time, timedelta(hours=1))
+
+    @timezone.override(timezone.utc)
+    def test_daily_usage(self):
+        """Closed periods are read from daily usage for aligned days."""
+        DailyLampUsage.objects.create(lamp=self.lamp,
+                                      date=START.date(),
+                                      working_microseconds=3600 * 10**6,
+                                      weighted_microseconds=1800 * 10**6)
+        self.add_period(1, 2)
+        # Active period isn't rolled up
+        self.add_period(26, None, brightness=10)
+        self.mock_now.return_value = START + timedelta(hours=27)
+
+        report = working_time_report(START, START + timedelta(days=2))
+
+        self.assertEqual(
+            [(bucket.working_time, bucket.weighted_working_time)
+             for bucket in report],
+            [(timedelta(hours=1), timedelta(minutes=30)),
+             (timedelta(hours=1), timedelta(minutes=6))])
+
+    @timezone.override(timezone.utc)
+    def test_daily_usage_partial_day(self):
+        """Daily usage isn't used for a day partially in the window."""
+        for day, hours in [(0, 2), (1, 4)]:
+            DailyLampUsage.objects.create(
+                lamp=self.lamp,
+                date=(START + timedelta(days=day)).date(),
+                working_microseconds=hours * 3600 * 10**6,
+                weighted_microseconds=hours * 3600 * 10**6)
+        self.add_period(1, 2)
+        # Partially rolled up
+        self.add_period(23, 25)
+        self.add_period(34, 35)
+        # After the window end
+        self.add_period(42, 44)
+
+        report = working_time_report(START, START + timedelta(hours=36))
+
+        self.assertEqual([bucket.working_time for bucket in report],
+                         [timedelta(hours=2), timedelta(hours=2)])
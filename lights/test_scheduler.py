@@ -0,0 +1,163 @@
+from datetime import datetime
+from unittest import mock
+
+from django.test import TestCase
+from django.utils import timezone
+
+from .cron import CronExpression
+from .models import Lamp, LampGroup, Schedule
+from .scheduler import Scheduler
+from .services import LampService
+from .switch import Switch
+
+
+def local(*args):
+    return timezone.make_aware(datetime(*args))
+
+
+class CronExpressionTests(TestCase):
+
+    def test_next_after(self):
+        # Friday
+        moment = local(2019, 3, 1, 8, 0)
+        cases = [
+            ('30 7 * * 1-5', local(2019, 3, 4, 7, 30)),
+            ('*/15 8,20 * * *', local(2019, 3, 1, 8, 15)),
+            ('0 9-17/4 * * *', local(2019, 3, 1, 9, 0)),
+            ('0 0 * * 0', local(2019, 3, 3)),
+            ('0 0 * * 7', local(2019, 3, 3)),
+            ('0 0 1 * *', local(2019, 4, 1)),
+            # Either day of month or of week
+            ('0 0 10 * 6', local(2019, 3, 2)),
+            ('0 0 29 2 *', local(2020, 2, 29)),
+        ]
+        for expression, expected in cases:
+            with self.subTest(expression):
+                self.assertEqual(CronExpression(expression).next_after(moment),
+                                 expected)
+
+    def test_next_after_skips_current_minute(self):
+        expression = CronExpression('* * * * *')
+
+        self.assertEqual(expression.next_after(local(2019, 3, 1, 8, 0, 30)),
+                         local(2019, 3, 1, 8, 1))
+
+    def test_never(self):
+        expression = CronExpression('0 0 31 2 *')
+
+        self.assertIsNone(expression.next_after(local(2019, 3, 1)))
+
+    def test_invalid(self):
+        for expression in ['* * * *', '60 * * * *', '*/0 * * * *',
+                           '5-1 * * * *', 'x * * * *']:
+            with self.subTest(expression):
+                with self.assertRaises(ValueError):
+                    CronExpression(expression)
+
+
+class SchedulerTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('django.utils.timezone.now',
+                             return_value=local(2019, 3, 1, 7, 59))
+        self.mock_now = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.lamps = [Lamp.objects.create(name=f'lamp{i}') for i in range(3)]
+
+    def create_schedule(self, cron='0 8 * * *', *, lamps=None, **kwargs):
+        schedule = Schedule.objects.create(name=cron, cron=cron, **kwargs)
+        schedule.lamps.set(self.lamps if lamps is None else lamps)
+        return schedule
+
+    def test_run_pending(self):
+        schedule = self.create_schedule(on=True, brightness=50)
+        scheduler = Scheduler(LampService(Switch()), batch_size=2)
+        scheduler.load()
+
+        self.assertEqual(scheduler.next_fire(), local(2019, 3, 1, 8, 0))
+        self.assertEqual(scheduler.run_pending(), 0)
+
+        self.mock_now.return_value = local(2019, 3, 1, 8, 0, 5)
+        self.assertEqual(scheduler.run_pending(), 1)
+
+        for lamp in self.lamps:
+            lamp.refresh_from_db()
+            self.assertTrue(lamp.is_on)
+            self.assertEqual(lamp.brightness, 50)
+        schedule.refresh_from_db()
+        self.assertEqual(schedule.last_fire, local(2019, 3, 1, 8, 0, 5))
+        self.assertEqual(schedule.next_fire, local(2019, 3, 2, 8, 0))
+        self.assertEqual(scheduler.next_fire(), schedule.next_fire)
+
+    def test_merge_changes(self):
+        self.lamps[0].is_on = True
+        self.lamps[0].save()
+        self.create_schedule(on=True, brightness=50)
+        self.create_schedule(brightness=70, lamps=self.lamps[:2])
+        service = mock.Mock()
+        scheduler = Scheduler(service)
+        scheduler.load()
+
+        self.mock_now.return_value = local(2019, 3, 1, 8, 0)
+        self.assertEqual(scheduler.run_pending(), 2)
+
+        changes, = service.set_lamps_mode.call_args[0]
+        self.assertEqual(
+            [(change.lamp.pk, change.on, change.brightness)
+             for change in changes],
+            [(self.lamps[0].pk, None, 70),
+             (self.lamps[1].pk, True, 70),
+             (self.lamps[2].pk, True, 50)])
+
+    def test_group(self):
+        floor = LampGroup.objects.create(name='floor')
+        room = LampGroup.objects.create(name='room', parent=floor)
+        Lamp.objects.filter(pk=self.lamps[1].pk).update(group=room)
+        schedule = self.create_schedule(on=True, lamps=self.lamps[:1])
+        schedule.groups.add(floor)
+        service = mock.Mock()
+        scheduler = Scheduler(service)
+        scheduler.load()
+
+        self.mock_now.return_value = local(2019, 3, 1, 8, 0)
+        scheduler.run_pending()
+
+        changes, = service.set_lamps_mode.call_args[0]
+        self.assertEqual([change.lamp.pk for change in changes],
+                         [lamp.pk for lamp in self.lamps[:2]])
+
+    def test_refresh(self):
+        disabled = self.create_schedule(on=True)
+        scheduler = Scheduler(mock.Mock())
+        scheduler.load()
+        disabled.enabled = False
+        disabled.save()
+        created = self.create_schedule('0 9 * * *', on=False)
+        scheduler.refresh()
+
+        self.assertEqual(scheduler.next_fire(), created.next_fire)
+        self.mock_now.return_value = local(2019, 3, 1, 9, 0)
+        self.assertEqual(scheduler.run_pending(), 1)
+        created.refresh_from_db()
+        self.assertEqual(created.last_fire, local(2019, 3, 1, 9, 0))
+
+    def test_deleted(self):
+        schedule = self.create_schedule(on=True)
+        service = mock.Mock()
+        scheduler = Scheduler(service)
+        scheduler.load()
+        schedule.delete()
+
+        self.mock_now.return_value = local(2019, 3, 1, 8, 0)
+        self.assertEqual(scheduler.run_pending(), 0)
+        self.assertIsNone(scheduler.next_fire())
+        service.set_lamps_mode.assert_not_called()
+
+    def test_no_queries_until_due(self):
+        for hour in range(9, 20):
+            self.create_schedule(f'0 {hour} * * *', on=True)
+        scheduler = Scheduler(mock.Mock())
+        scheduler.load()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(scheduler.run_pending(), 0)
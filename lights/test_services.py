@@ -1,10 +1,27 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from io import StringIO
 from unittest import mock
 
-from django.test import TestCase
+from django.db import connection
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.utils import timezone
 
-from .models import Lamp
-from .services import ExternalError, LampService
-from .switch import Switch, SwitchError
+from .models import Lamp, LampCommand, LampGroup
+from .network_switch import NetworkSwitch, StandInController
+from .services import (
+    ExternalBatchError,
+    ExternalError,
+    LampModeChange,
+    LampService,
+    archive_periods,
+    close_abandoned_periods,
+    import_lamps,
+    update_group_counters,
+)
+from .switch import Switch, SwitchBatchError, SwitchCommand, SwitchError
 
 
 class LampServiceTests(TestCase):
@@ -20,8 +37,8 @@ class LampServiceTests(TestCase):
 
         self.service.set_lamp_mode(lamp, on=True)
 
-        self.mock_switch.turn_on.assert_called_once_with(lamp.pk)
-        self.mock_switch.set_brightness.assert_not_called()
+        self.mock_switch.execute.assert_called_once_with(
+            [SwitchCommand(lamp.pk, on=True)])
         lamp.refresh_from_db()
         self.assertEqual(lamp.is_on, True)
         self.assertIsNotNone(lamp.last_switch)
@@ -31,7 +48,8 @@ class LampServiceTests(TestCase):
 
         self.service.set_lamp_mode(lamp, on=False)
 
-        self.mock_switch.turn_off.assert_called_once_with(lamp.pk)
+        self.mock_switch.execute.assert_called_once_with(
+            [SwitchCommand(lamp.pk, on=False)])
         lamp.refresh_from_db()
         self.assertEqual(lamp.is_on, False)
         self.assertIsNotNone(lamp.last_switch)
@@ -41,11 +59,8 @@ class LampServiceTests(TestCase):
         new_brightness = lamp.brightness + 10
         self.service.set_lamp_mode(lamp, brightness=new_brightness)
 
-        self.mock_switch.set_brightness.assert_called_once_with(
-            lamp_id=lamp.pk,
-            brightness=new_brightness)
-        self.mock_switch.turn_on.assert_not_called()
-        self.mock_switch.turn_off.assert_not_called()
+        self.mock_switch.execute.assert_called_once_with(
+            [SwitchCommand(lamp.pk, brightness=new_brightness)])
         lamp.refresh_from_db()
         self.assertEqual(lamp.brightness, new_brightness)
         self.assertIsNone(lamp.last_switch)
@@ -98,10 +113,96 @@ class LampServiceTests(TestCase):
         second_period = lamp.periods.latest('start')
         self.assertNotEqual(second_period.pk, first_period.pk)
 
+    def test_turn_on_with_brightness(self):
+        """Power and brightness should be sent in one command."""
+        lamp = Lamp.objects.create(name='the lamp')
+
+        self.service.set_lamp_mode(lamp, on=True, brightness=40)
+
+        self.mock_switch.execute.assert_called_once_with(
+            [SwitchCommand(lamp.pk, on=True, brightness=40)])
+
+    def test_closed_working_time_counter(self):
+        lamp = Lamp.objects.create(name='the lamp')
+        self.service.set_lamp_mode(lamp, on=True)
+        self.service.set_lamp_mode(lamp, brightness=20)
+        self.service.set_lamp_mode(lamp, on=False)
+
+        expected = sum((period.duration for period in lamp.periods.all()),
+                       timedelta())
+        self.assertEqual(lamp.closed_working_time, expected)
+        lamp.refresh_from_db()
+        self.assertEqual(lamp.closed_working_time, expected)
+
+    def test_daily_usage(self):
+        lamp = Lamp.objects.create(name='the lamp', brightness=50)
+        self.service.set_lamp_mode(lamp, on=True)
+        self.service.set_lamp_mode(lamp, on=False)
+
+        usage = lamp.daily_usage.get()
+        self.assertEqual(usage.date, timezone.localdate(lamp.last_switch))
+        self.assertEqual(usage.working_microseconds,
+                         lamp.closed_working_microseconds)
+        self.assertEqual(usage.weighted_microseconds,
+                         lamp.closed_working_microseconds // 2)
+
+    def test_turn_off_twice(self):
+        """Closed period should not be closed again."""
+        lamp = Lamp.objects.create(name='the lamp')
+        self.service.set_lamp_mode(lamp, on=True)
+        self.service.set_lamp_mode(lamp, on=False)
+        period = lamp.periods.get()
+        counter = lamp.closed_working_microseconds
+
+        self.service.set_lamp_mode(lamp, on=False)
+
+        lamp.refresh_from_db()
+        self.assertEqual(lamp.closed_working_microseconds, counter)
+        self.assertEqual(lamp.periods.get().end, period.end)
+
+    def test_no_change(self):
+        lamp = Lamp.objects.create(name='the lamp', brightness=50)
+        self.service.set_lamp_mode(lamp, on=True)
+        self.mock_switch.execute.reset_mock()
+
+        # Lock only, plus savepoint queries
+        with self.assertNumQueries(3):
+            self.service.set_lamp_mode(lamp, on=True, brightness=50)
+
+        self.mock_switch.execute.assert_not_called()
+        self.assertEqual(lamp.periods.count(), 1)
+
+    def test_stale_instance(self):
+        """Change should be applied to the latest mode of the lamp."""
+        lamp = Lamp.objects.create(name='the lamp')
+        stale_lamp = Lamp.objects.get(pk=lamp.pk)
+        self.service.set_lamp_mode(lamp, on=True)
+
+        self.service.set_lamp_mode(stale_lamp, on=True)
+
+        self.assertTrue(stale_lamp.is_on)
+        self.assertEqual(self.mock_switch.execute.call_count, 1)
+        self.assertEqual(lamp.periods.count(), 1)
+
+    def test_partial_change(self):
+        """Only changed parameters should be sent and saved."""
+        lamp = Lamp.objects.create(name='the lamp', brightness=50)
+        self.service.set_lamp_mode(lamp, on=True)
+        period = lamp.periods.get()
+
+        self.service.set_lamp_mode(lamp, on=True, brightness=60)
+
+        self.mock_switch.execute.assert_called_with(
+            [SwitchCommand(lamp.pk, brightness=60)])
+        self.assertEqual(lamp.periods.count(), 2)
+        self.assertEqual(lamp.periods.latest('start').brightness, 60)
+        self.assertEqual(Lamp.objects.get(pk=lamp.pk).last_switch,
+                         period.start)
+
     def test_switch_error(self):
         lamp = Lamp.objects.create(name='the lamp')
 
-        self.mock_switch.turn_on.side_effect = SwitchError('switch error')
+        self.mock_switch.execute.side_effect = SwitchError('switch error')
         with self.assertRaises(ExternalError):
             self.service.set_lamp_mode(lamp, on=True)
 
@@ -116,6 +217,834 @@ class LampServiceTests(TestCase):
         self.assertEqual(lamp.is_on, True)
 
 
-# TODO: no change - switch on, switch on
+class LampServiceBulkTests(TestCase):
+
+    def setUp(self):
+        self.mock_switch = mock.create_autospec(Switch,
+                                                spec_set=True,
+                                                instance=True)
+        self.service = LampService(self.mock_switch)
+        self.lamps = [Lamp.objects.create(name=f'lamp{i}', brightness=50)
+                      for i in range(3)]
+
+    def test_turn_on(self):
+        self.service.set_lamps_mode(LampModeChange(lamp, on=True)
+                                    for lamp in self.lamps)
+
+        self.mock_switch.execute.assert_called_once_with(
+            [SwitchCommand(lamp.pk, on=True) for lamp in self.lamps])
+        for lamp in self.lamps:
+            self.assertEqual(lamp.is_on, True)
+            lamp.refresh_from_db()
+            self.assertEqual(lamp.is_on, True)
+            period = lamp.periods.get()
+            self.assertEqual(period.brightness, 50)
+            self.assertEqual(period.start, lamp.last_switch)
+            self.assertIsNone(period.end)
+
+    def test_turn_off(self):
+        self.service.set_lamps_mode(LampModeChange(lamp, on=True)
+                                    for lamp in self.lamps)
+        self.service.set_lamps_mode(LampModeChange(lamp, on=False)
+                                    for lamp in self.lamps)
+
+        for lamp in self.lamps:
+            period = lamp.periods.get()
+            lamp.refresh_from_db()
+            self.assertEqual(lamp.is_on, False)
+            self.assertEqual(period.end, lamp.last_switch)
+            self.assertEqual(lamp.closed_working_time, period.duration)
+
+    def test_change_brightness(self):
+        lamp_on, lamp_off = self.lamps[:2]
+        self.service.set_lamp_mode(lamp_on, on=True)
+
+        self.service.set_lamps_mode([
+            LampModeChange(lamp_on, brightness=20),
+            LampModeChange(lamp_off, brightness=30)])
+
+        self.assertEqual(
+            list(lamp_on.periods.order_by('start')
+                 .values_list('brightness', flat=True)),
+            [50, 20])
+        self.assertIsNone(lamp_on.periods.latest('start').end)
+        self.assertEqual(lamp_off.periods.count(), 0)
+        lamp_off.refresh_from_db()
+        self.assertEqual(lamp_off.brightness, 30)
+
+    def test_mixed(self):
+        self.service.set_lamp_mode(self.lamps[0], on=True)
+
+        self.service.set_lamps_mode([
+            LampModeChange(self.lamps[0], on=False),
+            LampModeChange(self.lamps[1], on=True, brightness=10)])
+
+        self.mock_switch.execute.assert_called_with([
+            SwitchCommand(self.lamps[0].pk, on=False),
+            SwitchCommand(self.lamps[1].pk, on=True, brightness=10)])
+        self.assertIsNotNone(self.lamps[0].periods.get().end)
+        self.assertEqual(self.lamps[1].periods.get().brightness, 10)
+
+    def test_no_change(self):
+        lamp_on, lamp_off = self.lamps[:2]
+        self.service.set_lamp_mode(lamp_on, on=True)
+        self.mock_switch.execute.reset_mock()
+
+        self.service.set_lamps_mode([
+            LampModeChange(lamp_on, on=True),
+            LampModeChange(lamp_off, on=False, brightness=30)])
+
+        self.mock_switch.execute.assert_called_once_with(
+            [SwitchCommand(lamp_off.pk, brightness=30)])
+        self.assertEqual(lamp_on.periods.count(), 1)
+
+        # Lock only, plus savepoint queries
+        with self.assertNumQueries(3):
+            self.service.set_lamps_mode([LampModeChange(lamp_on, on=True)])
+
+    def test_query_count(self):
+        """Number of queries shouldn't depend on number of lamps."""
+        lamps = [Lamp.objects.create(name=f'other lamp{i}')
+                 for i in range(10)]
+        self.service.set_lamps_mode(LampModeChange(lamp, on=True)
+                                    for lamp in lamps)
+
+        # Lock lamps, update lamps, select periods, update periods,
+        # update counters, create/select/update daily usage, create
+        # periods, confirm state, create events, plus savepoint queries
+        # (of the transaction and the one for rolling back failed lamps)
+        with self.assertNumQueries(15):
+            self.service.set_lamps_mode(
+                LampModeChange(lamp, brightness=10) for lamp in lamps)
+
+    def test_switch_error(self):
+        self.mock_switch.execute.side_effect = SwitchBatchError(
+            {self.lamps[1].pk: 'error'})
+
+        with self.assertRaises(ExternalBatchError) as cm:
+            self.service.set_lamps_mode(LampModeChange(lamp, on=True)
+                                        for lamp in self.lamps)
+
+        self.assertEqual(cm.exception.errors, {self.lamps[1].pk: 'error'})
+        # Only the failed lamp is rolled back
+        for lamp, is_on in zip(self.lamps, [True, False, True]):
+            self.assertEqual(lamp.is_on, is_on)
+            lamp.refresh_from_db()
+            self.assertEqual(lamp.is_on, is_on)
+            self.assertEqual(lamp.actual_is_on, is_on or None)
+            self.assertEqual(lamp.periods.count(), int(is_on))
+            self.assertEqual(lamp.events.count(), int(is_on))
+
+    def test_switch_error_all(self):
+        self.mock_switch.execute.side_effect = SwitchError()
+
+        with self.assertRaises(ExternalError) as cm:
+            self.service.set_lamps_mode(LampModeChange(lamp, on=True)
+                                        for lamp in self.lamps)
+
+        self.assertNotIsInstance(cm.exception, ExternalBatchError)
+        for lamp in self.lamps:
+            # Instance is restored
+            self.assertEqual(lamp.is_on, False)
+            self.assertIsNone(lamp.last_switch)
+            lamp.refresh_from_db()
+            self.assertEqual(lamp.is_on, False)
+            self.assertEqual(lamp.periods.count(), 0)
+
+    def test_network_switch_batches(self):
+        """Batches for a controller are sent in parallel."""
+        controller = StandInController(delay=0.2)
+        address = controller.start()
+        self.addCleanup(controller.stop)
+        switch = NetworkSwitch([{'address': address}], max_connections=4)
+        self.addCleanup(switch.close)
+        self.service = LampService(switch)
+        self.service.switch_batch_size = 1
+
+        started = time.monotonic()
+        self.service.set_lamps_mode(LampModeChange(lamp, on=True)
+                                    for lamp in self.lamps)
+
+        self.assertLess(time.monotonic() - started, 0.35)
+        self.assertEqual(controller.request_count, 3)
+
+    def test_switch_batches(self):
+        self.service.switch_batch_size = 2
+
+        def execute(commands):
+            if len(commands) == 1:
+                raise SwitchError()
+
+        self.mock_switch.execute.side_effect = execute
+        for lamp in self.lamps:
+            lamp.is_on = True
+            lamp.save()
+            lamp.periods.create(brightness=50,
+                                start=timezone.now() - timedelta(hours=1))
+
+        with self.assertRaises(ExternalBatchError) as cm:
+            self.service.set_lamps_mode(LampModeChange(lamp, on=False)
+                                        for lamp in self.lamps)
+
+        self.assertEqual(self.mock_switch.execute.call_count, 2)
+        self.assertEqual(list(cm.exception.errors), [self.lamps[2].pk])
+        for lamp, is_on in zip(self.lamps, [False, False, True]):
+            lamp.refresh_from_db()
+            self.assertEqual(lamp.is_on, is_on)
+            self.assertEqual(lamp.closed_working_microseconds > 0, not is_on)
+
+
+class LampServiceGroupTests(TestCase):
+
+    def setUp(self):
+        self.mock_switch = mock.create_autospec(Switch,
+                                                spec_set=True,
+                                                instance=True)
+        self.service = LampService(self.mock_switch)
+        self.floor = LampGroup.objects.create(name='floor')
+        self.room = LampGroup.objects.create(name='room', parent=self.floor)
+        self.lamps = [Lamp.objects.create(name=f'lamp{i}',
+                                          brightness=50,
+                                          group=self.room)
+                      for i in range(3)]
+        LampGroup.objects.rebuild_counters()
+
+    def assert_counters(self, group, lamp_count, on_count, brightness):
+        group.refresh_from_db()
+        self.assertEqual(group.lamp_count, lamp_count)
+        self.assertEqual(group.on_count, on_count)
+        self.assertEqual(group.average_brightness, brightness)
+
+    def test_counters(self):
+        self.service.set_lamp_mode(self.lamps[0], on=True)
+        self.service.set_lamps_mode([LampModeChange(self.lamps[1], on=True,
+                                                    brightness=70)])
+
+        self.assert_counters(self.room, 3, 2, 60)
+        self.assert_counters(self.floor, 3, 2, 60)
+
+        self.service.request_lamp_mode(self.lamps[1], on=False)
+
+        self.assert_counters(self.floor, 3, 1, 50)
+        self.assertEqual(LampGroup.objects.rebuild_counters(), [])
+
+    def test_counters_after_switch(self):
+        """Group rows aren't locked while the switch is called."""
+        on_counts = []
+
+        def check_counters(commands):
+            on_counts.append(
+                LampGroup.objects.get(pk=self.floor.pk).on_count)
+        self.mock_switch.execute.side_effect = check_counters
+
+        self.service.set_lamp_mode(self.lamps[0], on=True)
+        self.service.set_lamps_mode([LampModeChange(self.lamps[1], on=True)])
+
+        self.assertEqual(on_counts, [0, 1])
+
+        self.assertEqual(self.mock_switch.execute.call_count, 2)
+        self.assert_counters(self.floor, 3, 2, 50)
+
+    def test_counters_switch_error(self):
+        self.mock_switch.execute.side_effect = SwitchBatchError(
+            {self.lamps[0].pk: 'error'})
+
+        with self.assertRaises(ExternalBatchError):
+            self.service.set_lamps_mode(LampModeChange(lamp, on=True)
+                                        for lamp in self.lamps[:2])
+
+        self.assert_counters(self.floor, 3, 1, 50)
+        self.assertEqual(LampGroup.objects.rebuild_counters(), [])
+
+    def test_no_group_queries(self):
+        lamp = Lamp.objects.create(name='ungrouped')
+
+        with self.assertNumQueries(0):
+            update_group_counters([(None, False, 100)], [(None, True, 100)])
+        self.service.set_lamp_mode(lamp, on=True)
+        self.assertEqual(LampGroup.objects.rebuild_counters(), [])
+
+    def test_set_group_mode(self):
+        self.service.set_lamp_mode(self.lamps[0], on=True)
+        self.mock_switch.reset_mock()
+        self.service.switch_batch_size = 1
+
+        lamps = self.service.set_group_mode(self.floor, on=True)
+
+        self.assertEqual(lamps, self.lamps)
+        # Lamp 0 is on already
+        # Batches are sent concurrently
+        self.assertCountEqual(self.mock_switch.execute.call_args_list,
+                              [mock.call([SwitchCommand(lamp.pk, on=True)])
+                               for lamp in self.lamps[1:]])
+        for lamp in self.lamps:
+            lamp.refresh_from_db()
+            self.assertTrue(lamp.is_on)
+            self.assertEqual(lamp.periods.count(), 1)
+        self.assert_counters(self.floor, 3, 3, 50)
+
+    def test_set_group_mode_error(self):
+        self.mock_switch.execute.side_effect = SwitchError()
+
+        with self.assertRaises(ExternalError):
+            self.service.set_group_mode(self.room, brightness=10)
+
+        self.assertFalse(Lamp.objects.filter(brightness=10).exists())
+        self.assert_counters(self.room, 3, 0, None)
+
+
+class LampServiceQueueTests(TestCase):
+
+    def setUp(self):
+        self.mock_switch = mock.create_autospec(Switch,
+                                                spec_set=True,
+                                                instance=True)
+        self.service = LampService(self.mock_switch)
+
+    def test_request_lamp_mode(self):
+        lamp = Lamp.objects.create(name='the lamp')
+
+        self.service.request_lamp_mode(lamp, on=True, brightness=30)
+
+        self.mock_switch.execute.assert_not_called()
+        lamp.refresh_from_db()
+        self.assertEqual((lamp.is_on, lamp.brightness), (True, 30))
+        self.assertIsNone(lamp.actual_is_on)
+        self.assertIsNone(lamp.periods.get().end)
+        command = lamp.commands.get()
+        self.assertEqual((command.on, command.brightness), (True, 30))
+        self.assertEqual(command.status, LampCommand.PENDING)
+
+    def test_request_lamps_mode(self):
+        lamps = [Lamp.objects.create(name=f'lamp{i}') for i in range(3)]
+
+        self.service.request_lamps_mode(LampModeChange(lamp, on=True)
+                                        for lamp in lamps)
+
+        self.mock_switch.execute.assert_not_called()
+        self.assertEqual(LampCommand.objects.count(), 3)
+        self.assertEqual(Lamp.objects.filter(is_on=True).count(), 3)
+
+    def test_request_no_change(self):
+        lamp = Lamp.objects.create(name='the lamp')
+
+        self.service.request_lamp_mode(lamp, on=False)
+        self.service.request_lamps_mode([LampModeChange(lamp, on=False)])
+
+        self.assertFalse(lamp.commands.exists())
+
+    def test_process_commands(self):
+        lamp = Lamp.objects.create(name='the lamp')
+        self.service.request_lamp_mode(lamp, on=True)
+        self.service.request_lamp_mode(lamp, brightness=40)
+
+        processed = self.service.process_commands('worker')
+
+        self.assertEqual(processed, 2)
+        # Desired state is applied once for multiple commands
+        self.mock_switch.execute.assert_called_once_with(
+            [SwitchCommand(lamp.pk, on=True, brightness=40)])
+        lamp.refresh_from_db()
+        self.assertEqual((lamp.actual_is_on, lamp.actual_brightness),
+                         (True, 40))
+        self.assertTrue(lamp.is_confirmed)
+        self.assertFalse(LampCommand.objects.exists())
+        self.assertEqual(self.service.process_commands('worker'), 0)
+
+    def test_events(self):
+        """Requested and confirmed states are recorded as events."""
+        lamp = Lamp.objects.create(name='the lamp')
+        self.service.request_lamp_mode(lamp, on=True)
+        self.service.process_commands('worker')
+
+        self.assertEqual(
+            list(lamp.events.order_by('pk')
+                 .values_list('is_on', 'actual_is_on')),
+            [(True, None), (True, True)])
+
+    def test_process_commands_batch_error(self):
+        lamps = [Lamp.objects.create(name=f'lamp{i}') for i in range(2)]
+        self.service.request_lamps_mode(LampModeChange(lamp, on=True)
+                                        for lamp in lamps)
+        self.mock_switch.execute.side_effect = SwitchBatchError(
+            {lamps[1].pk: 'error'})
+
+        self.service.process_commands('worker')
+
+        lamps[0].refresh_from_db()
+        self.assertTrue(lamps[0].is_confirmed)
+        lamps[1].refresh_from_db()
+        self.assertIsNone(lamps[1].actual_is_on)
+        command = LampCommand.objects.get()
+        self.assertEqual(command.lamp, lamps[1])
+        self.assertEqual(command.status, LampCommand.PENDING)
+        self.assertEqual(command.attempts, 1)
+        self.assertEqual(command.error, 'error')
+
+    def test_process_commands_failed(self):
+        lamp = Lamp.objects.create(name='the lamp')
+        self.service.request_lamp_mode(lamp, on=True)
+        self.mock_switch.execute.side_effect = SwitchError('error')
+
+        for _ in range(self.service.max_command_attempts):
+            self.service.process_commands('worker')
+
+        command = lamp.commands.get()
+        self.assertEqual(command.status, LampCommand.FAILED)
+        self.assertEqual(self.service.process_commands('worker'), 0)
+
+    def test_reconcile(self):
+        confirmed_lamp = Lamp.objects.create(name='confirmed',
+                                             actual_is_on=False,
+                                             actual_brightness=100)
+        unconfirmed_lamp = Lamp.objects.create(name='unconfirmed',
+                                               is_on=True,
+                                               actual_is_on=False,
+                                               actual_brightness=100)
+        unknown_lamp = Lamp.objects.create(name='unknown')
+        self.service.request_lamp_mode(confirmed_lamp, on=True)
+
+        queued = self.service.reconcile()
+
+        self.assertEqual(queued, 2)
+        self.assertEqual(
+            set(LampCommand.objects.values_list('lamp', flat=True)),
+            {confirmed_lamp.pk, unconfirmed_lamp.pk, unknown_lamp.pk})
+
+    def test_reconcile_stale(self):
+        lamp = Lamp.objects.create(name='the lamp')
+        LampCommand.objects.create(
+            lamp=lamp,
+            status=LampCommand.PROCESSING,
+            worker='dead worker',
+            claimed=timezone.now() - timedelta(hours=1))
+
+        self.service.reconcile()
+
+        command = lamp.commands.get()
+        self.assertEqual(command.status, LampCommand.PENDING)
+
+
+class LampServiceCoalesceTests(TestCase):
+
+    def setUp(self):
+        self.mock_switch = mock.create_autospec(Switch,
+                                                spec_set=True,
+                                                instance=True)
+        self.service = LampService(self.mock_switch,
+                                   coalesce_window=timedelta(seconds=10))
+
+    def test_change_brightness(self):
+        lamp = Lamp.objects.create(name='the lamp', brightness=50)
+        self.service.set_lamp_mode(lamp, on=True)
+
+        for brightness in [60, 70, 80]:
+            self.service.set_lamp_mode(lamp, brightness=brightness)
+
+        period = lamp.periods.get()
+        self.assertEqual(period.brightness, 80)
+        self.assertIsNone(period.end)
+        self.assertEqual(self.mock_switch.execute.call_count, 4)
+
+    def test_change_brightness_after_window(self):
+        lamp = Lamp.objects.create(name='the lamp', brightness=50)
+        self.service.set_lamp_mode(lamp, on=True)
+        lamp.periods.update(start=F('start') - timedelta(seconds=11))
+
+        self.service.set_lamp_mode(lamp, brightness=60)
+
+        self.assertEqual(
+            list(lamp.periods.order_by('start')
+                 .values_list('brightness', flat=True)),
+            [50, 60])
+
+    def test_change_brightness_bulk(self):
+        lamps = [Lamp.objects.create(name=f'lamp{i}', brightness=50)
+                 for i in range(3)]
+        self.service.set_lamps_mode(LampModeChange(lamp, on=True)
+                                    for lamp in lamps[:2])
+        lamps[1].periods.update(start=F('start') - timedelta(seconds=11))
+
+        self.service.set_lamps_mode(LampModeChange(lamp, brightness=70)
+                                    for lamp in lamps)
+
+        self.assertEqual(
+            list(lamps[0].periods.values_list('brightness', flat=True)),
+            [70])
+        self.assertEqual(
+            list(lamps[1].periods.order_by('start')
+                 .values_list('brightness', flat=True)),
+            [50, 70])
+        self.assertEqual(lamps[2].periods.count(), 0)
+
+    def test_request_lamp_mode(self):
+        lamp = Lamp.objects.create(name='the lamp', brightness=50)
+
+        self.service.request_lamp_mode(lamp, on=True)
+        self.service.request_lamp_mode(lamp, brightness=60)
+        self.service.request_lamps_mode([LampModeChange(lamp, brightness=70)])
+
+        command = lamp.commands.get()
+        self.assertEqual(command.status, LampCommand.PENDING)
+        self.assertEqual(lamp.periods.get().brightness, 70)
+        self.service.process_commands('worker')
+        self.mock_switch.execute.assert_called_once_with(
+            [SwitchCommand(lamp.pk, on=True, brightness=70)])
+
+    def test_request_after_processed(self):
+        lamp = Lamp.objects.create(name='the lamp')
+        self.service.request_lamp_mode(lamp, on=True)
+        self.service.process_commands('worker')
+
+        self.service.request_lamp_mode(lamp, brightness=60)
+
+        self.assertEqual(lamp.commands.get().brightness, 60)
+
+
+class ArchivePeriodsTests(TestCase):
+
+    def setUp(self):
+        self.lamp = Lamp.objects.create(name='the lamp')
+        self.cutoff = datetime(2019, 2, 1, tzinfo=timezone.utc)
+        for day in [1, 2, 3]:
+            self.lamp.periods.create(
+                brightness=50,
+                start=datetime(2019, 1, day, 10, tzinfo=timezone.utc),
+                end=datetime(2019, 1, day, 11, tzinfo=timezone.utc))
+        self.recent_period = self.lamp.periods.create(
+            brightness=50,
+            start=datetime(2019, 2, 1, 10, tzinfo=timezone.utc),
+            end=datetime(2019, 2, 1, 11, tzinfo=timezone.utc))
+        Lamp.objects.rebuild_closed_working_time()
+
+    def test_archive(self):
+        export_file = StringIO()
+
+        count = archive_periods(self.cutoff, batch_size=2,
+                                export_file=export_file)
+
+        self.assertEqual(count, 3)
+        self.assertEqual(list(self.lamp.periods.all()), [self.recent_period])
+        self.lamp.refresh_from_db()
+        self.assertEqual(self.lamp.archived_working_microseconds,
+                         3 * 3600 * 10**6)
+        self.assertEqual(self.lamp.archived_until, self.cutoff)
+        self.assertEqual(self.lamp.closed_working_time, timedelta(hours=4))
+        # Header and 3 periods
+        self.assertEqual(len(export_file.getvalue().splitlines()), 4)
+
+    def test_rebuild_after_archive(self):
+        with timezone.override(timezone.utc):
+            Lamp.objects.rebuild_daily_usage()
+            archive_periods(self.cutoff)
+            Lamp.objects.rebuild_daily_usage()
+
+        self.assertEqual(Lamp.objects.rebuild_closed_working_time(), [])
+        self.assertEqual(self.lamp.daily_usage.count(), 4)
+
+
+class CloseAbandonedPeriodsTests(TestCase):
+
+    def setUp(self):
+        self.lamps = [Lamp.objects.create(name=f'lamp{i}') for i in range(3)]
+        lamp, other_lamp, _ = self.lamps
+        for hour in [10, 12, 14]:
+            # Abandoned, abandoned, active
+            lamp.periods.create(
+                brightness=50,
+                start=datetime(2019, 1, 1, hour, tzinfo=timezone.utc))
+        self.closed_period = other_lamp.periods.create(
+            brightness=50,
+            start=datetime(2019, 1, 1, 10, tzinfo=timezone.utc),
+            end=datetime(2019, 1, 1, 11, tzinfo=timezone.utc))
+        other_lamp.periods.create(
+            brightness=50,
+            start=datetime(2019, 1, 1, 12, tzinfo=timezone.utc))
+        Lamp.objects.rebuild_closed_working_time()
+
+    def test_close(self):
+        lamp = self.lamps[0]
+
+        with timezone.override(timezone.utc):
+            periods = close_abandoned_periods(chunk_size=2)
+
+        self.assertEqual(
+            [(period.lamp_id, period.start.hour, period.end.hour)
+             for period in periods],
+            [(lamp.pk, 10, 12), (lamp.pk, 12, 14)])
+        self.assertEqual(
+            list(lamp.periods.order_by('start')
+                 .values_list('end', flat=True)),
+            [period.end for period in periods] + [None])
+        lamp.refresh_from_db()
+        self.assertEqual(lamp.closed_working_time, timedelta(hours=4))
+        self.assertEqual(
+            lamp.daily_usage.get().working_microseconds, 4 * 3600 * 10**6)
+        self.assertEqual(Lamp.objects.rebuild_closed_working_time(), [])
+        self.assertEqual(close_abandoned_periods(), [])
+
+    def test_dry_run(self):
+        periods = close_abandoned_periods(dry_run=True)
+
+        self.assertEqual(len(periods), 2)
+        self.assertEqual(
+            self.lamps[0].periods.filter(end__isnull=True).count(), 3)
+        self.assertEqual(Lamp.objects.rebuild_closed_working_time(), [])
+
+
+class ImportLampsTests(TestCase):
+
+    def test_create(self):
+        result = import_lamps([{'name': 'lamp1'},
+                               {'name': 'lamp2', 'brightness': '50'},
+                               {'name': 'lamp3', 'brightness': 20}],
+                              chunk_size=2)
+
+        self.assertEqual(result.created, 3)
+        self.assertEqual(result.conflicts, [])
+        self.assertEqual(
+            list(Lamp.objects.order_by('name')
+                 .values_list('name', 'brightness')),
+            [('lamp1', 100), ('lamp2', 50), ('lamp3', 20)])
+
+    def test_conflicts(self):
+        Lamp.objects.create(name='lamp1', brightness=10)
+        Lamp.objects.create(name='lamp2', brightness=10)
+
+        result = import_lamps([{'name': 'lamp1', 'brightness': 10},
+                               {'name': 'lamp2', 'brightness': 20},
+                               {'name': 'lamp3'},
+                               {'name': 'lamp3'},
+                               {'name': 'lamp4', 'brightness': 0},
+                               {'brightness': 10}])
+
+        self.assertEqual((result.created, result.updated, result.unchanged),
+                         (1, 0, 1))
+        self.assertEqual([(row_number, name)
+                          for row_number, name, reason in result.conflicts],
+                         [(2, 'lamp2'), (4, 'lamp3'), (5, 'lamp4'), (6, '')])
+        self.assertEqual(Lamp.objects.get(name='lamp2').brightness, 10)
+
+    def test_update(self):
+        Lamp.objects.create(name='lamp1', brightness=10)
+        Lamp.objects.create(name='lamp2', brightness=10, is_on=True)
+
+        result = import_lamps([{'name': 'lamp1', 'brightness': 20},
+                               {'name': 'lamp2', 'brightness': 20}],
+                              update=True)
+
+        self.assertEqual(result.updated, 1)
+        self.assertEqual(result.conflicts, [(2, 'lamp2', 'lamp is on')])
+        self.assertEqual(
+            list(Lamp.objects.order_by('name')
+                 .values_list('brightness', flat=True)),
+            [20, 10])
+
+
+class LampServiceAfterCommitTests(TransactionTestCase):
+
+    def setUp(self):
+        self.mock_switch = mock.create_autospec(Switch,
+                                                spec_set=True,
+                                                instance=True)
+        self.service = LampService(self.mock_switch,
+                                   switch_after_commit=True)
+
+    def test_turn_on(self):
+        lamp = Lamp.objects.create(name='the lamp')
+
+        def check_committed(commands):
+            self.assertFalse(connection.in_atomic_block)
+            self.assertTrue(Lamp.objects.get(pk=lamp.pk).is_on)
+        self.mock_switch.execute.side_effect = check_committed
+
+        self.service.set_lamp_mode(lamp, on=True)
+
+        self.mock_switch.execute.assert_called_once_with(
+            [SwitchCommand(lamp.pk, on=True)])
+        lamp.refresh_from_db()
+        self.assertTrue(lamp.is_on)
+        self.assertTrue(lamp.is_confirmed)
+        self.assertIsNone(lamp.periods.get().end)
+
+    def test_turn_on_error(self):
+        lamp = Lamp.objects.create(name='the lamp')
+        self.mock_switch.execute.side_effect = SwitchError('switch error')
+
+        with self.assertRaises(ExternalError):
+            self.service.set_lamp_mode(lamp, on=True)
+
+        self.assertEqual(lamp.is_on, False)
+        lamp.refresh_from_db()
+        self.assertEqual(lamp.is_on, False)
+        self.assertIsNone(lamp.last_switch)
+        self.assertEqual(lamp.periods.count(), 0)
+        # Change and revert
+        self.assertEqual(
+            list(lamp.events.order_by('pk').values_list('is_on', flat=True)),
+            [True, False])
+
+    def test_turn_off_error(self):
+        lamp = Lamp.objects.create(name='the lamp')
+        self.service.set_lamp_mode(lamp, on=True)
+        self.mock_switch.execute.side_effect = SwitchError('switch error')
+
+        with self.assertRaises(ExternalError):
+            self.service.set_lamp_mode(lamp, on=False)
+
+        lamp.refresh_from_db()
+        self.assertEqual(lamp.is_on, True)
+        self.assertEqual(lamp.closed_working_microseconds, 0)
+        self.assertIsNone(lamp.periods.get().end)
+        self.assertEqual(lamp.daily_usage.get().working_microseconds, 0)
+
+    def test_change_brightness_error(self):
+        lamp = Lamp.objects.create(name='the lamp', brightness=50)
+        self.service.set_lamp_mode(lamp, on=True)
+        self.mock_switch.execute.side_effect = SwitchError('switch error')
+
+        with self.assertRaises(ExternalError):
+            self.service.set_lamp_mode(lamp, brightness=60)
+
+        lamp.refresh_from_db()
+        self.assertEqual(lamp.brightness, 50)
+        period = lamp.periods.get()
+        self.assertEqual(period.brightness, 50)
+        self.assertIsNone(period.end)
+
+    def test_concurrent_change_not_reverted(self):
+        lamp = Lamp.objects.create(name='the lamp')
+
+        def change_lamp(commands):
+            Lamp.objects.filter(pk=lamp.pk).update(brightness=10)
+            raise SwitchError('switch error')
+        self.mock_switch.execute.side_effect = change_lamp
+
+        with self.assertRaises(ExternalError):
+            self.service.set_lamp_mode(lamp, on=True)
+
+        lamp.refresh_from_db()
+        self.assertEqual((lamp.is_on, lamp.brightness), (True, 10))
+
+    @mock.patch('time.sleep')
+    def test_coalesced(self, mock_sleep):
+        """Periods are coalesced, the switch is called without delay."""
+        lamp = Lamp.objects.create(name='the lamp', brightness=50)
+        self.service.set_lamp_mode(lamp, on=True)
+        self.service.coalesce_window = timedelta(seconds=10)
+
+        for brightness in [60, 70]:
+            self.service.set_lamp_mode(lamp, brightness=brightness)
+
+        mock_sleep.assert_not_called()
+        self.assertEqual(self.mock_switch.execute.call_count, 3)
+        self.assertEqual(lamp.periods.get().brightness, 70)
+        lamp.refresh_from_db()
+        self.assertTrue(lamp.is_confirmed)
+
+    def test_change_brightness_coalesced_error(self):
+        lamp = Lamp.objects.create(name='the lamp', brightness=50)
+        self.service.set_lamp_mode(lamp, on=True)
+        self.service.coalesce_window = timedelta(seconds=10)
+        self.mock_switch.execute.side_effect = SwitchError('switch error')
+
+        with self.assertRaises(ExternalError):
+            self.service.set_lamp_mode(lamp, brightness=60)
+
+        lamp.refresh_from_db()
+        self.assertEqual(lamp.brightness, 50)
+        period = lamp.periods.get()
+        self.assertEqual(period.brightness, 50)
+        self.assertIsNone(period.end)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class LampServiceConcurrencyTests(TransactionTestCase):
+    """Concurrent changes of a lamp.
+
+    Requires a database with row locks, skipped on SQLite. CI should
+    run the test suite against PostgreSQL too:
+
+        DJANGO_SETTINGS_MODULE=demolighting.settings_postgres \\
+            ./manage.py test lights
+
+    with PG* environment variables pointing to the server.
+    """
+
+    thread_count = 8
+    changes_per_thread = 20
+
+    def setUp(self):
+        self.service = LampService(Switch())
+        self.errors = []
+
+    def change_lamp(self, lamp_id, thread_index):
+        try:
+            for index in range(self.changes_per_thread):
+                # Each request loads the lamp, like the API does
+                lamp = Lamp.objects.get(pk=lamp_id)
+                if (index + thread_index) % 3:
+                    self.service.set_lamp_mode(lamp,
+                                               on=bool(index % 2),
+                                               brightness=index + 1)
+                else:
+                    self.service.set_lamps_mode(
+                        [LampModeChange(lamp, on=True)])
+        except Exception as e:
+            # Deadlocks, serialization failures, etc.
+            self.errors.append(e)
+        finally:
+            connection.close()
+
+    def test_one_lamp(self):
+        lamp = Lamp.objects.create(name='the lamp')
+        threads = [threading.Thread(target=self.change_lamp,
+                                    args=(lamp.pk, index))
+                   for index in range(self.thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.errors, [])
+        lamp.refresh_from_db()
+        open_periods = lamp.periods.filter(end__isnull=True)
+        self.assertEqual(open_periods.count(), 1 if lamp.is_on else 0)
+        if lamp.is_on:
+            self.assertEqual(open_periods.get(),
+                             lamp.periods.latest('start'))
+        closed_periods = list(lamp.periods.filter(end__isnull=False))
+        self.assertEqual(
+            lamp.closed_working_microseconds,
+            sum(period.duration // timedelta(microseconds=1)
+                for period in closed_periods))
+
+    def test_group(self):
+        """Changes of lamps of a group don't wait for each other's
+        switch calls."""
+        switch_delay = 0.05
+        switch = mock.create_autospec(Switch, spec_set=True, instance=True)
+        switch.execute.side_effect = lambda commands: time.sleep(switch_delay)
+        self.service = LampService(switch)
+        group = LampGroup.objects.create(name='room')
+        lamps = [Lamp.objects.create(name=f'lamp{i}', group=group)
+                 for i in range(2)]
+        threads = [threading.Thread(target=self.change_lamp,
+                                    args=(lamp.pk, index))
+                   for index, lamp in enumerate(lamps)]
+
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.errors, [])
+        # Serialized calls would take twice as long
+        self.assertLess(time.monotonic() - started,
+                        1.5 * self.changes_per_thread * switch_delay)
+        self.assertEqual(LampGroup.objects.rebuild_counters(), [])
+
+
 # TODO: turn on, change brightness;
 # TODO: turn off, change brightness
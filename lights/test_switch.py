@@ -0,0 +1,276 @@
+import threading
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from .network_switch import (
+    CircuitBreaker,
+    CircuitOpenError,
+    ConnectionPool,
+    NetworkSwitch,
+    StandInController,
+)
+from .services import _load_switch
+from .switch import Switch, SwitchBatchError, SwitchCommand, SwitchError
+
+
+class NetworkSwitchTests(SimpleTestCase):
+
+    def start_controller(self, **kwargs):
+        controller = StandInController(**kwargs)
+        address = controller.start()
+        self.addCleanup(controller.stop)
+        return controller, address
+
+    def create_switch(self, controllers, **kwargs):
+        switch = NetworkSwitch(controllers, **kwargs)
+        self.addCleanup(switch.close)
+        return switch
+
+    def test_execute(self):
+        controller1, address1 = self.start_controller()
+        controller2, address2 = self.start_controller()
+        switch = self.create_switch([
+            {'address': address1, 'lamp_ids': (1, 10)},
+            {'address': '{}:{}'.format(*address2)},
+        ])
+
+        switch.execute([SwitchCommand(1, on=True, brightness=50),
+                        SwitchCommand(11, on=True)])
+        switch.turn_off(11)
+
+        self.assertEqual(controller1.lamps, {1: {'on': True,
+                                                 'brightness': 50}})
+        self.assertEqual(controller2.lamps, {11: {'on': False,
+                                                  'brightness': 100}})
+
+    def test_connection_reuse(self):
+        controller, address = self.start_controller()
+        switch = self.create_switch([{'address': address}])
+
+        for _ in range(3):
+            switch.turn_on(1)
+
+        self.assertEqual(controller.request_count, 3)
+        self.assertEqual(len(switch._default_pool._idle), 1)
+
+    def test_reconnect(self):
+        controller, address = self.start_controller()
+        pool = ConnectionPool(address)
+        self.addCleanup(pool.close)
+        pool.request({'commands': []})
+        # Controller restarted, the idle connection is dead
+        pool._idle[0].shutdown(2)
+
+        self.assertEqual(pool.request({'commands': []}), {'errors': {}})
+
+    def test_partial_failure(self):
+        controller1, address1 = self.start_controller()
+        controller2, address2 = self.start_controller()
+        controller1.failing_lamp_ids.add(2)
+        controller2.stop()
+        switch = self.create_switch([
+            {'address': address1, 'lamp_ids': (1, 10)},
+            {'address': address2, 'lamp_ids': (11, 20)},
+        ], timeout=1)
+
+        with self.assertRaises(SwitchBatchError) as cm:
+            switch.execute([SwitchCommand(1, on=True),
+                            SwitchCommand(2, on=True),
+                            SwitchCommand(11, on=True),
+                            SwitchCommand(21, on=True)])
+
+        self.assertEqual(set(cm.exception.errors), {2, 11, 21})
+        self.assertEqual(cm.exception.errors[21], 'no controller')
+        self.assertTrue(controller1.lamps[1]['on'])
+
+    def test_all_failed(self):
+        controller, address = self.start_controller()
+        controller.failing_lamp_ids.add(1)
+        switch = self.create_switch([{'address': address}])
+
+        with self.assertRaises(SwitchError):
+            switch.turn_on(1)
+
+    def test_timeout(self):
+        controller, address = self.start_controller(delay=0.5)
+        switch = self.create_switch([{'address': address, 'timeout': 0.1}])
+
+        with self.assertRaises(SwitchError):
+            switch.turn_on(1)
+
+    def test_concurrency(self):
+        controllers = [self.start_controller(delay=0.2) for _ in range(3)]
+        switch = self.create_switch([
+            {'address': address, 'lamp_ids': (index * 10, index * 10 + 9)}
+            for index, (controller, address) in enumerate(controllers)])
+
+        started = time.monotonic()
+        switch.execute([SwitchCommand(index * 10, on=True)
+                        for index in range(3)])
+
+        # Controllers are called in parallel
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    def test_concurrent_calls(self):
+        """Concurrent calls are limited by connections of controllers
+        only, a slow controller doesn't hold up calls to others."""
+        slow_controller, slow_address = self.start_controller(delay=0.3)
+        fast_controller, fast_address = self.start_controller()
+        switch = self.create_switch([
+            {'address': slow_address, 'lamp_ids': (1, 10)},
+            {'address': fast_address}],
+            max_connections=4)
+        durations = {}
+
+        def execute(lamp_id):
+            started = time.monotonic()
+            switch.turn_on(lamp_id)
+            durations[lamp_id] = time.monotonic() - started
+
+        threads = [threading.Thread(target=execute, args=(lamp_id,))
+                   for lamp_id in [1, 2, 3, 4, 11]]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLess(time.monotonic() - started, 0.55)
+        self.assertLess(durations[11], 0.2)
+        self.assertEqual(slow_controller.request_count, 4)
+
+    def test_connection_limit(self):
+        controller, address = self.start_controller()
+        pool = ConnectionPool(address, max_connections=1, timeout=0.1)
+        self.addCleanup(pool.close)
+        # Another request is in progress
+        pool._slots.acquire()
+
+        with self.assertRaisesRegex(SwitchError, 'no free connection'):
+            pool.request({'commands': []})
+        self.assertEqual(controller.request_count, 0)
+
+    def test_retry(self):
+        controller, address = self.start_controller()
+        controller.failing_lamp_ids.add(2)
+        apply = controller.apply
+
+        def apply_and_recover(commands):
+            errors = apply(commands)
+            controller.failing_lamp_ids.clear()
+            return errors
+
+        controller.apply = apply_and_recover
+        switch = self.create_switch([{'address': address}],
+                                    retry_backoff=0.01)
+
+        switch.execute([SwitchCommand(1, on=True), SwitchCommand(2, on=True)])
+
+        self.assertEqual(controller.request_count, 2)
+        self.assertTrue(controller.lamps[2]['on'])
+
+    def test_retries_exhausted(self):
+        controller, address = self.start_controller()
+        controller.failing_lamp_ids.add(2)
+        switch = self.create_switch([{'address': address}],
+                                    retries=1,
+                                    retry_backoff=0.01)
+
+        with self.assertRaises(SwitchBatchError) as cm:
+            switch.execute([SwitchCommand(1, on=True),
+                            SwitchCommand(2, on=True)])
+
+        self.assertEqual(list(cm.exception.errors), [2])
+        self.assertEqual(controller.request_count, 2)
+
+    def test_circuit_breaker(self):
+        controller, address = self.start_controller()
+        controller.stop()
+        switch = self.create_switch([{'address': address}],
+                                    retries=0,
+                                    failure_threshold=2)
+
+        for _ in range(2):
+            with self.assertRaisesRegex(SwitchError, 'failed to connect'):
+                switch.turn_on(1)
+        with self.assertRaisesRegex(SwitchError, 'is down'):
+            switch.turn_on(1)
+
+        status, = switch.status()
+        self.assertEqual(status['controller'], '{}:{}'.format(*address))
+        self.assertEqual(status['state'], 'open')
+        self.assertEqual(status['failures'], 2)
+        self.assertEqual(status['rejected'], 1)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch('lights.network_switch.time.monotonic',
+                             return_value=100.0)
+        self.mock_monotonic = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker('controller',
+                                      failure_threshold=2,
+                                      reset_timeout=10)
+
+    def test_open(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.before_request()
+
+        self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_request()
+        self.assertEqual(self.breaker.open_count, 1)
+
+    def test_half_open(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.mock_monotonic.return_value += 10
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        # A single probe request is allowed
+        self.breaker.before_request()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_request()
+
+        self.breaker.record_success()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.before_request()
+
+    def test_probe_failure(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.mock_monotonic.return_value += 10
+        self.breaker.before_request()
+
+        self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_request()
+        self.assertEqual(self.breaker.open_count, 2)
+
+
+class LoadSwitchTests(SimpleTestCase):
+
+    def test_default(self):
+        self.assertIsInstance(_load_switch(), Switch)
+
+    @override_settings(
+        LIGHTS_SWITCH_BACKEND='lights.network_switch.NetworkSwitch',
+        LIGHTS_SWITCH_OPTIONS={'controllers': [{'address': 'localhost:1'}],
+                               'timeout': 1})
+    def test_backend(self):
+        switch = _load_switch()
+        self.addCleanup(switch.close)
+
+        self.assertIsInstance(switch, NetworkSwitch)
@@ -2,15 +2,31 @@ from django.urls import include, path
 from rest_framework import routers
 
 from . import views
-from .api_views import LampViewSet
+from .api_views import (
+    LampGroupViewSet,
+    LampViewSet,
+    SwitchStatusView,
+    WorkingPeriodExportView,
+    WorkingTimeReportView,
+)
 
 
 rest_router = routers.DefaultRouter()
 rest_router.register('lamps', LampViewSet)
+rest_router.register('groups', LampGroupViewSet)
 
 app_name = 'lights'
 urlpatterns = [
     path('api/', include(rest_router.urls)),
+    path('api/reports/working-time/',
+         WorkingTimeReportView.as_view(),
+         name='working-time-report'),
+    path('api/switch/status/',
+         SwitchStatusView.as_view(),
+         name='switch-status'),
+    path('api/periods/export/',
+         WorkingPeriodExportView.as_view(),
+         name='period-export'),
     path('', views.root_view),
     path('lamps/', views.LampListView.as_view(), name='lamp-site-list'),
     path('lamps/<int:pk>',
@@ -17,6 +17,7 @@ def root_view(request):
 class LampListView(LoginRequiredMixin, ListView):
 
     model = Lamp
+    queryset = Lamp.objects.with_total_working_time()
 
 
 class LampDetailView(LoginRequiredMixin, DetailView):